@@ -0,0 +1,950 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+#
+# benchmark.py
+# Author: Albert Lukaszewski
+#
+# Released under the GPLv2:
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+'''
+Benchmarks for restserver.py.
+
+Usage: benchmark.py BENCHMARK [options]
+
+Benchmarks:
+  load                  Start restserver.py once for each combination of the
+                        SERVER_MODEs, keep-alive, SSL and logging settings
+                        given with -m, -k, -S and -l, and drive the same load
+                        against each.  The server runs with stub backends, so
+                        no database is needed, in a subprocess or, with -I,
+                        in this process.  Each result gives the requests per
+                        second, the latency percentiles and the CPU time the
+                        server spent per request.  With -o, the results are
+                        also saved to a file, and with -b, compared with
+                        those saved by an earlier run: a fall in requests per
+                        second or a rise in p99 latency of more than -t
+                        percent is reported, and the benchmark exits with
+                        status 1.
+
+  engines               The load benchmark with SSL and logging off.
+
+  routes                Time the lookup of a request's handler in route
+                        tables of the sizes given with -r, next to the chain
+                        of comparisons the route table replaced.  Nothing is
+                        sent over the network.
+
+  codec                 Time the encoding of responses and the decoding of
+                        request data in the profile, contact and session
+                        shapes, at each size given with -z, for every JSON
+                        library installed, with and without KEEP_TYPES.
+                        "per-request" is the encoder and decoder made anew
+                        for every request, as the server used to do.
+
+  metrics               Time what the request metrics add to each request: a
+                        mark for every phase and the count of the request in
+                        the histograms, spread over every route.  "off" is
+                        the cost of the marks with METRICS switched off.
+                        "render" is the time to build the /metrics page once
+                        every route has been counted.  The cost within a
+                        whole request can be seen with "load -x '-E 0'"
+                        against the default.
+
+  handshake             Start restserver.py with SSL in each of the SERVER_MODEs
+                        given with -m and time its TLS handshakes with
+                        openssl s_time for -T seconds, first with a new
+                        session for every connection and then resuming the
+                        first one.  TLS 1.2 is used, as s_time cannot resume
+                        a TLS 1.3 session.  Session tickets can be compared with the
+                        session cache alone with "-x '-x 0'", and older
+                        settings with -x as well.
+
+  pool                  Run a query on an SQLite database, standing in for the
+                        database of the backends, from -c threads at once,
+                        -n times each.  "none" opens a connection for every
+                        query, as a backend does on its own; the others take
+                        one from a ResourcePool of each size given with -P.
+                        Each result gives the queries per second, the
+                        connections opened and the mean wait for a pooled
+                        connection.
+
+  clock                 Time the formatting of the times that one request
+                        writes to the log and sends in its Date header,
+                        with a Clock of each CLOCK_RESOLUTION given with -R.
+                        "per-request" formats them anew for every request,
+                        as the server used to do.
+
+  serve                 Run restserver.py with the stub backends installed.
+                        Everything after "serve" is passed to restserver.py.
+                        This is what the other benchmarks start.
+
+Options:
+  -h, --help            show this help message and exit
+
+  -m MODES
+  --modes=MODES         Comma-separated SERVER_MODEs to compare.
+                        (default = single,thread,async)
+
+  -c CONCURRENCY
+  --concurrency=CONCURRENCY
+                        Set the number of clients sending requests at the
+                        same time.  (default = 16)
+
+  -n REQUESTS
+  --requests=REQUESTS   Set the number of requests each client sends.
+                        (default = 200)
+
+  -k KEEPALIVE
+  --keepalive=KEEPALIVE Comma-separated settings for whether the clients
+                        reuse their connections.  In single mode the server
+                        closes every connection after one request unless
+                        restserver.py is given -r.  (1 = yes, 0 = no,
+                        default = 1)
+
+  -S SSL
+  --ssl=SSL             Comma-separated settings for whether the server and
+                        clients speak HTTPS, with a self-signed certificate
+                        made by openssl.  (1 = yes, 0 = no, default = 0)
+
+  -l LOGGING
+  --logging=LOGGING     Comma-separated settings for whether the server logs
+                        the requests.  (1 = yes, 0 = no, default = 0)
+
+  -x SERVER_OPTIONS
+  --server-options=SERVER_OPTIONS
+                        Further options for restserver.py, such as "-C
+                        1048576" to turn the cache on.
+
+  -I
+  --in-process          Run the server in this process rather than in a
+                        subprocess.  The CPU time is then that of the
+                        clients and the server together.
+
+  -o OUTPUT
+  --output=OUTPUT       Save the results of the load benchmark to this file.
+
+  -b BASELINE
+  --baseline=BASELINE   Compare the results of the load benchmark with those
+                        saved to this file by an earlier run.
+
+  -t TOLERANCE
+  --tolerance=TOLERANCE Set the change, in percent, that counts as a
+                        regression when comparing with BASELINE.
+                        (default = 10)
+
+  -p PORT
+  --port=PORT           Set the port on which the servers are started.
+                        (default = 65001)
+
+  -r ROUTES
+  --routes=ROUTES       Comma-separated route table sizes for the routes
+                        benchmark.  (default = 3,10,50,100,500)
+
+  -i ITERATIONS
+  --iterations=ITERATIONS
+                        Set the number of lookups timed for each size in the
+                        routes benchmark.  (default = 100000)
+
+  -z SIZES
+  --sizes=SIZES         Comma-separated payload sizes for the codec benchmark,
+                        as the number of fields added to each shape.
+                        (default = 0,10,100)
+
+  -R RESOLUTIONS
+  --resolutions=RESOLUTIONS
+                        Comma-separated CLOCK_RESOLUTIONs for the clock
+                        benchmark.  (default = 0.000001,0.001,1)
+
+  -d DURATION
+  --duration=DURATION   Set how many seconds each encoding and decoding is
+                        timed in the codec benchmark, each setting in the
+                        metrics benchmark and each resolution in the clock
+                        benchmark.  (default = 0.5)
+
+  -T SECONDS
+  --seconds=SECONDS     Set how many seconds each kind of handshake is timed
+                        in the handshake benchmark.  (default = 3)
+
+  -P POOL_SIZES
+  --pool-sizes=POOL_SIZES
+                        Comma-separated pool sizes for the pool benchmark.
+                        (default = 1,4,16)
+'''
+
+
+# Use datetime for the log times formatted by the server before it
+# had a clock
+from datetime import datetime
+# Use partial to call the pool benchmark's query through a pool
+from functools import partial
+# Use product to run every combination of the load settings
+from itertools import product
+# Use json to print the results in a machine-readable form
+from json import (dumps, load)
+# Use optparse to parse CLI options
+from optparse import OptionParser
+# Use os for the paths of the server and its log, and to read the CPU
+# time of the server from /proc
+from os import (devnull, path, listdir, remove, sysconf, times)
+# Use shlex to split the further options for the server
+from shlex import split
+# Use sqlite3 as the database of the pool benchmark
+import sqlite3
+# Use signal to make sure the interrupt that stops a server run in this
+# process is not ignored, as it is when started in the background
+from signal import (signal, SIGINT, default_int_handler)
+# Use socket for the client connections
+from socket import (create_connection, error as socket_error)
+# Use wrap_socket for the connections of the SSL benchmarks
+from ssl import wrap_socket
+# Use re to read the handshake rates reported by openssl
+from re import search
+# Use subprocess to run the server under test, to make a certificate
+# for it with openssl and to time its handshakes with openssl s_time
+from subprocess import (Popen, PIPE, call)
+# Use sys to pass options through to restserver.py
+import sys
+# Use gettempdir to keep the server log out of the working directory
+from tempfile import gettempdir
+# Use Thread to run the clients, and Event and interrupt_main to stop
+# a server run in this process
+from threading import (Thread, Event)
+from thread import interrupt_main
+# Use time to measure latency
+from time import (sleep, time)
+# Use ModuleType to build the stub backends
+from types import ModuleType
+
+
+# The request sent by the clients.  The contact retrieval exercises
+# the full GET path: URI parsing, body reading, JSON decoding, the
+# backend call and the encoding of the reply.
+REQUEST = ('GET /user/00123/contact/012345609 HTTP/1.1\r\n'
+           'Host: localhost\r\n'
+           'Content-Type: application/json\r\n'
+           'Content-Length: 2\r\n'
+           '\r\n'
+           '{}')
+
+
+def installStubBackends():
+    """ Register stand-ins for the backend modules imported by
+    restserver.py.  Each returns a small, fixed result at once, so
+    that the benchmark measures the server rather than the backend. """
+
+    profile = {'name': 'Some User', 'email': 'user@somedomain.someTLD'}
+    contact = {'name': 'Some Contact', 'phone': '555-0100'}
+    session = {'sessionID': '0123456789abcdef'}
+
+    backends = {
+        'get_user': {
+            'get_user_profile': lambda agentID, data: profile,
+            'get_user_contact': lambda agentID, data: contact},
+        'put_user': {
+            'put_user_profile': lambda agentID, data: True,
+            'put_user_contact': lambda agentID, data: True},
+        'post_user': {
+            'post_user_profile': lambda agentID, data: profile,
+            'post_user_contact': lambda agentID, data: contact},
+        'delete_user': {
+            'delete_user_profile': lambda agentID, data: True,
+            'delete_user_contact': lambda agentID, data: True},
+        'sessions': {
+            'get_user_sessionID': lambda sessionID: session,
+            'put_user_sessionID': lambda sessionID: True,
+            'post_user_sessionID': lambda sessionID: session,
+            'delete_user_sessionID': lambda sessionID: True},
+    }
+
+    for name, functions in backends.items():
+        module = ModuleType(name)
+        module.__dict__.update(functions)
+        sys.modules[name] = module
+
+
+def importServer(argv = []):
+    """ Import restserver.py, which reads its options from sys.argv
+    when it is loaded, with the given options.  A copy imported
+    earlier with other options is replaced. """
+    sys.argv = [path.join(path.dirname(path.abspath(__file__)), 'restserver.py')] + argv
+    if path.dirname(sys.argv[0]) not in sys.path:
+        sys.path.insert(0, path.dirname(sys.argv[0]))
+    sys.modules.pop('restserver', None)
+    import restserver
+    return restserver
+
+
+def makeCertificate():
+    """ Return the path of a self-signed certificate and key for
+    localhost, made with openssl the first time. """
+    pem = path.join(gettempdir(), 'restserver-benchmark.pem')
+    if not path.exists(pem):
+        quiet = open(devnull, 'w')
+        status = call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+                       '-subj', '/CN=localhost', '-keyout', pem, '-out', pem],
+                      stdout = quiet, stderr = quiet)
+        if status != 0:
+            raise RuntimeError('openssl could not make a certificate for the SSL benchmarks.')
+    return pem
+
+
+def importStubbedServer(argv):
+    """ Import restserver.py with the stub backends. """
+    installStubBackends()
+    return importServer(argv)
+
+
+def serve(argv):
+    """ Run restserver.main() with the stub backends and the given
+    restserver.py options. """
+    importStubbedServer(argv).main()
+
+
+def waitForServer(port, running):
+    """ Wait until the server accepts connections on port, for as long
+    as running() is true. """
+    for i in range(100):
+        if not running():
+            break
+        try:
+            create_connection(('127.0.0.1', port)).close()
+            return True
+        except socket_error:
+            sleep(0.05)
+    return False
+
+
+def serverCommand(port, argv):
+    """ Return the restserver.py options of a benchmark server, whose
+    log is kept out of the working directory. """
+    log = path.join(gettempdir(), 'restserver-benchmark.log')
+    if path.exists(log):
+        remove(log)
+    return ['-p', str(port), '-L', log] + argv
+
+
+def startServer(port, argv):
+    """ Start the server in a subprocess and wait until it accepts
+    connections. """
+    command = [sys.executable, path.abspath(__file__), 'serve'] + serverCommand(port, argv)
+    quiet = open(devnull, 'w')
+    process = Popen(command, stdout = quiet, stderr = quiet)
+    if waitForServer(port, lambda: process.poll() is None):
+        return process
+    if process.poll() is None:
+        process.kill()
+    raise RuntimeError('The server did not start: %s' %(' '.join(command)))
+
+
+def stopServer(process):
+    process.terminate()
+    process.wait()
+
+
+def readResponse(reader):
+    """ Read one response from reader, the file of a client connection.
+    Return its status code and whether the server will close the
+    connection afterwards. """
+    statusline = reader.readline()
+    if not statusline:
+        raise ValueError('The server closed the connection.')
+    status = int(statusline.split(' ', 2)[1])
+    length = 0
+    close_connection = statusline.startswith('HTTP/1.0')
+    while True:
+        line = reader.readline()
+        if line in ('\r\n', '\n', ''):
+            break
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            close_connection = value.strip().lower() == 'close'
+    reader.read(length)
+    return status, close_connection
+
+
+def processCPU(pid):
+    """ Return the CPU seconds used so far by process pid and all its
+    descendants, such as the workers of the fork mode, or None if
+    /proc cannot be read. """
+    try:
+        entries = listdir('/proc')
+    except OSError:
+        return None
+    parents = {}
+    ticks = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' %(entry)) as stat:
+                data = stat.read()
+        except IOError:
+            continue
+        # The fields after the command name, which is in parentheses:
+        # state, ppid, ..., utime and stime at 11 and 12.
+        fields = data[data.rindex(')') + 2:].split()
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+        ticks[int(entry)] = int(fields[11]) + int(fields[12])
+    total = 0
+    family = [pid]
+    while family:
+        member = family.pop()
+        total += ticks.get(member, 0)
+        family.extend(parents.get(member, []))
+    return total / float(sysconf('SC_CLK_TCK'))
+
+
+def runClient(port, count, keepalive, latencies, statuses, ssl = False):
+    """ Send count requests, recording the latency and status code of
+    every request.  With keepalive, a connection is reused until the
+    server closes it; otherwise each request gets its own.  With ssl,
+    the connections are wrapped for HTTPS. """
+    request = REQUEST
+    if not keepalive:
+        request = request.replace('\r\n\r\n', '\r\nConnection: close\r\n\r\n', 1)
+    conn = None
+    for i in range(count):
+        start = time()
+        try:
+            if conn is None:
+                conn = create_connection(('127.0.0.1', port))
+                if ssl:
+                    conn = wrap_socket(conn)
+                reader = conn.makefile('rb')
+            conn.sendall(request)
+            status, close_connection = readResponse(reader)
+        except (socket_error, IndexError, ValueError):
+            status = 'error'
+            close_connection = True
+        latencies.append(time() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        if close_connection and conn is not None:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def percentile(ordered, fraction):
+    """ Return the value below which the given fraction of the sorted
+    list falls. """
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def runLoad(port, concurrency, requests, keepalive, ssl = False):
+    """ Drive the server with concurrency clients of requests each and
+    return a summary of the run. """
+    latencies = []
+    statuses = {}
+    clients = [Thread(target = runClient, args = (port, requests, keepalive, latencies, statuses, ssl))
+               for i in range(concurrency)]
+    start = time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p90': round(percentile(latencies, 0.90) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+    }
+
+
+def loadServer(opts, port, argv, keepalive, ssl):
+    """ Run the server on port with the restserver.py options argv,
+    drive the load of opts against it and return the summary, with the
+    CPU seconds used meanwhile by the server or, with opts.in_process,
+    by this whole process. """
+    if ssl:
+        argv = argv + ['-s', '0', '-c', makeCertificate()]
+    else:
+        argv = argv + ['-s', '1']
+
+    if not opts.in_process:
+        process = startServer(port, argv)
+        try:
+            before = processCPU(process.pid)
+            result = runLoad(port, opts.concurrency, opts.requests, keepalive, ssl)
+            after = processCPU(process.pid)
+        finally:
+            stopServer(process)
+    else:
+        # main() has to run in the main thread, where it can set its
+        # signal handlers, so the load is driven from another thread,
+        # which stops the server with a KeyboardInterrupt when done.
+        # The interrupt is lost if it lands in a request handler, which
+        # catches everything, so it is repeated until main() returns.
+        restserver = importStubbedServer(serverCommand(port, argv))
+        outcome = []
+        stopped = Event()
+        def drive():
+            try:
+                if waitForServer(port, lambda: True):
+                    before = sum(times()[:2])
+                    outcome.append(runLoad(port, opts.concurrency, opts.requests,
+                                           keepalive, ssl))
+                    outcome.append(sum(times()[:2]) - before)
+            finally:
+                while not stopped.wait(0.1):
+                    interrupt_main()
+        signal(SIGINT, default_int_handler)
+        driver = Thread(target = drive)
+        driver.start()
+        try:
+            restserver.main()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stopped.set()
+        while driver.is_alive():
+            try:
+                driver.join()
+            except KeyboardInterrupt:
+                pass
+        if not outcome:
+            raise RuntimeError('The server did not start in this process.')
+        result = outcome[0]
+        before, after = 0.0, outcome[1]
+
+    if before is not None and after is not None:
+        result['cpu_s'] = round(after - before, 3)
+        result['cpu_us_per_request'] = round((after - before) / max(result['requests'], 1) * 1e6, 1)
+    return result
+
+
+def benchLoad(opts):
+    """ Run the load against every combination of the settings. """
+    results = []
+    settings = product(opts.modes.split(','), opts.keepalive.split(','),
+                       opts.ssl.split(','), opts.logging.split(','))
+    for run, (mode, keepalive, ssl, logging) in enumerate(settings):
+        # A server run in this process keeps its listening socket open
+        # after main() returns, so each one gets a port of its own.
+        port = opts.port + run if opts.in_process else opts.port
+        argv = ['-m', mode, '-l', logging] + split(opts.server_options)
+        result = loadServer(opts, port, argv, int(keepalive), int(ssl))
+        result.update({'mode': mode, 'keepalive': int(keepalive), 'ssl': int(ssl),
+                       'logging': int(logging), 'in_process': int(bool(opts.in_process)),
+                       'concurrency': opts.concurrency, 'server_options': opts.server_options})
+        results.append(result)
+        printResult(result)
+    return results
+
+
+def benchEngines(opts):
+    """ Compare the serving modes under the same load. """
+    opts.ssl = '0'
+    opts.logging = '0'
+    return benchLoad(opts)
+
+
+# The settings that identify the same benchmark in two runs.
+SETTINGS = ('mode', 'keepalive', 'ssl', 'logging', 'in_process', 'concurrency', 'server_options')
+
+def compareResults(results, baseline, tolerance):
+    """ Compare results with those of an earlier run and return
+    whether any has regressed by more than tolerance percent. """
+    earlier = dict((tuple(result.get(name) for name in SETTINGS), result) for result in baseline)
+    regressed = False
+    for result in results:
+        before = earlier.get(tuple(result.get(name) for name in SETTINGS))
+        if before is None:
+            continue
+        rps = (result['rps'] / before['rps'] - 1) * 100 if before['rps'] else 0.0
+        p99 = result['latency_ms']['p99']
+        p99_before = before['latency_ms']['p99']
+        p99_change = (p99 / p99_before - 1) * 100 if p99_before else 0.0
+        regression = rps < -tolerance or p99_change > tolerance
+        regressed = regressed or regression
+        comparison = dict((name, result.get(name)) for name in SETTINGS)
+        comparison.update({'rps': result['rps'], 'rps_before': before['rps'],
+                           'rps_change_pct': round(rps, 1), 'p99_ms': p99,
+                           'p99_ms_before': p99_before, 'p99_change_pct': round(p99_change, 1),
+                           'regression': regression})
+        printResult(comparison)
+    return regressed
+
+
+def benchRoutes(opts):
+    """ Time how long it takes to find the handler of a request, for
+    route tables of each size given with -r.  The route table is
+    compared with the chain of string comparisons it replaced, which
+    tested each (method, agent, object) in turn. """
+    restserver = importServer()
+    results = []
+    for size in [int(n) for n in opts.routes.split(',')]:
+        table = restserver.RouteTable()
+        chain = []
+        for i in range(size):
+            key = ('GET', 'agent%d' %(i), 'object%d' %(i))
+            table.add(key[0], key[1], key[2], lambda agentID, objectID, jsondata: None,
+                      agentType = restserver.digits)
+            chain.append(key)
+
+        # Spread the lookups evenly over the routes, so that the chain
+        # is charged its average rather than its best case.
+        paths = ['/agent%d/00123/object%d/012345609' %(i, i)
+                 for i in range(0, size, max(size // 100, 1))]
+        rounds = max(opts.iterations // len(paths), 1)
+
+        start = time()
+        for n in range(rounds):
+            for uri in paths:
+                table.match('GET', uri)
+        table_ns = (time() - start) / (rounds * len(paths)) * 1e9
+
+        start = time()
+        for n in range(rounds):
+            for uri in paths:
+                uriParts = uri.split('/')
+                for method, uriAgent, uriObject in chain:
+                    if method == 'GET' and uriAgent == uriParts[1] and uriObject == uriParts[3]:
+                        break
+        chain_ns = (time() - start) / (rounds * len(paths)) * 1e9
+
+        result = {'routes': size, 'lookups': rounds * len(paths),
+                  'table_ns': round(table_ns, 1), 'chain_ns': round(chain_ns, 1)}
+        results.append(result)
+        printResult(result)
+    return results
+
+
+# The shapes of the sample API's data, as a backend returns them.
+SHAPES = {
+    'profile': {'userID': 123, 'name': 'Some User', 'email': 'user@somedomain.someTLD',
+                'verified': True, 'rating': 4.5, 'joined': '2013-01-01 12:00:00', 'bio': None},
+    'contact': {'contactID': 12345609, 'name': 'Some Contact', 'phone': '555-0100',
+                'address': '1 Some Street, Some Town', 'tags': ['work', 'family']},
+    'session': {'sessionID': '0123456789abcdef0123456789abcdef', 'expires': 1381234567},
+}
+
+
+def codecPayload(shape, size):
+    """ Return the data of SHAPE with SIZE further fields, alternately
+    strings and numbers. """
+    payload = dict(SHAPES[shape])
+    for i in range(size):
+        if i % 2:
+            payload['field%d' %(i)] = i * 1000003
+        else:
+            payload['field%d' %(i)] = 'value of field %d' %(i)
+    return payload
+
+
+def timeCall(function, argument, duration):
+    """ Call function(argument) for about DURATION seconds and return
+    the calls made per second. """
+    calls = 0
+    rounds = 1
+    start = time()
+    while True:
+        for n in xrange(rounds):
+            function(argument)
+        calls += rounds
+        elapsed = time() - start
+        if elapsed >= duration:
+            return calls / elapsed
+        rounds *= 2
+
+
+def benchCodec(opts):
+    """ Compare the JSON codecs on the shapes of the sample API. """
+    restserver = importServer()
+
+    def perRequestEncode(results):
+        records = {}
+        for k, v in results.iteritems():
+            records[k] = str(v)
+        return restserver.JSONEncoder().encode(records)
+
+    def perRequestDecode(data):
+        return restserver.JSONDecoder().decode(data)
+
+    codecs = [('per-request', 0, perRequestEncode, perRequestDecode)]
+    for library, module in (('json', True), ('simplejson', restserver.simplejson),
+                            ('ujson', restserver.ujson)):
+        if module:
+            for keep_types in (0, 1):
+                codec = restserver.JSONCodec(library, keep_types)
+                codecs.append((library, keep_types, codec.encode, codec.decode))
+
+    results = []
+    for shape in sorted(SHAPES):
+        for size in [int(n) for n in opts.sizes.split(',')]:
+            payload = codecPayload(shape, size)
+            for library, keep_types, encode, decode in codecs:
+                data = encode(payload)
+                encodes = timeCall(encode, payload, opts.duration)
+                decodes = timeCall(decode, data, opts.duration)
+                result = {'shape': shape, 'size': size, 'bytes': len(data),
+                          'library': library, 'keep_types': keep_types,
+                          'encode_per_s': round(encodes), 'decode_per_s': round(decodes),
+                          'encode_mb_s': round(encodes * len(data) / 1e6, 2),
+                          'decode_mb_s': round(decodes * len(data) / 1e6, 2)}
+                results.append(result)
+                printResult(result)
+    return results
+
+
+# The phases marked by a GET answered by the backend, in order.
+PHASES = ('parse', 'log', 'route', 'read', 'cache', 'decode', 'call', 'encode', 'write', 'log')
+
+def benchMetrics(opts):
+    """ Time the marks and the count of one request, with and without
+    METRICS. """
+    restserver = importServer()
+    metrics = restserver.metrics
+
+    class Handler(restserver.RESTHandler):
+        """ A handler with no connection, only for its marks. """
+        def __init__(self):
+            pass
+
+    handler = Handler()
+    labels = sorted(set(route.label for route in restserver.routes.routes.values()))
+
+    def request(label):
+        handler.timings = [None] * len(restserver.PHASES)
+        handler.request_start = handler.phase_start = time()
+        for phase in PHASES:
+            handler.mark(phase)
+        if restserver.metrics is not None:
+            restserver.metrics.observe('GET', label, 200, handler.phase_start - handler.request_start,
+                                       handler.timings)
+
+    def requests(count):
+        for label in labels:
+            request(label)
+
+    results = []
+    for setting in ('on', 'off'):
+        restserver.metrics = metrics if setting == 'on' else None
+        rate = timeCall(requests, None, opts.duration) * len(labels)
+        result = {'metrics': setting, 'phases': len(PHASES), 'routes': len(labels),
+                  'us_per_request': round(1e6 / rate, 3)}
+        results.append(result)
+        printResult(result)
+    renders = timeCall(lambda argument: metrics.render(), None, opts.duration)
+    result = {'metrics': 'render', 'routes': len(labels), 'bytes': len(metrics.render()),
+              'ms_per_render': round(1e3 / renders, 3)}
+    results.append(result)
+    printResult(result)
+    return results
+
+
+def benchHandshake(opts):
+    """ Count the TLS handshakes per second that the server completes
+    for new sessions and for resumed ones, timed by openssl s_time.
+    TLS 1.2 is used, since s_time closes every connection before the
+    tickets of TLS 1.3, which come after the handshake, can be read,
+    and so never resumes a TLS 1.3 session. """
+    results = []
+    for mode in opts.modes.split(','):
+        argv = ['-m', mode, '-l', '0', '-s', '0', '-c', makeCertificate()] + split(opts.server_options)
+        process = startServer(opts.port, argv)
+        try:
+            for session in ('new', 'reuse'):
+                timer = Popen(['openssl', 's_time', '-connect', '127.0.0.1:%d' %(opts.port),
+                               '-tls1_2', '-' + session, '-time', str(opts.seconds)],
+                              stdout = PIPE, stderr = PIPE)
+                output = timer.communicate()[0]
+                found = search(r'(\d+) connections in ([\d.]+) real seconds', output)
+                if timer.returncode != 0 or not found:
+                    raise RuntimeError('openssl s_time failed: %s' %(output.strip()))
+                connections, seconds = int(found.group(1)), float(found.group(2))
+                result = {'mode': mode, 'session': session, 'connections': connections,
+                          'handshakes_per_second': round(connections / max(seconds, 1e-9), 1),
+                          'server_options': opts.server_options}
+                results.append(result)
+                printResult(result)
+        finally:
+            stopServer(process)
+    return results
+
+
+def benchPool(opts):
+    """ Time queries with a connection opened for each and with pooled
+    connections. """
+    restserver = importServer()
+    database = path.join(gettempdir(), 'restserver-benchmark.db')
+    if path.exists(database):
+        remove(database)
+    setup = sqlite3.connect(database)
+    setup.execute('CREATE TABLE profile (id INTEGER PRIMARY KEY, name TEXT)')
+    setup.executemany('INSERT INTO profile VALUES (?, ?)', [(i, 'User %d' % i) for i in range(1000)])
+    setup.commit()
+    setup.close()
+
+    def connect():
+        return sqlite3.connect(database, check_same_thread = False)
+
+    def ping(connection):
+        connection.execute('SELECT 1')
+
+    def query(connection, agentID):
+        return connection.execute('SELECT name FROM profile WHERE id = ?', (agentID,)).fetchone()
+
+    def unpooled(agentID):
+        connection = connect()
+        try:
+            return query(connection, agentID)
+        finally:
+            connection.close()
+
+    results = []
+    for size in ['none'] + opts.pool_sizes.split(','):
+        if size == 'none':
+            call = unpooled
+        else:
+            pool = restserver.ResourcePool('benchmark-%s' %(size), int(size))
+            pool.bind(connect, ping)
+            call = partial(pool.call, query)
+        def client():
+            for i in range(opts.requests):
+                call(i % 1000)
+        threads = [Thread(target = client) for i in range(opts.concurrency)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - start
+        queries = opts.concurrency * opts.requests
+        result = {'pool': size, 'threads': opts.concurrency, 'queries': queries,
+                  'queries_per_second': round(queries / elapsed, 1)}
+        if size == 'none':
+            result['connections'] = queries
+        else:
+            stats = pool.stats()
+            waits = restserver.metrics.pool_waits[pool.name]
+            result.update({'connections': stats['created'], 'timeouts': stats['timeouts'],
+                           'wait_us_mean': round(waits[-1] / max(sum(waits[:-1]), 1) * 1e6, 1)})
+        results.append(result)
+        printResult(result)
+    remove(database)
+    return results
+
+
+def benchClock(opts):
+    """ Time the formatting of the times one request writes to the log
+    and sends in its Date header. """
+    restserver = importServer()
+    handler = restserver.BaseHTTPRequestHandler
+
+    def perRequest(count):
+        str(datetime.now())
+        str(datetime.now())
+        handler.date_time_string.im_func(handler)
+
+    results = []
+    for resolution in ['per-request'] + opts.resolutions.split(','):
+        if resolution == 'per-request':
+            request = perRequest
+        else:
+            clock = restserver.Clock(float(resolution))
+            def request(count):
+                clock.stamp()
+                clock.stamp()
+                clock.httpDate()
+        rate = timeCall(request, None, opts.duration)
+        result = {'clock': resolution, 'us_per_request': round(1e6 / rate, 3)}
+        results.append(result)
+        printResult(result)
+    return results
+
+
+def printResult(result):
+    """ Write one result as a line of JSON. """
+    sys.stdout.write(dumps(result, sort_keys = True) + '\n')
+    sys.stdout.flush()
+
+
+def main(argv):
+    if argv[:1] == ['serve']:
+        serve(argv[1:])
+        return
+
+    bench = OptionParser(usage = 'benchmark.py BENCHMARK [options]')
+    bench.add_option('-m', '--modes', action = 'store', dest = 'modes', help = 'Comma-separated SERVER_MODEs to compare.\n (default = single,thread,async)')
+    bench.add_option('-c', '--concurrency', action = 'store', type = 'int', dest = 'concurrency', help = 'Set the number of clients sending requests at the same time.\n (default = 16)')
+    bench.add_option('-n', '--requests', action = 'store', type = 'int', dest = 'requests', help = 'Set the number of requests each client sends.\n (default = 200)')
+    bench.add_option('-k', '--keepalive', action = 'store', dest = 'keepalive', help = 'Comma-separated settings for whether the clients reuse their connections.\n (1 = yes, 0 = no, default = 1)')
+    bench.add_option('-S', '--ssl', action = 'store', dest = 'ssl', help = 'Comma-separated settings for whether the server and clients speak HTTPS.\n (1 = yes, 0 = no, default = 0)')
+    bench.add_option('-l', '--logging', action = 'store', dest = 'logging', help = 'Comma-separated settings for whether the server logs the requests.\n (1 = yes, 0 = no, default = 0)')
+    bench.add_option('-x', '--server-options', action = 'store', dest = 'server_options', help = 'Further options for restserver.py.')
+    bench.add_option('-I', '--in-process', action = 'store_true', dest = 'in_process', help = 'Run the server in this process rather than in a subprocess.')
+    bench.add_option('-o', '--output', action = 'store', dest = 'output', help = 'Save the results of the load benchmark to this file.')
+    bench.add_option('-b', '--baseline', action = 'store', dest = 'baseline', help = 'Compare the results of the load benchmark with those saved to this file by an earlier run.')
+    bench.add_option('-t', '--tolerance', action = 'store', type = 'float', dest = 'tolerance', help = 'Set the change, in percent, that counts as a regression when comparing with BASELINE.\n (default = 10)')
+    bench.add_option('-p', '--port', action = 'store', type = 'int', dest = 'port', help = 'Set the port on which the servers are started.\n (default = 65001)')
+    bench.add_option('-r', '--routes', action = 'store', dest = 'routes', help = 'Comma-separated route table sizes for the routes benchmark.\n (default = 3,10,50,100,500)')
+    bench.add_option('-i', '--iterations', action = 'store', type = 'int', dest = 'iterations', help = 'Set the number of lookups timed for each size in the routes benchmark.\n (default = 100000)')
+    bench.add_option('-z', '--sizes', action = 'store', dest = 'sizes', help = 'Comma-separated payload sizes for the codec benchmark, as the number of fields added to each shape.\n (default = 0,10,100)')
+    bench.add_option('-T', '--seconds', action = 'store', type = 'int', dest = 'seconds', help = 'Set how many seconds each kind of handshake is timed in the handshake benchmark.\n (default = 3)')
+    bench.add_option('-P', '--pool-sizes', action = 'store', dest = 'pool_sizes', help = 'Comma-separated pool sizes for the pool benchmark.\n (default = 1,4,16)')
+    bench.add_option('-R', '--resolutions', action = 'store', dest = 'resolutions', help = 'Comma-separated CLOCK_RESOLUTIONs for the clock benchmark.\n (default = 0.000001,0.001,1)')
+    bench.add_option('-d', '--duration', action = 'store', type = 'float', dest = 'duration', help = 'Set how many seconds each encoding and decoding is timed in the codec benchmark, each setting in the metrics benchmark and each resolution in the clock benchmark.\n (default = 0.5)')
+    bench.set_defaults(modes = 'single,thread,async', concurrency = 16, requests = 200, keepalive = '1', port = 65001,
+                       routes = '3,10,50,100,500', iterations = 100000, sizes = '0,10,100', duration = 0.5,
+                       ssl = '0', logging = '0', server_options = '', in_process = False, tolerance = 10.0,
+                       seconds = 3, pool_sizes = '1,4,16', resolutions = '0.000001,0.001,1')
+    opts, args = bench.parse_args(argv)
+
+    if args in (['load'], ['engines']):
+        if args == ['load']:
+            results = benchLoad(opts)
+        else:
+            results = benchEngines(opts)
+        if opts.output:
+            with open(opts.output, 'w') as output:
+                output.write(dumps(results, indent = 1, sort_keys = True) + '\n')
+        if opts.baseline:
+            with open(opts.baseline) as baseline:
+                if compareResults(results, load(baseline), opts.tolerance):
+                    sys.exit(1)
+    elif args == ['routes']:
+        benchRoutes(opts)
+    elif args == ['codec']:
+        benchCodec(opts)
+    elif args == ['metrics']:
+        benchMetrics(opts)
+    elif args == ['handshake']:
+        benchHandshake(opts)
+    elif args == ['pool']:
+        benchPool(opts)
+    elif args == ['clock']:
+        benchClock(opts)
+    else:
+        bench.error('BENCHMARK must be one of "load", "engines", "routes", "codec", "metrics", "handshake", "pool", "clock" or "serve".')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -33,19 +33,57 @@ Options:
   --port=SERVER_PORT    Set the port on which the server is to run.   (default
                         = 65000)
                         
-  -o LOG_OUTPUT
+  -l LOG_OUTPUT
   --log=LOG_OUTPUT      Turn logging on and off.  Must be switched on in order 
-                        for other logging options like -l, -v, and -d to work.
+                        for other logging options like -L and -d to work.
                         (1 = yes, 0 = no, default = 0/no)
                         
-  -l SERVER_LOG         
+  -L SERVER_LOG         
   --Logfile=SERVER_LOG  Set the file to which the log is to be written.  Note:
-                        LOG_OUTPUT (-o) must be switched on for this file setting
+                        LOG_OUTPUT (-l) must be switched on for this file setting
                         to be effective.   (default = "./restserver.log")
                         
   -s NO_SSL
   --ssl-off=NO_SSL      Set whether HTTP is to be used instead of HTTPS.  (1 =
                         SSL off, 0 = SSL on, default = 0/on)
+
+  -c CERTFILE
+  --certfile=CERTFILE   Set the PEM file that holds the certificate chain of
+                        the server, and its private key unless KEYFILE is
+                        given.  (default = "restcert.pem")
+
+  -e KEYFILE
+  --keyfile=KEYFILE     Set the PEM file that holds the private key of the
+                        server.  (default = the key in CERTFILE)
+
+  -i CIPHERS
+  --ciphers=CIPHERS     Set the ciphers offered for TLS 1.2 and older, as an
+                        OpenSSL cipher list.  (default = "ECDHE+AESGCM:
+                        ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:
+                        !DSS")
+
+  -V TLS_MIN
+  --tls-min=TLS_MIN     Set the oldest TLS version accepted: "1.0", "1.1",
+                        "1.2" or "1.3".  (default = 1.2)
+
+  -x TLS_TICKETS
+  --tls-tickets=TLS_TICKETS
+                        Set whether clients are given session tickets with
+                        which to resume their session.  Sessions are also
+                        resumed by their ID from the session cache.  (1 =
+                        yes, 0 = no, default = 1/yes)
+
+  -a ALPN
+  --alpn=ALPN           Comma-separated protocols offered through ALPN.
+                        (default = "http/1.1")
+
+  -H HANDSHAKE_TIMEOUT
+  --handshake-timeout=HANDSHAKE_TIMEOUT
+                        Set how many seconds a client is given to complete
+                        the TLS handshake before its connection is closed.
+                        In single and fork mode, where a handshake holds up
+                        the process that runs it, this defaults to 2.
+                        (default = 10, or 2 in single and fork mode)
                         
   -d DEV_STATUS
   --development=DEV_STATUS
@@ -53,30 +91,350 @@ Options:
                         When switched to development, copious output is written 
                         to the log.  When set for deployment, one line for each 
                         of input and output is written for each request.  Note:
-                        LOG_OUTPUT (-o) must be switched on for this setting to 
+                        LOG_OUTPUT (-l) must be switched on for this setting to 
                         be effective.  (1 = development, 0 = deployment, 
                         default = 0/deployment)
+
+  -m SERVER_MODE
+  --mode=SERVER_MODE    Set how requests are served.  "single" handles one
+                        request at a time in one process.  "thread" hands
+                        connections to a fixed pool of worker threads.  "fork"
+                        pre-forks worker processes that share the listening
+                        socket.  "async" reads and writes every connection
+                        from one event loop and runs the handlers on a pool
+                        of worker threads.  (default = single)
+
+  -w WORKERS
+  --workers=WORKERS     Set the number of worker threads (thread and async
+                        modes) or worker processes (fork mode).  (default = 4)
+
+  -q QUEUE_SIZE
+  --queue-size=QUEUE_SIZE
+                        Set how many accepted connections may wait for a
+                        worker thread in thread mode.  When the queue is full,
+                        the server stops accepting until a worker is free.
+                        (default = 64)
+
+  -k KEEPALIVE_TIMEOUT
+  --keepalive-timeout=KEEPALIVE_TIMEOUT
+                        Set how many seconds an idle connection is kept open
+                        for further requests.  In thread and fork modes, an
+                        idle connection is closed at once when another client
+                        is waiting for a worker, so that idle clients never
+                        hold up the others.  (default = 15)
+
+  -r MAX_REQUESTS
+  --max-requests=MAX_REQUESTS
+                        Set how many requests are served on one connection
+                        before it is closed.  In single mode, where an open
+                        connection holds up every other client, this defaults
+                        to 1, which turns keep-alive off.  (default = 100, or
+                        1 in single mode)
+
+  -A RATE_LIMIT
+  --rate-limit=RATE_LIMIT
+                        Set how many requests a second each client may send,
+                        on average, before it is answered with 429 and a
+                        Retry-After.  The limit is checked before the body of
+                        the request is read.  GET /metrics is never limited.
+                        (0 = no limit, default = 0)
+
+  -J RATE_BURST
+  --rate-burst=RATE_BURST
+                        Set how many requests a client may send at once,
+                        above RATE_LIMIT, after it has been idle.
+                        (default = 20)
+
+  -I RATE_BY
+  --rate-by=RATE_BY     Comma-separated keys that are each limited to
+                        RATE_LIMIT: "ip", the client's IP address, and
+                        "agent", the agent and agent ID of the URI.
+                        (default = ip)
+
+  -S RATE_KEYS
+  --rate-keys=RATE_KEYS Set how many clients are tracked for each key of
+                        RATE_BY, at 24 bytes each.  (default = 262144)
+
+  -f MAX_ACTIVE
+  --max-active=MAX_ACTIVE
+                        Set how many requests may be handled, or in async
+                        mode wait for a worker thread, at once.  Any more are
+                        answered at once with 503 and a Retry-After.  GET
+                        /metrics is always answered.  (0 = no limit, default
+                        = 0)
+
+  -Q LOG_QUEUE
+  --log-queue=LOG_QUEUE Set how many log records may wait to be written.
+                        (default = 10000)
+
+  -B LOG_BATCH
+  --log-batch=LOG_BATCH Set how many waiting log records make the log writer
+                        write them out without waiting for LOG_FLUSH.
+                        (default = 256)
+
+  -F LOG_FLUSH
+  --log-flush=LOG_FLUSH Set the longest time in seconds a log record waits
+                        before it is written.  (default = 1.0)
+
+  -P LOG_POLICY
+  --log-policy=LOG_POLICY
+                        Set what happens to a log record when LOG_QUEUE
+                        records are already waiting.  "block" makes the
+                        request wait for room; "drop" discards the record
+                        and counts it in the log.  (default = block)
+
+  -O LOG_FORMAT
+  --log-format=LOG_FORMAT
+                        Set how requests are logged.  "text" writes the
+                        lines described under DEV_STATUS.  "json" writes one
+                        JSON object per line, and "binary" one length-
+                        prefixed record, for each request answered, holding
+                        its time, method, path, client, status, latency and
+                        response size.  (default = text)
+
+  -R LOG_ROTATE_SIZE
+  --log-rotate-size=LOG_ROTATE_SIZE
+                        Set the size in bytes past which the log is rotated.
+                        (0 = never, default = 0)
+
+  -T LOG_ROTATE_TIME
+  --log-rotate-time=LOG_ROTATE_TIME
+                        Set how many seconds the log is written to before it
+                        is rotated.  (0 = never, default = 0)
+
+  -K LOG_KEEP
+  --log-keep=LOG_KEEP   Set how many rotated logs are kept, as SERVER_LOG.1
+                        (the newest) to SERVER_LOG.LOG_KEEP.  (default = 5)
+
+  -D CLOCK_RESOLUTION
+  --clock-resolution=CLOCK_RESOLUTION
+                        Set how many seconds apart the times written to the
+                        log may be told apart.  Each time is formatted once
+                        and reused until the next such tick; the Date header
+                        is formatted once a second whatever this is.
+                        (default = 0.001)
+
+  -Y TRACE_EVERY
+  --trace-every=TRACE_EVERY
+                        Set how often the traceback of a failed request is
+                        written to the log in deployment: one failure in
+                        TRACE_EVERY.  In development, every traceback is
+                        written.  Otherwise, only the status and the kind
+                        of failure are.  (0 = never, default = 0)
+
+  -C CACHE_SIZE
+  --cache-size=CACHE_SIZE
+                        Set how many bytes of GET responses are cached.
+                        Only the routes given a ttl are cached.  (0 = no
+                        cache, default = 0)
+
+  -X COALESCE_TIMEOUT
+  --coalesce-timeout=COALESCE_TIMEOUT
+                        Set how many seconds a GET waits for an identical GET
+                        that is already calling the backend, to be answered
+                        with the same response, before it calls the backend
+                        itself.  (0 = no coalescing, default = 5)
+
+  -j JSON_LIBRARY
+  --json-library=JSON_LIBRARY
+                        Set the library that encodes and decodes JSON:
+                        "ujson", "simplejson" or the standard library's
+                        "json".  "auto" uses the first of these that is
+                        installed.  (default = auto)
+
+  -t KEEP_TYPES
+  --keep-types=KEEP_TYPES
+                        Set whether numbers, booleans, nulls, lists and
+                        nested objects returned by the backends are sent as
+                        they are, rather than as strings.  (1 = yes, 0 = no,
+                        default = 0/no)
+
+  -b MAX_BODY
+  --max-body=MAX_BODY   Set the largest request body, in bytes, that is
+                        read.  A request with a larger body is answered with
+                        413 before the body is read.  (default = 1048576)
+
+  -Z COMPRESS_LEVEL
+  --compress-level=COMPRESS_LEVEL
+                        Set the zlib level, from 1 (fastest) to 9 (smallest),
+                        at which responses are compressed with gzip or
+                        deflate for clients whose Accept-Encoding allows it.
+                        (0 = no compression, default = 6)
+
+  -z COMPRESS_MIN
+  --compress-min=COMPRESS_MIN
+                        Set the smallest response body, in bytes, that is
+                        compressed.  (default = 1024)
+
+  -M BATCH_MAX
+  --batch-max=BATCH_MAX Set the largest number of operations taken by one
+                        POST to /batch.  (default = 100)
+
+  -W BATCH_WORKERS
+  --batch-workers=BATCH_WORKERS
+                        Set the number of threads in each process that run
+                        the operations of a batch sent with ?concurrent=1.
+                        (default = 4)
+
+  -n POOL_SIZE
+  --pool-size=POOL_SIZE Set how many connections each ResourcePool opens at
+                        most in each process, unless the pool sets its own
+                        size.  (default = 8)
+
+  -u POOL_IDLE
+  --pool-idle=POOL_IDLE Set how many seconds a pooled connection is kept
+                        unused before it is closed.  (default = 300)
+
+  -y POOL_CHECK
+  --pool-check=POOL_CHECK
+                        Set how many seconds a pooled connection may be
+                        unused before it is checked again before use.
+                        (default = 30)
+
+  -U POOL_TIMEOUT
+  --pool-timeout=POOL_TIMEOUT
+                        Set how many seconds a request waits for a pooled
+                        connection before it is answered with 503.
+                        (default = 5)
+
+  -E METRICS
+  --metrics=METRICS     Set whether each request and each phase of it are
+                        timed, and the histograms served on GET /metrics in
+                        the Prometheus text format.  (1 = yes, 0 = no,
+                        default = 1/yes)
+
+  -G PROFILE_DIR
+  --profile-dir=PROFILE_DIR
+                        Set the directory to which profiles are written.  A
+                        SIGUSR1 samples the stacks of the serving threads for
+                        PROFILE_SECONDS and writes them as collapsed stacks
+                        for flame graphs.  A SIGUSR2 switches the profiling of
+                        every PROFILE_EVERY-th request with cProfile on, and
+                        the next one off again, after which the next request
+                        writes their statistics in the pstats format.
+                        (default = ".")
+
+  -g PROFILE_SECONDS
+  --profile-seconds=PROFILE_SECONDS
+                        Set how many seconds a SIGUSR1 samples the stacks
+                        for.  (default = 10)
+
+  -N PROFILE_EVERY
+  --profile-every=PROFILE_EVERY
+                        Set which requests are profiled once a SIGUSR2 has
+                        switched it on: one in every PROFILE_EVERY.
+                        (default = 100)
 '''
 
 
+# Use array to hold the token buckets of the rate limiters
+from array import array
+# Use asyncore for the event loop of the async serving mode
+import asyncore
 # To create a basic HTTP server.
 from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+# Use bisect_left to find the histogram bucket of a timing
+from bisect import bisect_left
+# Use deque to pass finished requests back to the event loop, and
+# OrderedDict to keep the response cache in order of use
+from collections import (deque, OrderedDict)
 # Use SimpleCookie for cookie handling
 from Cookie import SimpleCookie
-# Use datatime for timing of events
-from datetime import datetime
+# Use escape to quote the message on error pages
+from cgi import escape
+# Use Profile to profile single requests
+from cProfile import Profile
+# Use cStringIO to hold requests and responses of the async mode in memory
+from cStringIO import StringIO
+# Use formatdate for the Date header of responses
+from email.utils import formatdate
+# Use EINTR to resume waiting on worker processes after a signal
+from errno import EINTR
+# Use fcntl to keep the wakeup pipe of the async mode from blocking
+from fcntl import (fcntl, F_GETFL, F_SETFL)
+# Use partial to bind each route's handler to its backend function
+from functools import partial
+# Use sha1 to key cached responses on the request data and to tag
+# responses for conditional GETs
+from hashlib import sha1
+# Use import_module to load the backend modules named by the routes
+from importlib import import_module
+# Use count to pick the failures whose traceback is logged
+from itertools import count
 # Use sundry functions from json for serialized I/O
 from json import (dumps, loads, JSONDecoder, JSONEncoder)
+# Use encode_basestring_ascii to quote strings in JSON log records
+from json.encoder import encode_basestring_ascii
+# Use ujson or simplejson, if either is installed, to encode and
+# decode JSON faster than the standard library
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+# Use ThreadPool to run the operations of a batch at the same time
+from multiprocessing.pool import ThreadPool
 # Use optparse to parse CLI options
 from optparse import OptionParser
-# Use wrap_socket to encrypt communication
-from ssl import wrap_socket
-# Use stdout for output
-from sys import stdout,stderr
-# Use format_exc to format tracebacks when exceptions occur
+# Use fork, kill, wait and waitpid to run pre-forked worker processes,
+# a pipe to wake the event loop of the async mode and the handshake
+# thread of the thread mode, and file descriptor I/O for the log
+# writer, which also renames the files it rotates.  The
+# profiles of each process are named with getpid and placed with join,
+# and the frames of sampled stacks named with basename.  getpid also
+# tells a ResourcePool that it is in a newly forked worker.
+from os import (fork, kill, wait, waitpid, _exit, pipe, read, write, close, fsync,
+                stat, fstat, rename, unlink, getpid,
+                O_NONBLOCK, O_WRONLY, O_APPEND, O_CREAT)
+from os import open as os_open
+from os.path import (basename, exists, join)
+# Use Stats to add up the profiles of single requests
+from pstats import Stats
+# Use Queue to hold accepted connections for the worker threads
+from Queue import Queue
+# Use poll to wait for the client during a TLS handshake
+from select import (poll, POLLIN, POLLOUT, error as select_error)
+# Use signal to stop the worker processes along with the server, to
+# reload the backends on SIGHUP, and to start profiling on SIGUSR1 and
+# SIGUSR2
+from signal import (signal, SIGTERM, SIGHUP, SIGUSR1, SIGUSR2)
+# Use socket to create the listening socket of the async mode, and
+# to tell a connection that fails during its TLS handshake
+from socket import (AF_INET, SOCK_STREAM, error as socket_error)
+# Use SSLContext to encrypt communication
+from ssl import (SSLContext, SSLError, SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE,
+                 PROTOCOL_SSLv23, OP_NO_SSLv2, OP_NO_SSLv3, OP_NO_TLSv1, OP_NO_TLSv1_1,
+                 OP_NO_TLSv1_2, OP_CIPHER_SERVER_PREFERENCE, HAS_ALPN)
+# Use pack to build the records of the binary log and the trailers
+# of compressed responses
+from struct import pack
+# Use stdout for output, _current_frames to sample the stacks of the
+# serving threads, and exc_info to tell a halt from a failed request
+from sys import stdout,stderr,_current_frames,exc_info
+# Use Thread to run the worker threads, Event to wake the log writer,
+# Lock to share the response cache between threads, Condition to wait
+# for a pooled connection or for room in the log queue, Semaphore to
+# cap the TLS handshakes under way, current_thread to leave the
+# profiler's own thread out of its samples and to give each thread
+# back its last pooled connection, and local to keep the metrics of
+# each thread apart
+from threading import (Thread, Event, Lock, Condition, Semaphore, current_thread, local)
+# Use time to find idle connections in the async mode, sleep to pace
+# the profiler's samples, and localtime and strftime to format the
+# times of the log
+from time import (time, sleep, localtime, strftime)
+# Use format_exc to format the tracebacks written to the log
 from traceback import format_exc
+# Use GeneratorType to hold a pooled connection while a backend's
+# generator runs
+from types import GeneratorType
 # Use urlparse for rewriting URIs
 from urlparse import urlparse
+# Use zlib to compress responses with gzip or deflate
+from zlib import (compressobj, crc32, adler32, DEFLATED, Z_SYNC_FLUSH)
 
 # Retrieve CLI Options
 server = OptionParser()
@@ -84,8 +442,8 @@ server = OptionParser()
 server.add_option('-p', action = 'store', dest = 'server_port', help = 'Set the port on which the server is to run.\n (default = 65000)')
 server.add_option('--port', action = 'store', dest = 'server_port', help = 'Set the port on which the server is to run.\n  (default = 65000)')
 
-server.add_option('-l', action = 'store', dest = 'log_output', help = 'Set whether logging should be done.  Must be switched on in order for other logging options like -L, -v, and -d to work.\n (1 = yes, 0 = no, default = 0/no)')
-server.add_option('--log', action = 'store', dest = 'log_output', help = 'Set whether logging should be done.  Must be switched on in order for other logging options like -L, -v, and -d to work.\n (1 = yes, 0 = no, default = 0/no)')
+server.add_option('-l', action = 'store', dest = 'log_output', help = 'Set whether logging should be done.  Must be switched on in order for other logging options like -L and -d to work.\n (1 = yes, 0 = no, default = 0/no)')
+server.add_option('--log', action = 'store', dest = 'log_output', help = 'Set whether logging should be done.  Must be switched on in order for other logging options like -L and -d to work.\n (1 = yes, 0 = no, default = 0/no)')
 
 server.add_option('-L', action = 'store', dest = 'server_log', help = 'Set to which file the log is to be written.  Note that LOG_OUTPUT must be switched on for this file setting to be effective.\n (default = "./restserver.log")')
 server.add_option('--Logfile', action = 'store', dest = 'server_log', help = 'Set to which file the log is to be written.  Note that LOG_OUTPUT must be switched on for this file setting to be effective.\n  (default = "./restserver.log")')
@@ -93,15 +451,189 @@ server.add_option('--Logfile', action = 'store', dest = 'server_log', help = 'Se
 server.add_option('-s', action = 'store', dest = 'no_ssl', help = 'Set whether HTTP is to be used instead of HTTPS.\n (1 = SSL off, 0 = SSL on, default = 0/on)')
 server.add_option('--ssl-off', action = 'store', dest = 'no_ssl', help = 'Set whether HTTP is to be used instead of HTTPS.\n (1 = SSL off, 0 = SSL on, default = 0/on)')
 
+server.add_option('-c', action = 'store', dest = 'certfile', help = 'Set the PEM file that holds the certificate chain of the server, and its private key unless KEYFILE is given.\n (default = "restcert.pem")')
+server.add_option('--certfile', action = 'store', dest = 'certfile', help = 'Set the PEM file that holds the certificate chain of the server, and its private key unless KEYFILE is given.\n (default = "restcert.pem")')
+
+server.add_option('-e', action = 'store', dest = 'keyfile', help = 'Set the PEM file that holds the private key of the server.\n (default = the key in CERTFILE)')
+server.add_option('--keyfile', action = 'store', dest = 'keyfile', help = 'Set the PEM file that holds the private key of the server.\n (default = the key in CERTFILE)')
+
+server.add_option('-i', action = 'store', dest = 'ciphers', help = 'Set the ciphers offered for TLS 1.2 and older, as an OpenSSL cipher list.\n (default = "ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:!DSS")')
+server.add_option('--ciphers', action = 'store', dest = 'ciphers', help = 'Set the ciphers offered for TLS 1.2 and older, as an OpenSSL cipher list.\n (default = "ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:!DSS")')
+
+server.add_option('-V', action = 'store', dest = 'tls_min', help = 'Set the oldest TLS version accepted: "1.0", "1.1", "1.2" or "1.3".\n (default = 1.2)')
+server.add_option('--tls-min', action = 'store', dest = 'tls_min', help = 'Set the oldest TLS version accepted: "1.0", "1.1", "1.2" or "1.3".\n (default = 1.2)')
+
+server.add_option('-x', action = 'store', dest = 'tls_tickets', help = 'Set whether clients are given session tickets with which to resume their session.  Sessions are also resumed by their ID from the session cache.\n (1 = yes, 0 = no, default = 1/yes)')
+server.add_option('--tls-tickets', action = 'store', dest = 'tls_tickets', help = 'Set whether clients are given session tickets with which to resume their session.  Sessions are also resumed by their ID from the session cache.\n (1 = yes, 0 = no, default = 1/yes)')
+
+server.add_option('-a', action = 'store', dest = 'alpn', help = 'Comma-separated protocols offered through ALPN.\n (default = "http/1.1")')
+server.add_option('--alpn', action = 'store', dest = 'alpn', help = 'Comma-separated protocols offered through ALPN.\n (default = "http/1.1")')
+
+server.add_option('-H', action = 'store', dest = 'handshake_timeout', help = 'Set how many seconds a client is given to complete the TLS handshake before its connection is closed.  In single and fork mode, where a handshake holds up the process that runs it, this defaults to 2.\n (default = 10, or 2 in single and fork mode)')
+server.add_option('--handshake-timeout', action = 'store', dest = 'handshake_timeout', help = 'Set how many seconds a client is given to complete the TLS handshake before its connection is closed.  In single and fork mode, where a handshake holds up the process that runs it, this defaults to 2.\n (default = 10, or 2 in single and fork mode)')
+
 server.add_option('-d', action = 'store', dest = 'dev_status', help = 'Set whether the server is being used for development or deployment.  When switched for development, copious output is written to the log.  When switched to deployment, one line for each of input and output is written for each request.  Note that LOG_OUTPUT must be switched on for this setting to be effective.\n (1 = development, 0 = deployment, default = 0/deployment)')
 server.add_option('--development', action = 'store', dest = 'dev_status', help = 'Set whether the server is being used for development or deployment.  When switched for development, copious output is written to the log.  When switched to deployment, one line for each of input and output is written for each request.  Note that LOG_OUTPUT must be switched on for this setting to be effective.\n (1 = development, 0 = deployment, default = 0/deployment)')
 
+server.add_option('-m', action = 'store', dest = 'server_mode', help = 'Set how requests are served: "single" handles one request at a time, "thread" uses a fixed pool of worker threads, "fork" pre-forks worker processes that share the listening socket, and "async" serves every connection from one event loop and runs the handlers on a pool of worker threads.\n (default = single)')
+server.add_option('--mode', action = 'store', dest = 'server_mode', help = 'Set how requests are served: "single" handles one request at a time, "thread" uses a fixed pool of worker threads, "fork" pre-forks worker processes that share the listening socket, and "async" serves every connection from one event loop and runs the handlers on a pool of worker threads.\n (default = single)')
+
+server.add_option('-w', action = 'store', dest = 'workers', help = 'Set the number of worker threads (thread and async modes) or worker processes (fork mode).\n (default = 4)')
+server.add_option('--workers', action = 'store', dest = 'workers', help = 'Set the number of worker threads (thread and async modes) or worker processes (fork mode).\n (default = 4)')
+
+server.add_option('-q', action = 'store', dest = 'queue_size', help = 'Set how many accepted connections may wait for a worker thread in thread mode.  When the queue is full, the server stops accepting until a worker is free.\n (default = 64)')
+server.add_option('--queue-size', action = 'store', dest = 'queue_size', help = 'Set how many accepted connections may wait for a worker thread in thread mode.  When the queue is full, the server stops accepting until a worker is free.\n (default = 64)')
+
+server.add_option('-k', action = 'store', dest = 'keepalive_timeout', help = 'Set how many seconds an idle connection is kept open for further requests.  In thread and fork modes, an idle connection is closed at once when another client is waiting for a worker, so that idle clients never hold up the others.\n (default = 15)')
+server.add_option('--keepalive-timeout', action = 'store', dest = 'keepalive_timeout', help = 'Set how many seconds an idle connection is kept open for further requests.  In thread and fork modes, an idle connection is closed at once when another client is waiting for a worker, so that idle clients never hold up the others.\n (default = 15)')
+
+server.add_option('-Q', action = 'store', dest = 'log_queue', help = 'Set how many log records may wait to be written.\n (default = 10000)')
+server.add_option('--log-queue', action = 'store', dest = 'log_queue', help = 'Set how many log records may wait to be written.\n (default = 10000)')
+
+server.add_option('-B', action = 'store', dest = 'log_batch', help = 'Set how many waiting log records make the log writer write them out without waiting for LOG_FLUSH.\n (default = 256)')
+server.add_option('--log-batch', action = 'store', dest = 'log_batch', help = 'Set how many waiting log records make the log writer write them out without waiting for LOG_FLUSH.\n (default = 256)')
+
+server.add_option('-F', action = 'store', dest = 'log_flush', help = 'Set the longest time in seconds a log record waits before it is written.\n (default = 1.0)')
+server.add_option('--log-flush', action = 'store', dest = 'log_flush', help = 'Set the longest time in seconds a log record waits before it is written.\n (default = 1.0)')
+
+server.add_option('-P', action = 'store', dest = 'log_policy', help = 'Set what happens to a log record when LOG_QUEUE records are already waiting: "block" makes the request wait for room, and "drop" discards the record and counts it in the log.\n (default = block)')
+server.add_option('--log-policy', action = 'store', dest = 'log_policy', help = 'Set what happens to a log record when LOG_QUEUE records are already waiting: "block" makes the request wait for room, and "drop" discards the record and counts it in the log.\n (default = block)')
+
+server.add_option('-O', action = 'store', dest = 'log_format', help = 'Set how requests are logged: "text" writes the lines described under DEV_STATUS, while "json" writes one JSON object per line and "binary" one length-prefixed record for each request answered, holding its time, method, path, client, status, latency and response size.\n (default = text)')
+server.add_option('--log-format', action = 'store', dest = 'log_format', help = 'Set how requests are logged: "text" writes the lines described under DEV_STATUS, while "json" writes one JSON object per line and "binary" one length-prefixed record for each request answered, holding its time, method, path, client, status, latency and response size.\n (default = text)')
+
+server.add_option('-R', action = 'store', dest = 'log_rotate_size', help = 'Set the size in bytes past which the log is rotated.\n (0 = never, default = 0)')
+server.add_option('--log-rotate-size', action = 'store', dest = 'log_rotate_size', help = 'Set the size in bytes past which the log is rotated.\n (0 = never, default = 0)')
+
+server.add_option('-T', action = 'store', dest = 'log_rotate_time', help = 'Set how many seconds the log is written to before it is rotated.\n (0 = never, default = 0)')
+server.add_option('--log-rotate-time', action = 'store', dest = 'log_rotate_time', help = 'Set how many seconds the log is written to before it is rotated.\n (0 = never, default = 0)')
+
+server.add_option('-K', action = 'store', dest = 'log_keep', help = 'Set how many rotated logs are kept, as SERVER_LOG.1 (the newest) to SERVER_LOG.LOG_KEEP.\n (default = 5)')
+server.add_option('--log-keep', action = 'store', dest = 'log_keep', help = 'Set how many rotated logs are kept, as SERVER_LOG.1 (the newest) to SERVER_LOG.LOG_KEEP.\n (default = 5)')
+
+server.add_option('-D', action = 'store', dest = 'clock_resolution', help = 'Set how many seconds apart the times written to the log may be told apart.  Each time is formatted once and reused until the next such tick; the Date header is formatted once a second whatever this is.\n (default = 0.001)')
+server.add_option('--clock-resolution', action = 'store', dest = 'clock_resolution', help = 'Set how many seconds apart the times written to the log may be told apart.  Each time is formatted once and reused until the next such tick; the Date header is formatted once a second whatever this is.\n (default = 0.001)')
+
+server.add_option('-Y', action = 'store', dest = 'trace_every', help = 'Set how often the traceback of a failed request is written to the log in deployment: one failure in TRACE_EVERY.  In development, every traceback is written.  Otherwise, only the status and the kind of failure are.\n (0 = never, default = 0)')
+server.add_option('--trace-every', action = 'store', dest = 'trace_every', help = 'Set how often the traceback of a failed request is written to the log in deployment: one failure in TRACE_EVERY.  In development, every traceback is written.  Otherwise, only the status and the kind of failure are.\n (0 = never, default = 0)')
+
+server.add_option('-C', action = 'store', dest = 'cache_size', help = 'Set how many bytes of GET responses are cached.  Only the routes given a ttl are cached.\n (0 = no cache, default = 0)')
+server.add_option('--cache-size', action = 'store', dest = 'cache_size', help = 'Set how many bytes of GET responses are cached.  Only the routes given a ttl are cached.\n (0 = no cache, default = 0)')
+
+server.add_option('-X', action = 'store', dest = 'coalesce_timeout', help = 'Set how many seconds a GET waits for an identical GET that is already calling the backend, to be answered with the same response, before it calls the backend itself.\n (0 = no coalescing, default = 5)')
+server.add_option('--coalesce-timeout', action = 'store', dest = 'coalesce_timeout', help = 'Set how many seconds a GET waits for an identical GET that is already calling the backend, to be answered with the same response, before it calls the backend itself.\n (0 = no coalescing, default = 5)')
+
+server.add_option('-j', action = 'store', dest = 'json_library', help = 'Set the library that encodes and decodes JSON: "ujson", "simplejson" or the standard library\'s "json".  "auto" uses the first of these that is installed.\n (default = auto)')
+server.add_option('--json-library', action = 'store', dest = 'json_library', help = 'Set the library that encodes and decodes JSON: "ujson", "simplejson" or the standard library\'s "json".  "auto" uses the first of these that is installed.\n (default = auto)')
+
+server.add_option('-t', action = 'store', dest = 'keep_types', help = 'Set whether numbers, booleans, nulls, lists and nested objects returned by the backends are sent as they are, rather than as strings.\n (1 = yes, 0 = no, default = 0/no)')
+server.add_option('--keep-types', action = 'store', dest = 'keep_types', help = 'Set whether numbers, booleans, nulls, lists and nested objects returned by the backends are sent as they are, rather than as strings.\n (1 = yes, 0 = no, default = 0/no)')
+
+server.add_option('-b', action = 'store', dest = 'max_body', help = 'Set the largest request body, in bytes, that is read.  A request with a larger body is answered with 413 before the body is read.\n (default = 1048576)')
+server.add_option('--max-body', action = 'store', dest = 'max_body', help = 'Set the largest request body, in bytes, that is read.  A request with a larger body is answered with 413 before the body is read.\n (default = 1048576)')
+
+server.add_option('-Z', action = 'store', dest = 'compress_level', help = 'Set the zlib level, from 1 (fastest) to 9 (smallest), at which responses are compressed with gzip or deflate for clients whose Accept-Encoding allows it.\n (0 = no compression, default = 6)')
+server.add_option('--compress-level', action = 'store', dest = 'compress_level', help = 'Set the zlib level, from 1 (fastest) to 9 (smallest), at which responses are compressed with gzip or deflate for clients whose Accept-Encoding allows it.\n (0 = no compression, default = 6)')
+
+server.add_option('-z', action = 'store', dest = 'compress_min', help = 'Set the smallest response body, in bytes, that is compressed.\n (default = 1024)')
+server.add_option('--compress-min', action = 'store', dest = 'compress_min', help = 'Set the smallest response body, in bytes, that is compressed.\n (default = 1024)')
+
+server.add_option('-M', action = 'store', dest = 'batch_max', help = 'Set the largest number of operations taken by one POST to /batch.\n (default = 100)')
+server.add_option('--batch-max', action = 'store', dest = 'batch_max', help = 'Set the largest number of operations taken by one POST to /batch.\n (default = 100)')
+
+server.add_option('-W', action = 'store', dest = 'batch_workers', help = 'Set the number of threads in each process that run the operations of a batch sent with ?concurrent=1.\n (default = 4)')
+server.add_option('--batch-workers', action = 'store', dest = 'batch_workers', help = 'Set the number of threads in each process that run the operations of a batch sent with ?concurrent=1.\n (default = 4)')
+
+server.add_option('-n', action = 'store', dest = 'pool_size', help = 'Set how many connections each ResourcePool opens at most in each process, unless the pool sets its own size.\n (default = 8)')
+server.add_option('--pool-size', action = 'store', dest = 'pool_size', help = 'Set how many connections each ResourcePool opens at most in each process, unless the pool sets its own size.\n (default = 8)')
+
+server.add_option('-u', action = 'store', dest = 'pool_idle', help = 'Set how many seconds a pooled connection is kept unused before it is closed.\n (default = 300)')
+server.add_option('--pool-idle', action = 'store', dest = 'pool_idle', help = 'Set how many seconds a pooled connection is kept unused before it is closed.\n (default = 300)')
+
+server.add_option('-y', action = 'store', dest = 'pool_check', help = 'Set how many seconds a pooled connection may be unused before it is checked again before use.\n (default = 30)')
+server.add_option('--pool-check', action = 'store', dest = 'pool_check', help = 'Set how many seconds a pooled connection may be unused before it is checked again before use.\n (default = 30)')
+
+server.add_option('-U', action = 'store', dest = 'pool_timeout', help = 'Set how many seconds a request waits for a pooled connection before it is answered with 503.\n (default = 5)')
+server.add_option('--pool-timeout', action = 'store', dest = 'pool_timeout', help = 'Set how many seconds a request waits for a pooled connection before it is answered with 503.\n (default = 5)')
+
+server.add_option('-E', action = 'store', dest = 'metrics', help = 'Set whether each request and each phase of it are timed, and the histograms served on GET /metrics in the Prometheus text format.\n (1 = yes, 0 = no, default = 1/yes)')
+server.add_option('--metrics', action = 'store', dest = 'metrics', help = 'Set whether each request and each phase of it are timed, and the histograms served on GET /metrics in the Prometheus text format.\n (1 = yes, 0 = no, default = 1/yes)')
+
+server.add_option('-G', action = 'store', dest = 'profile_dir', help = 'Set the directory to which profiles are written.  A SIGUSR1 samples the stacks of the serving threads for PROFILE_SECONDS and writes them as collapsed stacks for flame graphs.  A SIGUSR2 switches the profiling of every PROFILE_EVERY-th request with cProfile on, and the next one off again, after which the next request writes their statistics in the pstats format.\n (default = ".")')
+server.add_option('--profile-dir', action = 'store', dest = 'profile_dir', help = 'Set the directory to which profiles are written.  A SIGUSR1 samples the stacks of the serving threads for PROFILE_SECONDS and writes them as collapsed stacks for flame graphs.  A SIGUSR2 switches the profiling of every PROFILE_EVERY-th request with cProfile on, and the next one off again, after which the next request writes their statistics in the pstats format.\n (default = ".")')
+
+server.add_option('-g', action = 'store', dest = 'profile_seconds', help = 'Set how many seconds a SIGUSR1 samples the stacks for.\n (default = 10)')
+server.add_option('--profile-seconds', action = 'store', dest = 'profile_seconds', help = 'Set how many seconds a SIGUSR1 samples the stacks for.\n (default = 10)')
+
+server.add_option('-N', action = 'store', dest = 'profile_every', help = 'Set which requests are profiled once a SIGUSR2 has switched it on: one in every PROFILE_EVERY.\n (default = 100)')
+server.add_option('--profile-every', action = 'store', dest = 'profile_every', help = 'Set which requests are profiled once a SIGUSR2 has switched it on: one in every PROFILE_EVERY.\n (default = 100)')
+
+server.add_option('-r', action = 'store', dest = 'max_requests', help = 'Set how many requests are served on one connection before it is closed.  In single mode, where an open connection holds up every other client, this defaults to 1, which turns keep-alive off.\n (default = 100, or 1 in single mode)')
+server.add_option('--max-requests', action = 'store', dest = 'max_requests', help = 'Set how many requests are served on one connection before it is closed.  In single mode, where an open connection holds up every other client, this defaults to 1, which turns keep-alive off.\n (default = 100, or 1 in single mode)')
+
+server.add_option('-A', action = 'store', dest = 'rate_limit', help = 'Set how many requests a second each client may send, on average, before it is answered with 429 and a Retry-After.  The limit is checked before the body of the request is read.  GET /metrics is never limited.\n (0 = no limit, default = 0)')
+server.add_option('--rate-limit', action = 'store', dest = 'rate_limit', help = 'Set how many requests a second each client may send, on average, before it is answered with 429 and a Retry-After.  The limit is checked before the body of the request is read.  GET /metrics is never limited.\n (0 = no limit, default = 0)')
+
+server.add_option('-J', action = 'store', dest = 'rate_burst', help = 'Set how many requests a client may send at once, above RATE_LIMIT, after it has been idle.\n (default = 20)')
+server.add_option('--rate-burst', action = 'store', dest = 'rate_burst', help = 'Set how many requests a client may send at once, above RATE_LIMIT, after it has been idle.\n (default = 20)')
+
+server.add_option('-I', action = 'store', dest = 'rate_by', help = 'Comma-separated keys that are each limited to RATE_LIMIT: "ip", the client\'s IP address, and "agent", the agent and agent ID of the URI.\n (default = ip)')
+server.add_option('--rate-by', action = 'store', dest = 'rate_by', help = 'Comma-separated keys that are each limited to RATE_LIMIT: "ip", the client\'s IP address, and "agent", the agent and agent ID of the URI.\n (default = ip)')
+
+server.add_option('-S', action = 'store', dest = 'rate_keys', help = 'Set how many clients are tracked for each key of RATE_BY, at 24 bytes each.\n (default = 262144)')
+server.add_option('--rate-keys', action = 'store', dest = 'rate_keys', help = 'Set how many clients are tracked for each key of RATE_BY, at 24 bytes each.\n (default = 262144)')
+
+server.add_option('-f', action = 'store', dest = 'max_active', help = 'Set how many requests may be handled, or in async mode wait for a worker thread, at once.  Any more are answered at once with 503 and a Retry-After.  GET /metrics is always answered.\n (0 = no limit, default = 0)')
+server.add_option('--max-active', action = 'store', dest = 'max_active', help = 'Set how many requests may be handled, or in async mode wait for a worker thread, at once.  Any more are answered at once with 503 and a Retry-After.  GET /metrics is always answered.\n (0 = no limit, default = 0)')
+
 # Set Defaults
 server.set_defaults(server_port = 65000)
 server.set_defaults(server_log = 'restserver.log')
 server.set_defaults(log_output = 0)
 server.set_defaults(no_ssl = 0)
+server.set_defaults(certfile = 'restcert.pem')
+server.set_defaults(keyfile = None)
+server.set_defaults(ciphers = 'ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:!DSS')
+server.set_defaults(tls_min = '1.2')
+server.set_defaults(tls_tickets = 1)
+server.set_defaults(alpn = 'http/1.1')
 server.set_defaults(dev_status = 0)
+server.set_defaults(server_mode = 'single')
+server.set_defaults(workers = 4)
+server.set_defaults(queue_size = 64)
+server.set_defaults(keepalive_timeout = 15)
+server.set_defaults(rate_limit = 0)
+server.set_defaults(rate_burst = 20)
+server.set_defaults(rate_by = 'ip')
+server.set_defaults(rate_keys = 262144)
+server.set_defaults(max_active = 0)
+server.set_defaults(log_queue = 10000)
+server.set_defaults(log_batch = 256)
+server.set_defaults(log_flush = 1.0)
+server.set_defaults(log_policy = 'block')
+server.set_defaults(log_format = 'text')
+server.set_defaults(log_rotate_size = 0)
+server.set_defaults(log_rotate_time = 0)
+server.set_defaults(log_keep = 5)
+server.set_defaults(clock_resolution = 0.001)
+server.set_defaults(trace_every = 0)
+server.set_defaults(cache_size = 0)
+server.set_defaults(coalesce_timeout = 5)
+server.set_defaults(json_library = 'auto')
+server.set_defaults(keep_types = 0)
+server.set_defaults(max_body = 1048576)
+server.set_defaults(compress_level = 6)
+server.set_defaults(compress_min = 1024)
+server.set_defaults(batch_max = 100)
+server.set_defaults(batch_workers = 4)
+server.set_defaults(pool_size = 8)
+server.set_defaults(pool_idle = 300)
+server.set_defaults(pool_check = 30)
+server.set_defaults(pool_timeout = 5)
+server.set_defaults(metrics = 1)
+server.set_defaults(profile_dir = '.')
+server.set_defaults(profile_seconds = 10)
+server.set_defaults(profile_every = 100)
 
 # Assign values
 opts, args = server.parse_args()
@@ -109,7 +641,112 @@ server_port = int(opts.server_port)
 server_log = opts.server_log
 log_output = int(opts.log_output)
 no_ssl = int(opts.no_ssl)
+certfile = opts.certfile
+keyfile = opts.keyfile
+ciphers = opts.ciphers
+tls_min = opts.tls_min
+tls_tickets = int(opts.tls_tickets)
+alpn = opts.alpn
 dev_status = int(opts.dev_status)
+server_mode = opts.server_mode
+workers = int(opts.workers)
+queue_size = int(opts.queue_size)
+keepalive_timeout = float(opts.keepalive_timeout)
+rate_limit = float(opts.rate_limit)
+rate_burst = float(opts.rate_burst)
+rate_by = opts.rate_by.split(',')
+rate_keys = int(opts.rate_keys)
+max_active = int(opts.max_active)
+log_queue = int(opts.log_queue)
+log_batch = int(opts.log_batch)
+log_flush = float(opts.log_flush)
+log_policy = opts.log_policy
+log_format = opts.log_format
+log_rotate_size = int(opts.log_rotate_size)
+log_rotate_time = float(opts.log_rotate_time)
+log_keep = int(opts.log_keep)
+clock_resolution = float(opts.clock_resolution)
+trace_every = int(opts.trace_every)
+cache_size = int(opts.cache_size)
+coalesce_timeout = float(opts.coalesce_timeout)
+json_library = opts.json_library
+keep_types = int(opts.keep_types)
+max_body = int(opts.max_body)
+compress_level = int(opts.compress_level)
+compress_min = int(opts.compress_min)
+batch_max = int(opts.batch_max)
+batch_workers = int(opts.batch_workers)
+pool_size = int(opts.pool_size)
+pool_idle = float(opts.pool_idle)
+pool_check = float(opts.pool_check)
+pool_timeout = float(opts.pool_timeout)
+metrics_on = int(opts.metrics)
+profile_dir = opts.profile_dir
+profile_seconds = float(opts.profile_seconds)
+profile_every = int(opts.profile_every)
+if opts.max_requests is not None:
+    max_requests = int(opts.max_requests)
+elif server_mode == 'single':
+    max_requests = 1
+else:
+    max_requests = 100
+if opts.handshake_timeout is not None:
+    handshake_timeout = float(opts.handshake_timeout)
+elif server_mode in ('single', 'fork'):
+    handshake_timeout = 2.0
+else:
+    handshake_timeout = 10.0
+
+if tls_min not in ('1.0', '1.1', '1.2', '1.3'):
+    server.error('TLS_MIN must be one of "1.0", "1.1", "1.2" or "1.3".')
+if handshake_timeout <= 0:
+    server.error('HANDSHAKE_TIMEOUT must be positive.')
+if server_mode not in ('single', 'thread', 'fork', 'async'):
+    server.error('SERVER_MODE must be one of "single", "thread", "fork" or "async".')
+if workers < 1:
+    server.error('WORKERS must be at least 1.')
+if queue_size < 1:
+    server.error('QUEUE_SIZE must be at least 1.')
+if max_requests < 1:
+    server.error('MAX_REQUESTS must be at least 1.')
+if rate_limit < 0 or rate_burst < 1 or rate_keys < 1:
+    server.error('RATE_LIMIT must not be negative, and RATE_BURST and RATE_KEYS must be at least 1.')
+if not set(rate_by) <= set(['ip', 'agent']):
+    server.error('RATE_BY must be "ip", "agent" or "ip,agent".')
+if max_active < 0:
+    server.error('MAX_ACTIVE must not be negative.')
+if log_queue < 1 or log_batch < 1:
+    server.error('LOG_QUEUE and LOG_BATCH must be at least 1.')
+if log_policy not in ('block', 'drop'):
+    server.error('LOG_POLICY must be one of "block" or "drop".')
+if log_format not in ('text', 'json', 'binary'):
+    server.error('LOG_FORMAT must be one of "text", "json" or "binary".')
+if log_rotate_size < 0 or log_rotate_time < 0 or log_keep < 0:
+    server.error('LOG_ROTATE_SIZE, LOG_ROTATE_TIME and LOG_KEEP must not be negative.')
+if not 0.000001 <= clock_resolution <= 1:
+    server.error('CLOCK_RESOLUTION must be from 0.000001 to 1.')
+if trace_every < 0:
+    server.error('TRACE_EVERY must not be negative.')
+if coalesce_timeout < 0:
+    server.error('COALESCE_TIMEOUT must not be negative.')
+if cache_size < 0:
+    server.error('CACHE_SIZE must not be negative.')
+if json_library not in ('auto', 'ujson', 'simplejson', 'json'):
+    server.error('JSON_LIBRARY must be one of "auto", "ujson", "simplejson" or "json".')
+if (json_library == 'ujson' and ujson is None) or (json_library == 'simplejson' and simplejson is None):
+    server.error('JSON_LIBRARY %s is not installed.' %(json_library))
+if max_body < 0:
+    server.error('MAX_BODY must not be negative.')
+if not 0 <= compress_level <= 9:
+    server.error('COMPRESS_LEVEL must be from 0 to 9.')
+if pool_size < 1:
+    server.error('POOL_SIZE must be at least 1.')
+if pool_idle <= 0 or pool_check < 0 or pool_timeout < 0:
+    server.error('POOL_IDLE must be positive, and POOL_CHECK and POOL_TIMEOUT must not be negative.')
+if batch_max < 1 or batch_workers < 1:
+    server.error('BATCH_MAX and BATCH_WORKERS must be at least 1.')
+if profile_seconds <= 0 or profile_every < 1:
+    server.error('PROFILE_SECONDS must be positive and PROFILE_EVERY at least 1.')
 
 
 # Redefine the error message template provided by
@@ -158,10 +795,1829 @@ BaseHTTPRequestHandler.responses[404] = ('Not found',
                                          'Requested resource not found.')
 BaseHTTPRequestHandler.responses[405] = ('Request method not valid', 
                                          'Incorrect use of GET/POST/PUT).')
+BaseHTTPRequestHandler.responses[429] = ('Too many requests',
+                                         'Send fewer requests, and retry after the time given.')
 #
 # The 5xx errors are left at their defaults.
 #
 
+# The status lines of the responses sent whole by RESTHandler, which
+# speaks HTTP/1.1, made once rather than for every response.
+STATUS_LINES = dict((code, 'HTTP/1.1 %d %s\r\n' %(code, short))
+                    for code, (short, explain) in BaseHTTPRequestHandler.responses.items())
+
+class Clock:
+    """
+    Format the times written to the log and sent in the Date header
+    once for each tick of RESOLUTION seconds, however many requests
+    ask for them within it.  A log time is the local time, as
+    "2013-10-08 12:34:56.789000", truncated to the tick; the Date
+    header and the time of the stderr lines keep to whole seconds.
+
+    Each tick is kept as one tuple, replaced rather than changed, so
+    threads share the clock without a lock: at worst two of them
+    format the same tick.
+    """
+
+    def __init__(self, resolution):
+        self.tick_us = max(int(round(resolution * 1000000)), 1)
+        self.tick = (None, '')
+        self.second = (None, '', '', '')
+
+    def seconds(self, second):
+        """ Return the local date and time, the HTTP date and the
+        stderr log date of second, formatting them when second is not
+        the one last asked for. """
+        state = self.second
+        if state[0] != second:
+            local = localtime(second)
+            state = (second, strftime('%Y-%m-%d %H:%M:%S', local), formatdate(second, usegmt = True),
+                     '%02d/%s/%04d %s' %(local.tm_mday, BaseHTTPRequestHandler.monthname[local.tm_mon],
+                                         local.tm_year, strftime('%H:%M:%S', local)))
+            self.second = state
+        return state
+
+    def stamp(self):
+        """ Return the time for a log line. """
+        now = int(time() * 1000000) // self.tick_us
+        tick, stamp = self.tick
+        if tick != now:
+            tick_start = now * self.tick_us
+            stamp = '%s.%06d' %(self.seconds(tick_start // 1000000)[1], tick_start % 1000000)
+            self.tick = (now, stamp)
+        return stamp
+
+    def httpDate(self):
+        """ Return the time for the Date header. """
+        return self.seconds(int(time()))[2]
+
+    def logDate(self):
+        """ Return the time for the lines BaseHTTPRequestHandler writes
+        to stderr. """
+        return self.seconds(int(time()))[3]
+
+clock = Clock(clock_resolution)
+
+# The Server and Date headers, which are the same for every response
+# sent within one second, along with the Date they were made with.
+standard_headers = (None, '')
+
+def standardHeaders():
+    """ Return the Server and Date headers, made again only when the
+    clock has moved on to another second. """
+    global standard_headers
+    date = clock.httpDate()
+    made_with, headers = standard_headers
+    if made_with is not date:
+        headers = 'Server: %s %s\r\nDate: %s\r\n' %(BaseHTTPRequestHandler.server_version,
+                                                    BaseHTTPRequestHandler.sys_version, date)
+        standard_headers = (date, headers)
+    return headers
+
+class JSONCodec:
+    """
+    Encode responses as JSON and decode the JSON data of requests with
+    an encoder and a decoder made once, when the server starts, rather
+    than new ones for every request.  LIBRARY is "ujson", "simplejson"
+    or "json", or "auto" for the first of them that is installed.
+
+    Unless KEEP_TYPES is set, every value of a response is turned into
+    a string before it is encoded, as the server has always sent the
+    rows of the database.  With KEEP_TYPES, the values are sent as
+    they are, and any that JSON has no type for, such as a datetime or
+    a Decimal, as its string.
+    """
+
+    def __init__(self, library, keep_types):
+        if library == 'auto':
+            if ujson is not None:
+                library = 'ujson'
+            elif simplejson is not None:
+                library = 'simplejson'
+            else:
+                library = 'json'
+        self.library = library
+        self.keep_types = keep_types
+        self.fallback = JSONEncoder(default = str).encode
+        if library == 'ujson':
+            self.dumps = ujson.dumps
+            self.decode = ujson.loads
+        elif library == 'simplejson':
+            self.dumps = simplejson.JSONEncoder(default = str).encode
+            self.decode = simplejson.JSONDecoder().decode
+        else:
+            self.dumps = self.fallback
+            self.decode = JSONDecoder().decode
+
+    def encodeItem(self, item):
+        """ Return one item of a list result as a JSON string. """
+        if isinstance(item, dict):
+            return self.encode(item)
+        if not self.keep_types:
+            item = str(item)
+        try:
+            return self.dumps(item)
+        except (TypeError, ValueError, OverflowError):
+            return self.fallback(item)
+
+    def encode(self, results):
+        """ Return the dictionary results as a JSON string. """
+        if not self.keep_types:
+            records = {}
+            for k, v in results.iteritems():
+                records[k] = str(v)
+            results = records
+        try:
+            return self.dumps(results)
+        except (TypeError, ValueError, OverflowError):
+            # ujson cannot encode values of other types at all.
+            return self.fallback(results)
+
+
+# Every request and response is decoded and encoded by this one codec.
+codec = JSONCodec(json_library, keep_types)
+
+
+# With LOG_FORMAT "json" or "binary", the log holds one record for
+# each request answered and one for each server event, such as a start
+# or halt, in place of the text lines.
+#
+# A JSON record is one line:
+#
+#   {"ts":1381234567.123456,"method":"GET","path":"/user/1/profile/2",
+#    "client":"10.0.0.1","status":200,"latency":0.000812,"bytes":57}
+#   {"ts":1381234567.123456,"event":"SERVER HALTED"}
+#
+# The strings are the bytes sent by the client, which need not be
+# UTF-8, each read as the character of the same number (Latin-1), so
+# that any request line can be logged and the bytes recovered.
+#
+# A binary record is its length as an unsigned 32-bit integer followed
+# by that many bytes, all numbers in network byte order:
+#
+#   type     1 byte       1 = request, 2 = event
+#   ts       double       seconds since the epoch
+#
+# then for a request:
+#
+#   status   2 bytes
+#   latency  4 bytes      microseconds
+#   bytes    4 bytes      size of the response body
+#   method, client, path  each a 2-byte length and the string
+#
+# or for an event, the rest of the record is its message.
+LOG_REQUEST = 1
+LOG_EVENT = 2
+
+def formatAccess(ts, method, path, client, status, latency, nbytes):
+    """ Build the LOG_FORMAT record of a request answered at ts. """
+    if log_format == 'json':
+        return ('{"ts":%.6f,"method":%s,"path":%s,"client":%s,"status":%d,"latency":%.6f,"bytes":%d}\n'
+                %(ts, encode_basestring_ascii(method.decode('latin-1')),
+                  encode_basestring_ascii(path.decode('latin-1')),
+                  encode_basestring_ascii(client.decode('latin-1')), status, latency, nbytes))
+    method, client, path = method[:0xffff], client[:0xffff], path[:0xffff]
+    record = ''.join((pack('!BdHII', LOG_REQUEST, ts, status,
+                           min(int(latency * 1000000), 0xffffffff), min(nbytes, 0xffffffff)),
+                      pack('!H', len(method)), method,
+                      pack('!H', len(client)), client,
+                      pack('!H', len(path)), path))
+    return pack('!I', len(record)) + record
+
+def formatEvent(message):
+    """ Build the LOG_FORMAT record of a server event. """
+    if log_format == 'json':
+        return '{"ts":%.6f,"event":%s}\n' %(time(), encode_basestring_ascii(message.strip().decode('latin-1')))
+    elif log_format == 'binary':
+        record = pack('!Bd', LOG_EVENT, time()) + message.strip()
+        return pack('!I', len(record)) + record
+    return "\n %s : %s \n\n" %(message, clock.stamp())
+
+def logEvent(message):
+    """ Log a server event, such as a start or halt. """
+    logger.write(formatEvent(message))
+
+
+class LogWriter:
+    """
+    Append records to the log file from a background thread, so that
+    a request only has to add its record to an in-memory queue.  The
+    file is opened once, and the queued records are written out
+    together as soon as LOG_BATCH of them are waiting or LOG_FLUSH
+    seconds have passed.
+
+    At most LOG_QUEUE records are held.  When the queue is full, the
+    request either waits for the writer to make room (LOG_POLICY
+    "block") or its record is discarded (LOG_POLICY "drop"), in which
+    case the number discarded is written to the log in its place.
+    Both go through the condition room: a blocked request waits on it
+    until the writer has emptied the queue, and the count of discarded
+    records is only changed while holding it.
+    close() writes out whatever is still queued and syncs the file to
+    disk.
+
+    The log is rotated by the writer thread, between two writes, once
+    it would grow past LOG_ROTATE_SIZE bytes or has been written to for
+    LOG_ROTATE_TIME seconds: SERVER_LOG becomes SERVER_LOG.1, the older
+    logs move up by one, and the one past LOG_KEEP is removed.  The
+    worker processes of the fork mode all append to the same file, so
+    a writer that finds the file already rotated by another process
+    only opens the new one.
+
+    A write or rotation that fails, as on a full disk, costs the
+    records being written, which are counted as discarded, but not the
+    writer thread: it keeps emptying the queue, so that requests never
+    wait on a queue that nothing empties.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = None
+
+    def start(self):
+        """ Open the log file and start the writer thread. """
+        self.records = deque()
+        self.dropped = 0
+        self.room = Condition()
+        self.wakeup = Event()
+        self.stopping = False
+        self.openLog()
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def openLog(self):
+        """ Open the log file and set when it is next rotated. """
+        self.fd = os_open(self.filename, O_WRONLY | O_APPEND | O_CREAT, 0644)
+        if log_rotate_time:
+            self.rotate_at = time() + log_rotate_time
+        else:
+            self.rotate_at = None
+
+    def rotate(self, incoming):
+        """ Rotate the log if writing incoming more bytes would take it
+        past LOG_ROTATE_SIZE, or if LOG_ROTATE_TIME has passed. """
+        if self.rotate_at is not None and time() >= self.rotate_at:
+            pass
+        elif log_rotate_size and incoming:
+            size = fstat(self.fd).st_size
+            if size == 0 or size + incoming <= log_rotate_size:
+                return
+        else:
+            return
+        try:
+            current = stat(self.filename).st_ino
+        except OSError:
+            current = None
+        if current == fstat(self.fd).st_ino:
+            if log_keep:
+                for n in range(log_keep - 1, 0, -1):
+                    older = '%s.%d' %(self.filename, n)
+                    if exists(older):
+                        rename(older, '%s.%d' %(self.filename, n + 1))
+                rename(self.filename, self.filename + '.1')
+            else:
+                unlink(self.filename)
+        # The new file is opened before the old one is closed, so that
+        # if it cannot be, the writer carries on with the old one and
+        # tries again at the next write.
+        rotated = self.fd
+        self.openLog()
+        close(rotated)
+
+    def afterFork(self):
+        """ Start afresh in a newly forked process.  The copy of the
+        queue inherited from the parent holds records that the parent
+        will write itself, and the parent's writer thread does not
+        exist in the child. """
+        if self.thread is not None:
+            close(self.fd)
+            self.thread = None
+
+    def write(self, record):
+        """ Queue record to be appended to the log. """
+        if self.thread is None:
+            self.start()
+        records = self.records
+        if len(records) >= log_queue:
+            with self.room:
+                if log_policy == 'drop':
+                    if len(records) >= log_queue:
+                        self.dropped += 1
+                        return
+                while len(records) >= log_queue and not self.stopping:
+                    self.wakeup.set()
+                    self.room.wait()
+        records.append(record)
+        if len(records) >= log_batch:
+            self.wakeup.set()
+
+    def run(self):
+        """ Write out the queue whenever woken or every LOG_FLUSH
+        seconds, until close() is called. """
+        while not self.stopping:
+            self.wakeup.wait(log_flush)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """ Write every queued record with a single write(). """
+        records = self.records
+        batch = []
+        while records:
+            batch.append(records.popleft())
+        written = len(batch)
+        with self.room:
+            dropped, self.dropped = self.dropped, 0
+            self.room.notify_all()
+        if dropped:
+            batch.append(formatEvent("LOG RECORDS DROPPED: %s" %(dropped)))
+        data = ''.join(batch)
+        try:
+            if log_rotate_size or log_rotate_time:
+                self.rotate(len(data))
+            while data:
+                data = data[write(self.fd, data):]
+        except OSError:
+            with self.room:
+                self.dropped += dropped + written
+
+    def close(self):
+        """ Write out the queue, sync the file to disk and stop the
+        writer thread. """
+        if self.thread is None:
+            return
+        with self.room:
+            self.stopping = True
+            self.room.notify_all()
+        self.wakeup.set()
+        self.thread.join()
+        fsync(self.fd)
+        close(self.fd)
+        self.thread = None
+
+
+# Every line of the log goes through this one writer.
+logger = LogWriter(server_log)
+
+
+# Responses are compressed once into a raw deflate stream, which is
+# all that gzip and deflate (RFC 1952 and RFC 1950) have in common:
+# either is that stream between a short header and a checksum of the
+# uncompressed body.  So a body compressed for one client, and kept in
+# the ResponseCache, serves the clients of both encodings.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+ZLIB_HEADER = '\x78\x9c'
+
+def deflateBody(body):
+    """ Return body compressed at COMPRESS_LEVEL as a raw deflate
+    stream, along with the checksums the two encodings need. """
+    compressor = compressobj(compress_level, DEFLATED, -15)
+    deflated = compressor.compress(body) + compressor.flush()
+    return deflated, crc32(body) & 0xffffffff, adler32(body) & 0xffffffff, len(body)
+
+def encodeBody(deflated, encoding):
+    """ Return the body compressed by deflateBody() in ENCODING. """
+    stream, crc, adler, length = deflated
+    if encoding == 'gzip':
+        return ''.join((GZIP_HEADER, stream, pack('<II', crc, length & 0xffffffff)))
+    return ''.join((ZLIB_HEADER, stream, pack('>I', adler)))
+
+
+class ResponseCache:
+    """
+    Hold the serialized responses of GET requests, so that asking
+    again for the same agent and object is answered without calling
+    the backend.  A response is keyed by its agent, agent ID, object,
+    object ID and a hash of the request data, and kept for the ttl of
+    its route.  When the entries take up more than CACHE_SIZE bytes,
+    the least recently used are evicted.
+
+    A PUT, POST or DELETE on an agent, agent ID and object invalidates
+    every response cached for them, whatever the object ID, since
+    handlers such as agentCall() do not use it.  Each such group has a
+    generation, counted in one of GENERATIONS slots, that every
+    invalidation moves on; a GET notes it before calling the backend,
+    and its response is not stored if a write has come in meanwhile.
+
+    In fork mode every worker process has its own cache, and a write
+    only invalidates the cache of the process that served it.  The
+    others keep their copy for at most the ttl of the route.
+    """
+
+    # Bytes counted for every entry on top of its body, for the key
+    # and bookkeeping.
+    OVERHEAD = 200
+    GENERATIONS = 1024
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.generations = [0] * self.GENERATIONS
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, group):
+        """ Return the generation of group, to be passed to put(). """
+        return self.generations[hash(group) % self.GENERATIONS]
+
+    def get(self, key):
+        """ Return the (status, body, etag, deflated) cached under key,
+        or None. """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= time():
+                if entry is not None:
+                    self.forget(key, entry)
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[2], entry[3], entry[5], entry[6]
+
+    def put(self, key, group, generation, ttl, code, body, etag, deflated):
+        """ Cache the response to key for ttl seconds, unless group
+        has been written to since generation was read.  deflated is
+        the body as compressed by deflateBody(), or None. """
+        size = len(body) + self.OVERHEAD
+        if deflated is not None:
+            size += len(deflated[0])
+        if size > self.budget:
+            return
+        with self.lock:
+            if self.generations[hash(group) % self.GENERATIONS] != generation:
+                return
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.forget(key, entry)
+            while self.size + size > self.budget:
+                oldest, entry = self.entries.popitem(last = False)
+                self.forget(oldest, entry)
+                self.evictions += 1
+            self.entries[key] = (time() + ttl, group, code, body, size, etag, deflated)
+            self.groups.setdefault(group, set()).add(key)
+            self.size += size
+
+    def invalidate(self, group):
+        """ Drop every response cached for group. """
+        with self.lock:
+            self.generations[hash(group) % self.GENERATIONS] += 1
+            for key in self.groups.pop(group, ()):
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[4]
+                    self.invalidations += 1
+
+    def forget(self, key, entry):
+        """ Account for an entry already taken out of self.entries. """
+        self.size -= entry[4]
+        keys = self.groups.get(entry[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.groups[entry[1]]
+
+    def stats(self):
+        """ Return the counters of the cache as a dictionary. """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self.entries),
+                'bytes': self.size}
+
+
+def entityTag(output):
+    """ Return the ETag of a response body: a hash of the body, so that
+    it changes whenever the body does. """
+    return '"%s"' %(sha1(output).hexdigest()[:20])
+
+
+# The cache of GET responses, if CACHE_SIZE is set.
+if cache_size:
+    cache = ResponseCache(cache_size)
+else:
+    cache = None
+
+
+class Flight:
+    """ One GET calling its backend, which identical GETs that come in
+    meanwhile wait on.  outcome is set when it lands. """
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.landed = Event()
+        self.outcome = None
+
+
+class Coalescer:
+    """
+    Let identical GETs that come in while one of them is calling the
+    backend share its call.  GETs are identical when they have the same
+    agent, agent ID, object, object ID and request data, as for the
+    ResponseCache.  The first leads a Flight and calls the backend; the
+    others join it and wait up to COALESCE_TIMEOUT seconds for it to
+    land with an outcome, which is one of:
+
+    (status, output, etag, deflated): the JSON sent by the leader,
+                                      which each of the others sends too
+    (status,):                        the error sent by the leader,
+                                      which each of the others sends too
+    None:                             nothing that can be shared, such as
+                                      a streamed list, so that each of
+                                      the others calls the backend itself
+
+    A GET whose wait times out calls the backend itself as well.  A
+    PUT, POST or DELETE on an agent, agent ID and object cuts the
+    Flights under way for them loose, so that no GET that comes in
+    after the write waits for a response read before it.
+
+    In fork mode only the GETs served by one worker process are
+    coalesced.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.groups = {}
+        self.flights = 0
+        self.shared = 0
+        self.shared_errors = 0
+        self.released = 0
+        self.timeouts = 0
+
+    def join(self, group, key):
+        """ Return the Flight for key in group, and whether the caller
+        leads it. """
+        with self.lock:
+            flights = self.groups.get(group)
+            if flights is None:
+                flights = self.groups[group] = {}
+            flight = flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = flights[key] = Flight(group, key)
+            self.flights += 1
+            return flight, True
+
+    def wait(self, flight):
+        """ Wait for flight to land and return its outcome, or None if
+        it has not landed in COALESCE_TIMEOUT seconds. """
+        landed = flight.landed.wait(coalesce_timeout)
+        outcome = flight.outcome
+        with self.lock:
+            if not landed:
+                self.timeouts += 1
+            elif outcome is None:
+                self.released += 1
+            else:
+                self.shared += 1
+                if len(outcome) == 1:
+                    self.shared_errors += 1
+        return outcome
+
+    def land(self, flight, outcome):
+        """ End flight with outcome and wake the GETs waiting on it.
+        Only the first landing of a flight counts. """
+        with self.lock:
+            if flight.landed.is_set():
+                return
+            flights = self.groups.get(flight.group)
+            if flights is not None and flights.get(flight.key) is flight:
+                del flights[flight.key]
+                if not flights:
+                    del self.groups[flight.group]
+            flight.outcome = outcome
+            flight.landed.set()
+
+    def invalidate(self, group):
+        """ Let no GET join the Flights under way for group. """
+        with self.lock:
+            self.groups.pop(group, None)
+
+    def stats(self):
+        """ Return the counters of the coalescer. """
+        with self.lock:
+            return {'flights': self.flights, 'shared': self.shared,
+                    'shared_errors': self.shared_errors, 'released': self.released,
+                    'timeouts': self.timeouts}
+
+
+# The coalescer of identical GETs, unless COALESCE_TIMEOUT is 0.
+if coalesce_timeout:
+    coalescer = Coalescer()
+else:
+    coalescer = None
+
+
+def invalidateGroup(group):
+    """ Drop what the ResponseCache holds for group, the agent and
+    object a PUT, POST or DELETE has just changed, and let no GET join
+    the Flights under way for it. """
+    if cache is not None:
+        cache.invalidate(group)
+    if coalescer is not None:
+        coalescer.invalidate(group)
+
+
+class RateLimiter:
+    """
+    A token bucket for each key, such as a client's IP address, that
+    fills at RATE tokens a second up to BURST.  Each request takes a
+    token, and one that finds its bucket empty is refused.
+
+    The buckets are held in arrays of SIZE slots rather than in a
+    dictionary, so that they take a fixed 24 bytes a slot however many
+    clients there are.  A key's bucket is in one of the PROBES slots
+    that follow the slot of its hash.  A bucket that has filled up
+    again is no different from a new one, so its slot is taken over as
+    if it were free: buckets expire on their own, with nothing to sweep
+    them.  When all the slots a key could take hold buckets still in
+    use, the one used longest ago is evicted, which at worst lets its
+    client start again with a full bucket.
+
+    In fork mode every worker process keeps its own buckets.
+    """
+
+    PROBES = 4
+
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.refill = burst / rate
+        self.size = size
+        self.lock = Lock()
+        self.hashes = array('l', [0]) * size
+        self.tokens = array('d', [0.0]) * size
+        self.stamps = array('d', [0.0]) * size
+        self.limited = 0
+        self.evictions = 0
+
+    def take(self, key):
+        """ Take a token from the bucket of key.  Return 0 if there was
+        one, or else the seconds until there will be. """
+        keyhash = hash(key) or 1
+        size = self.size
+        hashes = self.hashes
+        stamps = self.stamps
+        tokens = self.tokens
+        now = time()
+        with self.lock:
+            found = None
+            oldest = None
+            for probe in xrange(self.PROBES):
+                slot = (keyhash + probe) % size
+                if hashes[slot] == keyhash:
+                    found = slot
+                    break
+                if oldest is None or stamps[slot] < stamps[oldest]:
+                    oldest = slot
+            if found is None:
+                if hashes[oldest] and stamps[oldest] + self.refill > now:
+                    self.evictions += 1
+                hashes[oldest] = keyhash
+                tokens[oldest] = self.burst - 1
+                stamps[oldest] = now
+                return 0
+            level = min(self.burst, tokens[found] + (now - stamps[found]) * self.rate)
+            stamps[found] = now
+            if level >= 1:
+                tokens[found] = level - 1
+                return 0
+            tokens[found] = level
+            self.limited += 1
+            return (1 - level) / self.rate
+
+    def stats(self):
+        """ Return the requests refused and the buckets evicted. """
+        with self.lock:
+            return {'limited': self.limited, 'evictions': self.evictions}
+
+
+# The rate limiters of client IP addresses and of agent IDs, each
+# unless RATE_LIMIT is 0 or it is not one of RATE_BY.
+if rate_limit and 'ip' in rate_by:
+    ip_limiter = RateLimiter(rate_limit, rate_burst, rate_keys)
+else:
+    ip_limiter = None
+if rate_limit and 'agent' in rate_by:
+    agent_limiter = RateLimiter(rate_limit, rate_burst, rate_keys)
+else:
+    agent_limiter = None
+
+def retryAfter(seconds):
+    """ Return seconds rounded up to a whole number, for Retry-After. """
+    return int(seconds) + (seconds % 1 > 0)
+
+
+class Admission:
+    """
+    Count the requests under way and refuse any past LIMIT, so that a
+    server that has more work than it can do turns the rest away at
+    once rather than let it wait.  The async mode counts a request from
+    when it is read until its response is handed back to the event
+    loop, and so counts those waiting for a worker thread; the other
+    modes count it while it is handled.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = Lock()
+        self.active = 0
+        self.shed = 0
+
+    def enter(self):
+        """ Count a request in, and return whether it was admitted. """
+        with self.lock:
+            if self.active >= self.limit:
+                self.shed += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        """ Count an admitted request out. """
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        """ Return the requests under way and those refused. """
+        with self.lock:
+            return {'active': self.active, 'shed': self.shed}
+
+
+# The count of requests under way, unless MAX_ACTIVE is 0.
+if max_active:
+    admission = Admission(max_active)
+else:
+    admission = None
+
+
+def labelValue(value):
+    """ Return value as a Prometheus label value, with its backslashes,
+    double quotes and newlines escaped. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The phases of a request timed by RESTHandler.mark(), and the index
+# of each in its list of timings.
+PHASES = ('parse', 'log', 'route', 'read', 'cache', 'coalesce', 'decode',
+          'call', 'encode', 'compress', 'write')
+PHASE_INDEX = dict((phase, index) for index, phase in enumerate(PHASES))
+
+
+class Metrics:
+    """
+    Count how long requests take, by method, route and status, and how
+    long each phase of them takes, by method, route and phase, in
+    histograms with fixed buckets.  render() returns them, along with
+    the counters of the ResponseCache, the Coalescer, the TLS sessions,
+    the ResourcePools, the rate limiters and the Admission, and the
+    failures of each kind, in the Prometheus text format.
+
+    The phases of a request are timed by RESTHandler.mark(), which
+    counts the time since the previous mark as spent in the phase it
+    names:
+
+    parse:    reading and parsing the headers
+    log:      writing the text log and the access record
+    route:    matching the route
+    read:     reading the body
+    cache:    looking up the ResponseCache
+    coalesce: waiting for an identical GET to call the backend
+    decode:   decoding the JSON data
+    call:     calling the handler and its backend
+    encode:   encoding the result as JSON, and making its ETag
+    compress: compressing the body
+    write:    sending the status line, headers and body
+
+    The TLS handshakes are counted apart from the requests, by whether
+    they were completed, failed or timed out, and so is the wait for a
+    connection of each ResourcePool.
+
+    The items of a streamed list are counted as encoded as they are
+    produced.  In async mode the response is sent by the event loop,
+    so "write" only counts the time to buffer it.  In fork mode every
+    worker process counts its own requests, and /metrics shows those
+    of the process that answers it.
+
+    Requests with a method the server does not serve, which it answers
+    with 501, are counted under the method "other", so that a client
+    cannot add a histogram for every word it sends.
+
+    Each thread counts its requests in histograms of its own, which
+    only it changes, so that observe() takes no lock and formats
+    nothing.  The histograms of a request's method, route and status
+    are one flat list of bucket counts, for the whole request and then
+    for each phase in PHASES, and one list of sums.  render() adds up
+    those of every thread.
+    """
+
+    # The methods counted under their own names.
+    METHODS = ('GET', 'PUT', 'POST', 'DELETE')
+
+    # The upper bounds of the buckets, in seconds.
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+               0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.local = local()
+        self.threads = []
+        self.handshakes = {}
+        self.pool_waits = {}
+        self.failures = {}
+
+    def histogram(self):
+        """ Return an empty histogram: the count of each bucket, of the
+        timings past the last bucket, and the sum of the timings. """
+        return [0] * (len(self.BUCKETS) + 1) + [0.0]
+
+    def observe(self, method, route, status, latency, timings):
+        """ Count a request with its latency and the seconds spent in
+        each phase, given as a list in the order of PHASES that holds
+        None for the phases it did not go through. """
+        try:
+            requests = self.local.requests
+        except AttributeError:
+            requests = self.local.requests = {}
+            with self.lock:
+                self.threads.append(requests)
+        if method not in self.METHODS:
+            method = 'other'
+        buckets = self.BUCKETS
+        width = len(buckets) + 1
+        key = (method, route, status)
+        entry = requests.get(key)
+        if entry is None:
+            entry = requests[key] = ([0] * (width * (len(PHASES) + 1)), [0.0] * (len(PHASES) + 1))
+        counts, sums = entry
+        counts[bisect_left(buckets, latency)] += 1
+        sums[0] += latency
+        offset = index = 0
+        for elapsed in timings:
+            offset += width
+            index += 1
+            if elapsed is not None:
+                counts[offset + bisect_left(buckets, elapsed)] += 1
+                sums[index] += elapsed
+
+    def observeHandshake(self, outcome, latency):
+        """ Count a TLS handshake with its outcome, "ok", "failed" or
+        "timeout", and how long it took. """
+        with self.lock:
+            histogram = self.handshakes.get(outcome)
+            if histogram is None:
+                histogram = self.handshakes[outcome] = self.histogram()
+            histogram[bisect_left(self.BUCKETS, latency)] += 1
+            histogram[-1] += latency
+
+    def observePoolWait(self, pool, latency):
+        """ Count how long a backend waited for a connection of a
+        ResourcePool. """
+        with self.lock:
+            histogram = self.pool_waits.get(pool)
+            if histogram is None:
+                histogram = self.pool_waits[pool] = self.histogram()
+            histogram[bisect_left(self.BUCKETS, latency)] += 1
+            histogram[-1] += latency
+
+    def observeFailure(self, route, kind):
+        """ Count a request to route that failed with an exception of
+        kind, as classified by RouteTable.classify(). """
+        with self.lock:
+            self.failures[(route, kind)] = self.failures.get((route, kind), 0) + 1
+
+    def render(self):
+        """ Return the histograms and the cache counters in the
+        Prometheus text format, along with the session counters of the
+        TLS context.  "accept" counts handshakes begun, "accept_good"
+        those completed, and "hits" the sessions resumed. """
+        requests, phases = self.collect()
+        with self.lock:
+            handshakes = [(outcome, list(histogram)) for outcome, histogram in self.handshakes.iteritems()]
+            pool_waits = [(pool, list(histogram)) for pool, histogram in self.pool_waits.iteritems()]
+            failures = sorted(self.failures.items())
+        lines = ['# HELP restserver_request_seconds Time from reading the request line to sending the response.',
+                 '# TYPE restserver_request_seconds histogram']
+        for (method, route, status), histogram in sorted(requests.items()):
+            self.renderHistogram(lines, 'restserver_request_seconds',
+                                 'method="%s",route="%s",status="%s"'
+                                 %(labelValue(method), labelValue(route), labelValue(status)), histogram)
+        lines += ['# HELP restserver_phase_seconds Time spent in each phase of a request.',
+                  '# TYPE restserver_phase_seconds histogram']
+        for (method, route, phase), histogram in sorted(phases.items()):
+            self.renderHistogram(lines, 'restserver_phase_seconds',
+                                 'method="%s",route="%s",phase="%s"'
+                                 %(labelValue(method), labelValue(route), labelValue(phase)), histogram)
+        lines += ['# HELP restserver_failures_total Requests failed with an exception, by route and the kind of exception.',
+                  '# TYPE restserver_failures_total counter']
+        lines += ['restserver_failures_total{route="%s",kind="%s"} %d' %(labelValue(route), labelValue(kind), n)
+                  for (route, kind), n in failures]
+        if tls_context is not None:
+            lines += ['# HELP restserver_tls_handshake_seconds Time from accepting a connection to the end of its TLS handshake.',
+                      '# TYPE restserver_tls_handshake_seconds histogram']
+            for outcome, histogram in sorted(handshakes):
+                self.renderHistogram(lines, 'restserver_tls_handshake_seconds',
+                                     'outcome="%s"' %(labelValue(outcome)), histogram)
+            stats = tls_context.session_stats()
+            for name in ('accept', 'accept_good', 'hits', 'misses', 'timeouts', 'cache_full'):
+                lines += ['# TYPE restserver_tls_%s_total counter' %(name),
+                          'restserver_tls_%s_total %d' %(name, stats[name])]
+            lines += ['# TYPE restserver_tls_sessions gauge',
+                      'restserver_tls_sessions %d' %(stats['number'])]
+        if routes.pools:
+            lines += ['# HELP restserver_pool_wait_seconds Time taken to get a connection from a pool, including any connect and check.',
+                      '# TYPE restserver_pool_wait_seconds histogram']
+            for pool, histogram in sorted(pool_waits):
+                self.renderHistogram(lines, 'restserver_pool_wait_seconds', 'pool="%s"' %(labelValue(pool)), histogram)
+            pools = [(name, pool.stats()) for name, pool in sorted(routes.pools.items())]
+            for name in ('created', 'closed', 'failed_checks', 'timeouts'):
+                lines.append('# TYPE restserver_pool_%s_total counter' %(name))
+                lines += ['restserver_pool_%s_total{pool="%s"} %d' %(name, labelValue(pool), stats[name])
+                          for pool, stats in pools]
+            for name in ('size', 'open', 'idle'):
+                lines.append('# TYPE restserver_pool_%s gauge' %(name))
+                lines += ['restserver_pool_%s{pool="%s"} %d' %(name, labelValue(pool), stats[name])
+                          for pool, stats in pools]
+        limiters = [(by, limiter.stats()) for by, limiter in (('ip', ip_limiter), ('agent', agent_limiter))
+                    if limiter is not None]
+        if limiters:
+            for name in ('limited', 'evictions'):
+                lines.append('# TYPE restserver_rate_%s_total counter' %(name))
+                lines += ['restserver_rate_%s_total{by="%s"} %d' %(name, labelValue(by), stats[name])
+                          for by, stats in limiters]
+        if admission is not None:
+            stats = admission.stats()
+            lines += ['# TYPE restserver_shed_total counter',
+                      'restserver_shed_total %d' %(stats['shed']),
+                      '# TYPE restserver_active_requests gauge',
+                      'restserver_active_requests %d' %(stats['active'])]
+        if coalescer is not None:
+            stats = coalescer.stats()
+            for name in ('flights', 'shared', 'shared_errors', 'released', 'timeouts'):
+                lines += ['# TYPE restserver_coalesce_%s_total counter' %(name),
+                          'restserver_coalesce_%s_total %d' %(name, stats[name])]
+        if cache is not None:
+            stats = cache.stats()
+            for name in ('hits', 'misses', 'evictions', 'invalidations'):
+                lines += ['# TYPE restserver_cache_%s_total counter' %(name),
+                          'restserver_cache_%s_total %d' %(name, stats[name])]
+            for name in ('entries', 'bytes'):
+                lines += ['# TYPE restserver_cache_%s gauge' %(name),
+                          'restserver_cache_%s %d' %(name, stats[name])]
+        return '\n'.join(lines) + '\n'
+
+    def collect(self):
+        """ Add up the histograms of every thread, and return those of
+        the requests, by method, route and status, and those of the
+        phases, by method, route and phase. """
+        width = len(self.BUCKETS) + 1
+        requests = {}
+        phases = {}
+        with self.lock:
+            threads = list(self.threads)
+        for counted in threads:
+            # items() copies the dictionary at once, so that a thread
+            # may count a new request meanwhile.
+            for (method, route, status), (counts, sums) in counted.items():
+                counts = list(counts)
+                sums = list(sums)
+                for index in range(len(PHASES) + 1):
+                    histogram = counts[index * width:(index + 1) * width]
+                    if not any(histogram):
+                        continue
+                    if index == 0:
+                        key = (method, route, status)
+                        merged = requests
+                    else:
+                        key = (method, route, PHASES[index - 1])
+                        merged = phases
+                    total = merged.get(key)
+                    if total is None:
+                        merged[key] = histogram + [sums[index]]
+                    else:
+                        for bucket, n in enumerate(histogram):
+                            total[bucket] += n
+                        total[-1] += sums[index]
+        return requests, phases
+
+    def renderHistogram(self, lines, name, labels, histogram):
+        """ Add the lines of one histogram, whose buckets count the
+        timings up to each bound, to lines. """
+        count = 0
+        for bound, n in zip(self.BUCKETS, histogram):
+            count += n
+            lines.append('%s_bucket{%s,le="%s"} %d' %(name, labels, bound, count))
+        count += histogram[-2]
+        lines.append('%s_bucket{%s,le="+Inf"} %d' %(name, labels, count))
+        lines.append('%s_sum{%s} %.6f' %(name, labels, histogram[-1]))
+        lines.append('%s_count{%s} %d' %(name, labels, count))
+
+
+# The request and phase timings, unless METRICS is switched off.
+if metrics_on:
+    metrics = Metrics()
+else:
+    metrics = None
+
+
+def isMetricsRequest(method, path):
+    """ Return whether a request asks for the Metrics, which are served
+    ahead of any rate limit or MAX_ACTIVE, so that an overloaded
+    server can still be watched. """
+    return metrics is not None and method == 'GET' and path.split('?', 1)[0] == '/metrics'
+
+
+class Profiler:
+    """
+    Profile the running server when asked to by a signal, and write the
+    profiles to PROFILE_DIR, named after the process and the time.
+    Until then, nothing is profiled, and a request only checks whether
+    it should be.
+
+    startSampling(), on SIGUSR1, starts a thread that takes the stack
+    of every other thread every INTERVAL seconds for PROFILE_SECONDS
+    seconds.  The stacks are then written to restserver-PID-TIME.folded
+    as collapsed stacks, one "outer;...;inner count" line for each, as
+    flamegraph.pl takes them.  Threads waiting for a request or for
+    the log are sampled too, which shows how busy the workers are.
+
+    toggle(), on SIGUSR2, switches on the profiling of one request in
+    every PROFILE_EVERY with cProfile, from its parsing to its
+    response, or switches it off again.  The profiles are added up,
+    and written to restserver-PID-TIME.pstats when it is switched off
+    or the server halts.
+
+    A signal handler runs on the main thread in between any two of its
+    bytecodes, which may be in the middle of add() or of logging, so
+    neither startSampling() nor toggle() takes a lock or logs.  The
+    sampling thread logs for itself, and the next request parsed after
+    a toggle() calls settle() to log it and write out the statistics.
+    """
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sampler = None
+        self.profiling = False
+        self.switched = False
+        self.requests = 0
+        self.stats = None
+
+    def filename(self, extension):
+        """ Return the path of a new profile of this process. """
+        return join(profile_dir, 'restserver-%d-%d.%s' %(getpid(), time(), extension))
+
+    def startSampling(self):
+        """ Sample the stacks for PROFILE_SECONDS, unless a sampling
+        is already running. """
+        if self.sampler is not None and self.sampler.is_alive():
+            return
+        self.sampler = Thread(target = self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def sample(self):
+        """ Count the stacks of the other threads, by their code
+        objects, and write them out as collapsed stacks. """
+        logEvent("PROFILE SAMPLING STARTED FOR %s SECONDS" %(profile_seconds))
+        counts = {}
+        own = current_thread().ident
+        end = time() + profile_seconds
+        while time() < end:
+            for ident, frame in _current_frames().iteritems():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack = tuple(stack)
+                counts[stack] = counts.get(stack, 0) + 1
+            sleep(self.INTERVAL)
+        names = {}
+        lines = []
+        for stack, count in counts.iteritems():
+            for code in stack:
+                if code not in names:
+                    names[code] = '%s (%s:%d)' %(code.co_name, basename(code.co_filename), code.co_firstlineno)
+            lines.append('%s %d\n' %(';'.join([names[code] for code in reversed(stack)]), count))
+        filename = self.filename('folded')
+        with open(filename, 'w') as output:
+            output.writelines(sorted(lines))
+        logEvent("PROFILE SAMPLES WRITTEN TO %s" %(filename))
+
+    def toggle(self):
+        """ Switch the profiling of requests on or off, and leave the
+        rest to settle(). """
+        self.profiling = not self.profiling
+        self.switched = True
+
+    def settle(self):
+        """ Log that the profiling was switched on, or write out the
+        statistics if it was switched off, once after each toggle(). """
+        with self.lock:
+            if not self.switched:
+                return
+            self.switched = False
+        if self.profiling:
+            logEvent("PROFILING ONE IN EVERY %s REQUESTS" %(profile_every))
+        else:
+            self.writeStats()
+
+    def due(self):
+        """ Return whether the request being parsed is to be profiled. """
+        self.requests += 1
+        return self.requests % profile_every == 0
+
+    def add(self, profile):
+        """ Add the profile of a request to the statistics. """
+        with self.lock:
+            if self.stats is None:
+                self.stats = Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def writeStats(self):
+        """ Write out and forget the statistics of the requests
+        profiled, if there are any. """
+        with self.lock:
+            stats, self.stats = self.stats, None
+        if stats is not None:
+            filename = self.filename('pstats')
+            stats.dump_stats(filename)
+            logEvent("PROFILE STATISTICS WRITTEN TO %s" %(filename))
+
+
+# The profiler switched on by SIGUSR1 and SIGUSR2.
+profiler = Profiler()
+
+
+# The ssl module of Python 2.7 does not export OP_NO_TICKET.
+OP_NO_TICKET = 0x00004000
+
+# The protocol versions older than each TLS_MIN, which are switched off.
+TLS_OLDER = {'1.0': 0,
+             '1.1': OP_NO_TLSv1,
+             '1.2': OP_NO_TLSv1 | OP_NO_TLSv1_1,
+             '1.3': OP_NO_TLSv1 | OP_NO_TLSv1_1 | OP_NO_TLSv1_2}
+
+def makeTLSContext():
+    """
+    Return the SSLContext that every connection is wrapped with, set up
+    from the TLS options.  Its certificate is loaded by main().
+
+    OpenSSL keeps the sessions of the context in a cache, so a client
+    that comes back with the ID of an earlier session, or with a
+    session ticket, resumes it without a full handshake.  In fork
+    mode the workers share the keys of the tickets, which are made
+    along with the context, before the fork, but each worker has a
+    session cache of its own.
+    """
+    context = SSLContext(PROTOCOL_SSLv23)
+    context.options |= OP_NO_SSLv2 | OP_NO_SSLv3 | TLS_OLDER[tls_min] | OP_CIPHER_SERVER_PREFERENCE
+    if not tls_tickets:
+        context.options |= OP_NO_TICKET
+    context.set_ciphers(ciphers)
+    if alpn and HAS_ALPN:
+        context.set_alpn_protocols(alpn.split(','))
+    return context
+
+
+# The TLS context of the server, unless SSL is switched off.
+if no_ssl == 0:
+    try:
+        tls_context = makeTLSContext()
+    except SSLError as error:
+        server.error('CIPHERS %s cannot be used: %s' %(ciphers, error))
+else:
+    tls_context = None
+
+
+def stepHandshake(sock):
+    """ Take the TLS handshake of sock, which must not block, as far as
+    the client has sent it.  Return 0 if it is complete, POLLIN or
+    POLLOUT if it waits for the client, or None if it failed. """
+    try:
+        sock.do_handshake()
+        return 0
+    except SSLError as error:
+        if error.args[0] == SSL_ERROR_WANT_READ:
+            return POLLIN
+        elif error.args[0] == SSL_ERROR_WANT_WRITE:
+            return POLLOUT
+        return None
+    except socket_error:
+        return None
+
+
+def completeHandshake(sock):
+    """
+    Complete the TLS handshake of an accepted connection, wrapped with
+    do_handshake_on_connect off, and return whether it succeeded.  The
+    client is given HANDSHAKE_TIMEOUT seconds for the whole handshake,
+    however slowly it sends it, after which the handshake counts as
+    timed out.  The outcome and duration are counted in the Metrics.
+
+    This blocks the calling thread for as long as the client takes, so
+    it is only used in single and fork mode, where a client that
+    stalls its handshake holds up its process for HANDSHAKE_TIMEOUT.
+    The thread mode drives handshakes in PooledHTTPServer's handshake
+    thread instead, and the async mode in its event loop.
+    """
+    start = time()
+    deadline = start + handshake_timeout
+    outcome = 'failed'
+    sock.settimeout(0.0)
+    try:
+        while True:
+            events = stepHandshake(sock)
+            if events == 0:
+                outcome = 'ok'
+                return True
+            elif events is None:
+                return False
+            remaining = deadline - time()
+            if remaining <= 0:
+                outcome = 'timeout'
+                return False
+            waiter = poll()
+            waiter.register(sock, events)
+            try:
+                if not waiter.poll(remaining * 1000):
+                    outcome = 'timeout'
+                    return False
+            except select_error as error:
+                if error.args[0] != EINTR:
+                    return False
+    except socket_error:
+        return False
+    finally:
+        sock.settimeout(None)
+        if metrics is not None:
+            metrics.observeHandshake(outcome, time() - start)
+
+
+# The ID segments of a URI can be given a type when a route is
+# registered.  A type is any callable that takes the segment as a
+# string and either returns the value handed to the handler or raises
+# ValueError, in which case the URI does not match and a 404 is sent.
+# str, which accepts any ID, is the default.
+def digits(segment):
+    """ An ID made up only of digits.  Unlike int, this keeps leading
+    zeros, so that "00123" reaches the backend as "00123". """
+    if not segment.isdigit():
+        raise ValueError('Not a numeric ID: %r' %(segment))
+    return segment
+
+
+class PoolTimeout(Exception):
+    """ No pooled connection became free within POOL_TIMEOUT seconds. """
+
+
+class ResourcePool:
+    """
+    A bounded pool of connections to a database or other service,
+    shared by the backends of the routes that name it.  A backend of
+    such a route is called with a connection from the pool as its first
+    argument, ahead of its usual ones, and the connection goes back to
+    the pool once the backend has returned, or, if it returns a
+    generator, once the generator is done.
+
+    connect() opens a new connection, which must have a close() method.
+    check(connection), if given, returns whether the connection is
+    still usable, and is run before a connection that has not been
+    used for POOL_CHECK seconds is used again, and after a backend
+    fails with it.  A connection that fails its check, or that has not
+    been used for POOL_IDLE seconds, is closed.  Both are set by
+    RouteTable.bind(), and replaced when the backends are reloaded, at
+    which point the connections made by the old connect() are closed
+    as they come back.
+
+    At most SIZE connections, or POOL_SIZE, are open at once.  A call
+    finding them all in use waits up to POOL_TIMEOUT seconds for one,
+    after which PoolTimeout is raised and the request is answered with
+    503.  A thread is given back the connection it used last, if it is
+    free, so that each worker tends to keep to one connection.  In fork
+    mode every worker process opens connections of its own.
+    """
+
+    def __init__(self, name, size = None):
+        self.name = name
+        self.size = size or pool_size
+        self.connect = None
+        self.check = None
+        self.cond = Condition(Lock())
+        self.pid = None
+        self.generation = 0
+        # The free connections, most recently used last, each as
+        # [connection, time of release, thread that used it, generation].
+        self.idle = []
+        self.open = 0
+        self.created = 0
+        self.closed = 0
+        self.failed_checks = 0
+        self.timeouts = 0
+
+    def bind(self, connect, check = None):
+        """ Make new connections with connect and check them with
+        check, and close those made by the functions bound before. """
+        with self.cond:
+            self.connect = connect
+            self.check = check
+            self.generation += 1
+            stale, self.idle = self.idle, []
+            self.open -= len(stale)
+            self.cond.notify_all()
+        for entry in stale:
+            self.close(entry[0])
+
+    def call(self, function, *args):
+        """ Call function with a pooled connection and args, and give
+        the connection back when it is done with. """
+        connection, generation = self.acquire()
+        try:
+            result = function(connection, *args)
+        except Exception:
+            self.release(connection, generation, failed = True)
+            raise
+        if isinstance(result, GeneratorType):
+            return PooledItems(self, connection, generation, result)
+        self.release(connection, generation)
+        return result
+
+    def acquire(self):
+        """ Return a free connection and its generation, opening a
+        new one if there is none and fewer than SIZE are open. """
+        start = time()
+        deadline = start + pool_timeout
+        thread = current_thread().ident
+        while True:
+            entry = None
+            with self.cond:
+                if self.pid != getpid():
+                    # The connections of the parent process are not
+                    # used in a forked worker.
+                    self.pid = getpid()
+                    self.idle = []
+                    self.open = 0
+                while not self.idle and self.open >= self.size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout('No connection of pool %s became free in %s seconds.'
+                                          %(self.name, pool_timeout))
+                    self.cond.wait(remaining)
+                if self.idle:
+                    entry = self.takeIdle(thread)
+                else:
+                    self.open += 1
+                connect, check, generation = self.connect, self.check, self.generation
+            if entry is None:
+                try:
+                    connection = connect()
+                except Exception:
+                    self.discard(None)
+                    raise
+                with self.cond:
+                    self.created += 1
+                break
+            connection = entry[0]
+            unused = time() - entry[1]
+            if unused < pool_idle and (check is None or unused < pool_check or self.healthy(connection)):
+                break
+            self.discard(connection)
+        if metrics is not None:
+            metrics.observePoolWait(self.name, time() - start)
+        return connection, generation
+
+    def takeIdle(self, thread):
+        """ Take the free connection last used by thread, or else the
+        one used most recently.  Called with the lock held. """
+        idle = self.idle
+        for i in range(len(idle) - 1, -1, -1):
+            if idle[i][2] == thread:
+                return idle.pop(i)
+        return idle.pop()
+
+    def release(self, connection, generation, failed = False):
+        """ Give a connection back to the pool, unless it was made by
+        connect() before a reload or, having failed, fails its check.
+        Connections unused for POOL_IDLE seconds are closed. """
+        if self.pid != getpid():
+            return
+        if generation != self.generation or (failed and not self.healthy(connection)):
+            self.discard(connection)
+            return
+        now = time()
+        with self.cond:
+            self.idle.append([connection, now, current_thread().ident, generation])
+            expired = 0
+            while self.idle[expired][1] < now - pool_idle:
+                expired += 1
+            stale = self.idle[:expired]
+            del self.idle[:expired]
+            self.open -= expired
+            self.cond.notify()
+        for entry in stale:
+            self.close(entry[0])
+
+    def healthy(self, connection):
+        """ Return whether connection passes the check. """
+        try:
+            if self.check is None or self.check(connection) is not False:
+                return True
+        except Exception:
+            pass
+        with self.cond:
+            self.failed_checks += 1
+        return False
+
+    def discard(self, connection):
+        """ Close a connection that is not going back to the pool, and
+        make room for another. """
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+        if connection is not None:
+            self.close(connection)
+
+    def close(self, connection):
+        with self.cond:
+            self.closed += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """ Return the counters of the pool. """
+        with self.cond:
+            return {'size': self.size, 'open': self.open, 'idle': len(self.idle),
+                    'created': self.created, 'closed': self.closed,
+                    'failed_checks': self.failed_checks, 'timeouts': self.timeouts}
+
+
+class PooledItems:
+    """
+    The items of a generator returned by a pooled backend, which keep
+    its connection out of the pool until they have all been taken, the
+    generator has failed, or they are dropped unfinished.
+    """
+
+    def __init__(self, pool, connection, generation, items):
+        self.pool = pool
+        self.connection = connection
+        self.generation = generation
+        self.items = items
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            self.release(False)
+            raise
+        except Exception:
+            self.release(True)
+            raise
+
+    def release(self, failed):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            # A generator dropped unfinished is closed first, so that it
+            # is done with the connection before another thread has it.
+            self.items.close()
+            self.pool.release(connection, self.generation, failed)
+
+    def __del__(self):
+        self.release(True)
+
+
+class Route:
+    """
+    The handler registered for one method, agent and object, along
+    with the types of its IDs and the status codes it answers with:
+
+    backend: If set, the "module.function" passed to the handler as
+             its first argument.
+    success: The status sent with the handler's result.  With 204, the
+             result is not sent.
+    failure: The status sent when the handler raises an exception,
+             unless the exception's class is registered with a status
+             by RouteTable.addFailure().
+    empty:   If set, the status sent when the handler returns no data.
+    ttl:     If set on a GET route, the seconds for which its
+             responses are kept in the ResponseCache.
+    label:   The route as named in the Metrics, "/uriAgent/<ID>/uriObject/<ID>".
+    pool:    If set, the name of the ResourcePool whose connection is
+             passed to the backend ahead of its other arguments.
+
+    call is what the dispatcher calls with the agent ID, object ID and
+    JSON data: the handler itself, or, once RouteTable.bind() has
+    loaded the backend, the handler with the backend bound to it.
+    """
+
+    def __init__(self, uriAgent, uriObject, handler, backend, agentType, objectType,
+                 success, failure, empty, ttl, pool):
+        self.uriAgent = uriAgent
+        self.uriObject = uriObject
+        self.handler = handler
+        self.backend = backend
+        self.call = handler if backend is None else None
+        self.agentType = agentType
+        self.objectType = objectType
+        self.success = success
+        self.failure = failure
+        self.empty = empty
+        self.ttl = ttl
+        self.label = '/%s/<ID>/%s/<ID>' %(uriAgent, uriObject)
+        self.pool = pool
+
+
+class RouteTable:
+    """
+    This server is developed for a REST API call like the following:
+
+    METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
+
+    Effectively, each call is a sentence where the method is the verb,
+    the agent is the subject, and the object is the recipient of the
+    action.  So, for example, a user retrieving a contact could be:
+
+    GET http://www.restserver.tld/user/00123/contact/012345609
+
+    and a user creating a contact could be:
+
+    POST http://www.restserver.tld/user/00123/contact/0
+
+    The zeroed out contact ID is because the contact does not have an
+    identifier yet.  In the present server, we use IDs for both agent
+    and object in order to allow us to use caches.
+
+    The table maps each (method, agent, object) to the Route that
+    handles it.  Routes are registered once, when the module is
+    loaded, either with add() or with the route() decorator.  A request
+    is then matched with a single dictionary lookup, so finding its
+    handler costs the same however many routes there are.
+
+    The backend modules named by the routes are imported by bind(),
+    which main() calls before the server starts.  A missing module or
+    function stops the server at once rather than showing up as an
+    error on the first request that needs it.  The same goes for the
+    connect and check functions of the ResourcePools registered with
+    addPool(), which the routes name with their pool option, and of
+    the exception classes registered with addFailure().
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.pools = {}
+        self.pool_functions = {}
+        self.failures = {}
+        self.failure_types = {}
+
+    def add(self, method, uriAgent, uriObject, handler, backend = None, agentType = str,
+            objectType = str, success = 200, failure = 403, empty = None, ttl = None,
+            pool = None):
+        """ Register handler for METHOD /uriAgent/<ID>/uriObject/<ID>. """
+        key = (method, uriAgent, uriObject)
+        if key in self.routes:
+            raise ValueError('A route for %s /%s/<ID>/%s/<ID> is already registered.' % key)
+        if pool is not None and backend is None:
+            raise ValueError('The route for %s /%s/<ID>/%s/<ID> has a pool but no backend.' % key)
+        self.routes[key] = Route(uriAgent, uriObject, handler, backend, agentType, objectType,
+                                 success, failure, empty, ttl, pool)
+
+    def addPool(self, name, connect, check = None, size = None):
+        """ Register a ResourcePool whose connections are opened by
+        connect and checked by check, each given as "module.function",
+        and of which at most size, or POOL_SIZE, are open at once. """
+        if name in self.pools:
+            raise ValueError('A pool named %s is already registered.' %(name))
+        self.pools[name] = ResourcePool(name, size)
+        self.pool_functions[name] = (connect, check)
+
+    def addFailure(self, exception, kind, status = None):
+        """ Classify the exceptions of class exception, given as a class
+        or as "module.Class", as kind, and answer them with status, or
+        with the failure status of the route if status is None. """
+        self.failures[exception] = (kind, status)
+        self.failure_types = dict((key, value) for key, value in self.failures.items()
+                                  if not isinstance(key, basestring))
+
+    def classify(self, error):
+        """ Return the kind of error and the status to answer it with,
+        or None for the failure status of the route, as registered for
+        the most specific of its classes.  Nothing is formatted: the
+        answer for each class is worked out once and kept. """
+        types = self.failure_types
+        known = types.get(type(error))
+        if known is None:
+            known = ('error', None)
+            for cls in type(error).__mro__:
+                if cls in types:
+                    known = types[cls]
+                    break
+            types[type(error)] = known
+        return known
+
+    def bind(self, reloading = False):
+        """ Import the backend of every route and bind it to the route's
+        handler.  With reloading, modules that are already loaded are
+        reloaded from their source.  If any backend cannot be loaded,
+        ImportError is raised naming each of them, and the routes keep
+        the backends they had. """
+        modules = {}
+        calls = {}
+        pools = {}
+        failure_types = {}
+        missing = []
+
+        def load(name):
+            modulename, sep, function = name.rpartition('.')
+            if modulename not in modules:
+                module = import_module(modulename)
+                if reloading:
+                    module = reload(module)
+                modules[modulename] = module
+            return getattr(modules[modulename], function)
+
+        for name, (connect, check) in sorted(self.pool_functions.items()):
+            try:
+                pools[name] = (load(connect), check and load(check))
+            except Exception as error:
+                missing.append('pool %s needs %s: %s' %(name, connect if check is None else connect + ' and ' + check, error))
+        for key, route in sorted(self.routes.items()):
+            if route.backend is None:
+                continue
+            try:
+                backend = load(route.backend)
+                if route.pool is not None:
+                    backend = partial(self.pools[route.pool].call, backend)
+                calls[key] = partial(route.handler, backend)
+            except Exception as error:
+                missing.append('%s /%s/<ID>/%s/<ID> needs %s: %s' % (key + (route.backend, error)))
+        for exception, known in self.failures.items():
+            try:
+                failure_types[load(exception) if isinstance(exception, basestring) else exception] = known
+            except Exception as error:
+                missing.append('failure %s: %s' %(exception, error))
+        if missing:
+            raise ImportError('Cannot load the backends of these routes:\n  ' + '\n  '.join(missing))
+        for name, (connect, check) in pools.items():
+            self.pools[name].bind(connect, check)
+        for key, call in calls.items():
+            self.routes[key].call = call
+        self.failure_types = failure_types
+
+    def route(self, method, uriAgent, uriObject, **options):
+        """ A decorator that registers the decorated function with
+        add().  The keyword options are those of add(). """
+        def register(handler):
+            self.add(method, uriAgent, uriObject, handler, **options)
+            return handler
+        return register
+
+    def match(self, method, path):
+        """ Return the route for method and path along with the typed
+        agent and object IDs, or None if nothing matches. """
+        uriParts = path.split('/', 5)
+        if len(uriParts) < 5:
+            return None
+        route = self.routes.get((method, uriParts[1], uriParts[3]))
+        if route is None:
+            return None
+        try:
+            return route, route.agentType(uriParts[2]), route.objectType(uriParts[4])
+        except ValueError:
+            return None
+
+
+routes = RouteTable()
+route = routes.route
+
+
+# Here we presume on the above example of an agent 'user' and a series
+# of objects on which that user can operate: profile, contact, and
+# sessionID.  Obviously, the details will depend on the API being
+# implemented.
+#
+# Each route names its backend as "module.function".  The backends
+# are imported once, by bind() at startup, and each handler is then
+# called with its backend function already in hand, followed by the
+# agent ID and object ID from the URI and the decoded JSON data of the
+# request.  It returns the dictionary to be sent back to the client.
+#
+# Backends that need a database connection can share a ResourcePool
+# rather than each open their own.  The pool is registered with the
+# functions that open and check a connection, and each route that
+# names it has its backend called with a connection first:
+#
+#   routes.addPool('userdb', connect = 'userdb.connect', check = 'userdb.ping')
+#   routes.add('GET', 'user', 'profile', agentCall, backend = 'get_user.get_user_profile',
+#              agentType = digits, pool = 'userdb')
+#
+# where get_user_profile(connection, agentID, data) uses the
+# connection only until it returns, or, if it returns a generator,
+# until the generator is done.
+def agentCall(backend, agentID, objectID, jsondata):
+    """ Call a backend that takes the agent ID and the request data. """
+    return backend(agentID, jsondata)
+
+def objectCall(backend, agentID, objectID, jsondata):
+    """ Call a backend that takes only the object ID. """
+    return backend(objectID)
+
+routes.add('GET', 'user', 'profile', agentCall, backend = 'get_user.get_user_profile',
+           agentType = digits, ttl = 30)
+routes.add('GET', 'user', 'contact', agentCall, backend = 'get_user.get_user_contact',
+           agentType = digits, objectType = digits, empty = 400, ttl = 30)
+routes.add('GET', 'user', 'sessionID', objectCall, backend = 'sessions.get_user_sessionID',
+           agentType = digits)
+
+routes.add('PUT', 'user', 'profile', agentCall, backend = 'put_user.put_user_profile',
+           agentType = digits, success = 204)
+routes.add('PUT', 'user', 'contact', agentCall, backend = 'put_user.put_user_contact',
+           agentType = digits, objectType = digits, success = 204)
+routes.add('PUT', 'user', 'sessionID', objectCall, backend = 'sessions.put_user_sessionID',
+           agentType = digits, success = 204)
+
+routes.add('POST', 'user', 'profile', agentCall, backend = 'post_user.post_user_profile',
+           agentType = digits, success = 201, failure = 401)
+routes.add('POST', 'user', 'contact', agentCall, backend = 'post_user.post_user_contact',
+           agentType = digits, objectType = digits, success = 201, failure = 401, empty = 403)
+routes.add('POST', 'user', 'sessionID', objectCall, backend = 'sessions.post_user_sessionID',
+           agentType = digits, success = 201, failure = 401)
+
+routes.add('DELETE', 'user', 'profile', agentCall, backend = 'delete_user.delete_user_profile',
+           agentType = digits, success = 204)
+routes.add('DELETE', 'user', 'contact', agentCall, backend = 'delete_user.delete_user_contact',
+           agentType = digits, objectType = digits, success = 204)
+routes.add('DELETE', 'user', 'sessionID', objectCall, backend = 'sessions.delete_user_sessionID',
+           agentType = digits, success = 204)
+
+
+class RequestTooLarge(Exception):
+    """ The body of a request is longer than MAX_BODY. """
+
+
+# A failed request is classified by the class of its exception, the
+# most specific one registered winning, rather than by the text of its
+# traceback.  The kinds are counted in the Metrics, and a class
+# registered with a status is answered with it whatever the route.
+# Backends can register their own, named as "module.Class" and loaded
+# by bind() along with the backends:
+#
+#   routes.addFailure('userdb.AccessDenied', 'auth', 401)
+#   routes.addFailure('userdb.BadRecord', 'validation', 400)
+#
+routes.addFailure(KeyError, 'missing field')
+routes.addFailure(IndexError, 'no data')
+routes.addFailure(ValueError, 'validation')
+routes.addFailure(TypeError, 'validation')
+routes.addFailure(RequestTooLarge, 'too large', 413)
+routes.addFailure(PoolTimeout, 'unavailable', 503)
+
+# Counts the failures logged, so that one in TRACE_EVERY is logged with
+# its traceback.
+failure_count = count(1)
+
+def describeFailure(kind, error):
+    """ Return the message logged for error, of kind. """
+    if kind == 'missing field' and isinstance(error, KeyError) and error.args:
+        return "The following field are missing: %s" %(error.args[0])
+    if kind == 'no data':
+        return "No matching data"
+    message = str(error)
+    if message:
+        return '%s: %s' %(type(error).__name__, message)
+    return type(error).__name__
+
+
+# The threads that run the operations of concurrent batches.  They are
+# started on first use, so that each worker process of the fork mode
+# starts its own.
+batch_pool = None
+batch_pool_lock = Lock()
+
+def batchPool():
+    """ Return the thread pool for concurrent batches. """
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            batch_pool = ThreadPool(batch_workers)
+    return batch_pool
+
+
 class RESTHandler(BaseHTTPRequestHandler):
     """
     In this class, one can implement any method that begins with do_*.
@@ -170,6 +2626,237 @@ class RESTHandler(BaseHTTPRequestHandler):
     by default.  
     """
 
+    # Speak HTTP/1.1 so that clients can keep their connection, and
+    # with it any SSL session, open between requests.  A connection is
+    # closed once it has been idle for KEEPALIVE_TIMEOUT seconds or has
+    # served MAX_REQUESTS requests.  As the connection holds its worker
+    # while it is idle, it is also closed as soon as another client is
+    # waiting for one (see waitForRequest()).  Pipelined requests are
+    # read one after another from the buffered rfile and so are
+    # answered in order.
+    #
+    # For this to work, every response must end exactly where the
+    # client expects it to: with a Content-Length, in chunks ending
+    # with an empty one, or with no body at all for 204.  Likewise,
+    # the body of each request must be read in full before the next
+    # request line.  If a response is sent without the body having
+    # been read, the connection is closed.
+    protocol_version = 'HTTP/1.1'
+    timeout = keepalive_timeout
+    requests_served = 0
+
+    # Buffer each response and send it when the request is done, so
+    # that a kept-open connection does not leave small header writes
+    # waiting on the client's delayed ACK.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    # A response made in one piece by sendWhole() is sent straight to
+    # the socket instead, in a single call.
+    direct_write = True
+
+    # List results are encoded and sent in chunks of about this many
+    # bytes.
+    stream_chunk_size = 16384
+
+    # How often, in seconds, an idle connection checks whether other
+    # clients are waiting for a worker.
+    idle_check = 0.1
+
+    # Whether the handler admits its request itself, by the RATE_LIMIT
+    # of its client's IP address and against MAX_ACTIVE.  The async
+    # mode admits requests in the event loop instead, before they wait
+    # for a worker thread.
+    admit = True
+
+    def handle(self):
+        """ Handle the requests of the connection one after another
+        until it is to be closed, waiting for each after the first with
+        waitForRequest(). """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.waitForRequest():
+            self.handle_one_request()
+
+    def waitForRequest(self):
+        """ Wait for the next request on a kept-open connection, and
+        return whether it came.  The connection is given up, and False
+        returned, when it has been idle for KEEPALIVE_TIMEOUT seconds,
+        or as soon as the server has other clients waiting for a
+        worker, so that idle connections cannot hold every worker.
+        Any response still buffered is sent first: BaseHTTPRequestHandler
+        does not flush the 501 it sends for an unknown method. """
+        self.wfile.flush()
+        buffered = self.rfile._rbuf
+        buffered.seek(0, 2)
+        if buffered.tell():
+            return True
+        pending = getattr(self.connection, 'pending', None)
+        if pending is not None and pending():
+            return True
+        waiting = getattr(self.server, 'waiting', None)
+        waiter = poll()
+        waiter.register(self.connection, POLLIN)
+        deadline = time() + keepalive_timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            try:
+                if waiter.poll(min(remaining, self.idle_check) * 1000):
+                    return True
+            except select_error as error:
+                if error.args[0] != EINTR:
+                    return False
+            if waiting is not None and waiting():
+                return False
+
+    def handle_one_request(self):
+        """ Handle one request of the connection.  Until the headers
+        have been parsed, any error sent must close the connection.
+        With LOG_FORMAT "json" or "binary", the request is logged once
+        its response has been sent, and with METRICS it is counted,
+        unless it asked for the metrics themselves.  If the request was
+        profiled, its profile is handed to the profiler. """
+        self.body_pending = True
+        self.request_start = self.phase_start = time()
+        self.timings = [None] * len(PHASES)
+        self.route_label = '-'
+        self.response_code = None
+        self.response_bytes = 0
+        self.profile = None
+        self.admitted = False
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            if self.admitted:
+                admission.leave()
+            if self.profile is not None:
+                self.profile.disable()
+                profiler.add(self.profile)
+        if self.response_code is None or self.route_label is None:
+            return
+        self.mark('write')
+        if log_output == 1 and log_format != 'text':
+            self.logAccess()
+            self.mark('log')
+        if metrics is not None:
+            metrics.observe(self.command, self.route_label, self.response_code,
+                            self.phase_start - self.request_start, self.timings)
+
+    def parse_request(self):
+        """ Parse the request line and headers, and decide whether the
+        connection can be kept open after this request.  Once profiling
+        is switched on, every PROFILE_EVERY-th request is profiled from
+        here on, and once it is switched off, the statistics are written
+        out here.  A request past the RATE_LIMIT of its client's IP
+        address, or past MAX_ACTIVE, is refused here, before its body
+        is read, unless it is for the metrics. """
+        self.request_start = self.phase_start = time()
+        if profiler.switched:
+            profiler.settle()
+        if profiler.profiling and profiler.due():
+            self.profile = Profile()
+            self.profile.enable()
+        if not BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self.mark('parse')
+        inputlength = self.headers.get('content-length', '').strip()
+        self.body_pending = inputlength not in ('', '0') or 'transfer-encoding' in self.headers
+        self.requests_served += 1
+        if self.requests_served >= max_requests:
+            self.close_connection = 1
+        # Refuse a body that is too large before reading any of it.
+        # The body is left unread, so the connection is closed.
+        if inputlength.isdigit() and int(inputlength) > max_body:
+            self.send_error(413)
+            return False
+        if not self.admit or isMetricsRequest(self.command, self.path):
+            return True
+        if ip_limiter is not None:
+            wait = ip_limiter.take(self.client_address[0])
+            if wait:
+                self.send_error(429, retry_after = wait)
+                return False
+        if admission is not None:
+            if not admission.enter():
+                self.send_error(503, retry_after = 1)
+                return False
+            self.admitted = True
+        return True
+
+    def mark(self, phase):
+        """ Count the time since the last mark as spent in phase.  See
+        Metrics for the phases. """
+        if metrics is None:
+            return
+        now = time()
+        timings = self.timings
+        index = PHASE_INDEX[phase]
+        timings[index] = (timings[index] or 0.0) + now - self.phase_start
+        self.phase_start = now
+
+    def date_time_string(self, timestamp=None):
+        """ Return the Date header for now from the clock, or for
+        timestamp as BaseHTTPRequestHandler does. """
+        if timestamp is None:
+            return clock.httpDate()
+        return BaseHTTPRequestHandler.date_time_string(self, timestamp)
+
+    def log_date_time_string(self):
+        """ Return the time for a line written to stderr from the
+        clock. """
+        return clock.logDate()
+
+    def send_response(self, code, message=None):
+        """ Send the status line and the standard headers, and tell the
+        client whether the connection stays open. """
+        self.response_code = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
+
+    def send_header(self, keyword, value):
+        """ Send a header, noting the size of the response body for the
+        log. """
+        if keyword == 'Content-Length':
+            self.response_bytes = int(value)
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def send_error(self, code, message=None, retry_after=None):
+        """ Send and log an error page.  Unlike the version provided by
+        BaseHTTPRequestHandler, the page is sent with a Content-Length
+        and the connection is only closed if the request body has not
+        been read.  With retry_after, the client is told to wait that
+        many seconds, rounded up, before it tries again. """
+        try:
+            short, explain = self.responses[code]
+        except KeyError:
+            short, explain = '???', '???'
+        if message is None:
+            message = short
+        self.log_error("code %d, message %s", code, message)
+        if self.body_pending:
+            self.close_connection = 1
+        self.send_response(code, message)
+        if retry_after is not None:
+            self.send_header('Retry-After', retryAfter(retry_after))
+
+        # No body is allowed with 1xx, 204, 205 or 304.
+        if code < 200 or code in (204, 205, 304):
+            self.end_headers()
+            return
+
+        content = (self.error_message_format %
+                   {'code': code, 'message': escape(message), 'explain': explain})
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
     # As the JSON format is so similar to a Python dictionary, we can
     # use MySQLdb's DictCursor to return dictionaries that can then be
     # converted into JSON.  For more information, see:
@@ -178,22 +2865,12 @@ class RESTHandler(BaseHTTPRequestHandler):
     #
     def makeJSONfromDICT(self, resultsDict):
         """ Convert the dictionary output from the DB to a JSON string. """
-        results = resultsDict
-
-        records = {}
-
-        for k,v in results.iteritems():
-            records[k] = str(v)
+        jsonout = codec.encode(resultsDict)
 
-        ajsondecoder = JSONEncoder()
-        jsonout = ajsondecoder.encode(records)
-
-        if log_output == 1:
-            logfile = open(server_log, 'at')
-            logfile.write("OUTPUT: \n")
-            logfile.write(jsonout)
-            logfile.write("\n\n")
-            logfile.close()
+        if log_output == 1 and log_format == 'text':
+            self.mark('encode')
+            logger.write("OUTPUT: \n" + jsonout + "\n\n")
+            self.mark('log')
 
         return jsonout
 
@@ -202,8 +2879,11 @@ class RESTHandler(BaseHTTPRequestHandler):
         request's date, time, IP address, method, URI, and
         protocol."""
 
+        if log_output == 0 or log_format != 'text':
+            return True
+
         if dev_status == 0:
-            status_items = [str(datetime.now()), "IN", self.command, self.path, str(self.client_address)]
+            status_items = [clock.stamp(), "IN", self.command, self.path, str(self.client_address)]
             headers = []
             for k in self.headers:
                 headers.append(k + ': ' + self.headers[k])
@@ -212,422 +2892,122 @@ class RESTHandler(BaseHTTPRequestHandler):
 
         else:
             status = '\n#\n#\n'
-            status += 'BEGIN REQUEST at %s\n\n' %(str(datetime.now()))
-            now = str(datetime.now())
+            now = clock.stamp()
+            status += 'BEGIN REQUEST at %s\n\n' %(now)
             status += 'INPUT:\n' + self.command + " request received: " + now + "\n"
             status += "SOURCE: " + str(self.client_address) + " using " + self.request_version + "\n"
             status += "URI: " + self.path + "\n"
             status += "HEADERS:\n" + str(self.headers)
 
-        logfile = open(server_log, 'at')
-        logfile.write(str(status) + '\n')
-        logfile.close()       
+        logger.write(str(status) + '\n')
         return True
 
     def logResponse(self,code,output):
         """ Log successful responses for requests received.  Logged
         data includes date, time, method, URI, IP, and status code."""
+        if log_output == 0 or log_format != 'text':
+            return True
+
         if dev_status == 0:
-            status_items = [str(datetime.now()), "OUT", self.command, self.path, str(self.client_address), code]
+            status_items = [clock.stamp(), "OUT", self.command, self.path, str(self.client_address), code]
             status = '\t'.join(status_items)
 
         else:
-            current_time = datetime.now()
             status = ('\nRESPONSE: Request succeeded with %s status.\n' %(code))
-            status += 'OUTPUT: ' + str(output) + '\n\nEND REQUEST TIME: %s\n#\n#' %(str(datetime.now()))
+            status += 'OUTPUT: ' + str(output) + '\n\nEND REQUEST TIME: %s\n#\n#' %(clock.stamp())
 
-        logfile = open(server_log, 'at')
-        logfile.write(status + '\n')
-        logfile.close()   
+        logger.write(status + '\n')
         return True
 
-    def logFailure(self, code, message, exception):
-        """ Log exceptions raised due to failed requests.  CLI options
-        determine whether the full error and traceback are logged.
-        The following data are always logged: date, time, method, URI,
-        IP, error code, and any description of the exception."""
-        exception_list = exception.split('\n')
-        exception_length = len(exception_list)
-        exception_type = exception_list[exception_length - 2]
-        if exception_type.find('KeyError') != -1:
-            missing_field = exception_list[exception_length-3]
-            missing_field = missing_field.split('[')
-            missing_field = missing_field[int(len(missing_field)-1)]
-            missing_field = missing_field.replace("'", "")
-            missing_field = missing_field.replace("]", "")
-            message = "The following field are missing: %s" %(missing_field)
-        elif exception_type.find('tuple index') != -1:
-            message = "No matching data"
-        else:
-            message = exception_type
-
+    def logFailure(self, code, message, trace = None, method = None, path = None):
+        """ Log a failed request.  The following data are always
+        logged: date, time, method, URI, IP, error code, and the
+        description of the failure.  The traceback is logged if it is
+        given, which failRequest() does in development and for one
+        failure in TRACE_EVERY.  METHOD and PATH, if given, are logged
+        in place of those of the request, as for an operation of a
+        batch. """
+        if log_output == 0 or log_format != 'text':
+            return
 
         if dev_status == 0:
-            status_items = [str(datetime.now()), "OUT", self.command, self.path, str(self.client_address), str(code), str(message)]
+            status_items = [clock.stamp(), "OUT", method or self.command, path or self.path,
+                            str(self.client_address), str(code), str(message)]
             status = '\t'.join(status_items)
+            if trace is not None:
+                status += '\n' + trace.rstrip('\n')
 
         else:
             status = ('\nRESPONSE: REQUEST FAILED WITH STATUS %s.\n'
                       'Check the format of both the URI and the body of your request.\n' %(int(code)))
             status += 'Further information follows:\n\nEXCEPTION: %s\n' %(message)
+            if trace is not None:
+                status += 'TRACEBACK:\n%s' %(trace)
             status += ('If you receive this error code repeatedly and are certain that '
                        'the URI and data are not malformed, there may be a bug in this '
                        'functionality.  Please report it at somebox@somedomain.someTLD.\n')
             status += '\n\nEND REQUEST\n#\n#'
 
-        logfile = open(server_log, 'at')
-        logfile.write(status + '\n')
-        logfile.close()
+        logger.write(status + '\n')
         return
 
+    def failRequest(self, error, status, method = None, path = None, label = None):
+        """ Count and log error, raised while answering the request, and
+        return the status to answer it with: the one its class is
+        registered with, or else status.  Call it from the except
+        clause, so that the traceback can be formatted if it is to be
+        logged.  An operation of a batch passes its own METHOD, PATH
+        and route LABEL, so that the failure is not put down to
+        /batch. """
+        kind, code = routes.classify(error)
+        if code is None:
+            code = status
+        if metrics is not None:
+            metrics.observeFailure(label or self.route_label or '-', kind)
+        if log_output == 1 and log_format == 'text':
+            trace = None
+            if dev_status != 0 or (trace_every and next(failure_count) % trace_every == 0):
+                trace = format_exc()
+            self.logFailure(code, describeFailure(kind, error), trace, method, path)
+        return code
+
+    def logAccess(self):
+        """ Log the request just answered as one LOG_FORMAT record.
+        The latency runs from reading the request line to sending the
+        response. """
+        now = time()
+        logger.write(formatAccess(self.request_start, self.command or '-', getattr(self, 'path', '') or '-',
+                                  self.client_address[0], self.response_code,
+                                  now - self.request_start, self.response_bytes))
+
     def do_GET(self):
         """ Process a GET request. """
 
-        logit = self.logInput()
-        status = ""
-
-        # Parsing on the question mark allows us to use tags in the
-        # URLs that are logged and so allow tracking but that do not
-        # impact negatively on the server's functionality.
-        self.path = self.path.split('?')[0]
-
-        uriParts = self.path.split('/')
-
-        # All URIs must have four parts.  If they don't, send a 404.
-        # Only the first four parts of the URI are used.
-        #
-        # This server is developed for a REST API call like the following:
-        #
-        # METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
-        #
-        # Effectively, each call is a sentence where the method is the
-        # verb, the agent is the subject, and the object is the
-        # recipient of the action.  So, for example, a user retrieving
-        # a contact could be:
-        #
-        # GET http://www.restserver.tld/user/00123/contact/012345609
-        #
-        # In the present server, we use IDs for both agent and object
-        # in order to allow us to use caches.  
-        try:
-            uriAgent = uriParts[1]
-            uriAgentID = uriParts[2]
-            uriObject = uriParts[3]
-            uriObjectID = uriParts[4]
-        except:
-            self.send_error(404)
+        if isMetricsRequest(self.command, self.path):
+            self.sendMetrics()
             return
 
-        try:
-            # Get the length of the data before reading it.  That is
-            # contained in the headers of the request.
-            inputlength = int(self.headers['content-length'])
-
-            # MUST NOT try to read the rfile attribute without setting
-            # the length.  Else the server hangs and waits for
-            # unlimited input from the client.
-            inputdata = self.rfile.read(inputlength)
+        self.handleREST(nobody = 404)
 
-            if dev_status != 0:
-                status += "RECEIVED DATA: "
-                status += inputdata
-                status += "\n"
-                logfile = open(server_log, 'at')
-                logfile.write(status)
-                logfile.close()
 
-        # If no data segment is sent with the request, send a 400.
-        except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('400', error, exc)
-            self.send_error(404)
-            return
+    def do_PUT(self):
+        """ Process a PUT request."""
 
-        try:
-            decodedata = inputdata
-        except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('400', error, exc)
-            self.send_error(400)
-            return
+        # NB: PUT actions and 204 codes do not allow for further
+        # output than the status code.  
 
-        # Instantiate new JSONDecoder object to decode JSON object
-        # into a dictionary.  
-        ajsondecoder = JSONDecoder()
-        jsondata = ajsondecoder.decode(decodedata)
-
-        if dev_status != 0:
-            logfile = open(server_log, 'at')
-            logfile.write('DECODED DATA: ' + str(jsondata) + '\n')
-            logfile.close()
-
-        # Here we presume on the above example of an agent 'user' and
-        # a series of objects on which that user can operate: profile,
-        # contact, and sessionID.  Obviously, the details will depend
-        # on the API being implemented.
-        if uriAgent == 'user' and uriObject == 'profile':
-            try:
-                from get_user import get_user_profile
-                agentID = str(uriAgentID)
-                profile = get_user_profile(agentID, jsondata)
+        self.handleREST(nobody = 404)
 
-                output = self.makeJSONfromLIST("profiles", "profile", profiles)
-                output = str(output)
-                output_length = len(output)
 
-                self.send_response(200) 
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', output_length)
-                self.end_headers()
-                self.wfile.write(output)
+    def do_POST(self):
+        """ Process a POST request. """
 
-                logit = self.logResponse('200',output)
+        # NB: POST actions take a 201 code and should return the
+        # identifier of the object they create.
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        elif uriAgent == 'user' and uriObject == 'contact': 
-            try:
-                from get_user import get_user_contact
-                agentID = str(uriAgentID)
-                contact = get_user_contact(agentID, jsondata)
-                if contact:
-
-                    output = self.makeJSONfromDICT("contacts", "contact", contact)
-
-                    output = str(output)
-                    output_length = len(output)
-
-                    self.send_response(200) 
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Content-Length', output_length)
-                    self.end_headers()
-                    self.wfile.write(output)
-
-                    logit = self.logResponse('200',output)
-
-                else:
-                    error = 'Retrieval failed.'
-                    exc = format_exc()
-                    logit = self.logFailure('400', error, exc)
-                    self.send_error(400)
-                    return
-
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        elif uriAgent == 'user' and uriObject == 'sessionID': 
-            try:
-                from sessions import get_user_sessionID
-                agentID = str(uriAgentID)
-                sessionID = get_user_sessionID(uriObject)
-
-                output = self.makeJSONfromDICT("sessions", "session", sessiondata)
-                output = str(output)
-                output_length = len(output)
-
-                self.send_response(200) 
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', output_length)
-                self.end_headers()
-                self.wfile.write(output)
-
-                logit = self.logResponse('200',output)
-
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        else: 
-            self.send_error(404)
-            return
-
-
-
-    def do_PUT(self):
-        """ Process a PUT request."""
-
-        # NB: PUT actions and 204 codes do not allow for further
-        # output than the status code.  
-
-        logit = self.logInput()
-        status = ""
-
-        # Parsing on the question mark allows us to use tags in the
-        # URLs that are logged and so allow tracking but that do not
-        # impact negatively on the server's functionality.
-        self.path = self.path.split('?')[0]
-
-        uriParts = self.path.split('/')
-
-        # All URIs must have four parts.  If they don't, send a 404.
-        # Only the first four parts of the URI are used.
-        #
-        # This server is developed for a REST API call like the following:
-        #
-        # METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
-        #
-        # Effectively, each call is a sentence where the method is the
-        # verb, the agent is the subject, and the object is the
-        # recipient of the action.  So, for example, a user retrieving
-        # a contact could be:
-        #
-        # GET http://www.restserver.tld/user/00123/contact/012345609
-        #
-        # In the present server, we use IDs for both agent and object
-        # in order to allow us to use caches.  
-        try:
-            uriAgent = uriParts[1]
-            uriAgentID = uriParts[2]
-            uriObject = uriParts[3]
-            uriObjectID = uriParts[4]
-        except Exception as error:
-            self.send_error(404)
-            return
-
-        # All URIs must have four parts.  If they don't, send a 404.
-        # Only the first four parts of the URI are used.
-        #
-        # This server is developed for a REST API call like the following:
-        #
-        # METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
-        #
-        # Effectively, each call is a sentence where the method is the
-        # verb, the agent is the subject, and the object is the
-        # recipient of the action.  So, for example, a user changing
-        # the details of a contact could be:
-        #
-        # PUT http://www.restserver.tld/user/00123/contact/012345609
-        #
-        # In the present server, we use IDs for both agent and object
-        # in order to allow us to use caches.  
-        status = '\n'
-        now = str(datetime.now())
-        status += self.command + " request received: " + now + "\n"
-        status += "SOURCE: " + str(self.client_address) + " using " + self.request_version + "\n"
-        status += "PATH: " + self.path + "\n"
-        status += "HEADERS:\n" + str(self.headers) ## + "\n"
-
-
-        try:
-            # Must get the length of the data before reading it.
-            inputlength = int(self.headers['content-length'])
-
-            # MUST NOT try to read the rfile attribute without setting
-            # the length.  Else the server hangs and waits for
-            # unlimited input from the client.
-            inputdata = self.rfile.read(inputlength)
-
-            if dev_status != 0:
-                status += "RECEIVED DATA: \n"
-                status += inputdata
-                status += "\n\n\n"
-
-                logfile = open(server_log, 'at')
-                logfile.write(status)
-                logfile.close()
-
-        # If no data segment is sent with the request, send a 404.
-        except Exception as error:
-            logfile = open(server_log, 'at')
-            logfile.write(status)
-            logfile.close()
-            self.send_error(404)
-            return
-
-        try:
-            # decodedata = loads(inputdata)
-            decodedata = inputdata
-        except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('400', error, exc)
-            self.send_error(400)
-            return
-
-        # Instantiate new JSONDecoder object to decode JSON object
-        # into a dictionary.  
-        ajsondecoder = JSONDecoder()
-        jsondata = ajsondecoder.decode(decodedata)
-
-        if dev_status != 0:
-            logfile = open(server_log, 'at')
-            logfile.write('DECODED DATA: ' + str(jsondata) + '\n')
-            logfile.close()
-        # Here we presume on the above example of an agent 'user' and
-        # a series of objects on which that user can operate: profile,
-        # contact, and sessionID.  Obviously, the details will depend
-        # on the API being implemented.
-        if uriAgent == 'user' and uriObject == 'profile':
-            try:
-                from put_user import put_user_profile
-                agentID = str(uriAgentID)
-                profile = put_user_profile(agentID, jsondata)
-
-                self.send_response(204) 
-
-                logit = self.logResponse('204',output)
-
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        elif uriAgent == 'user' and uriObject == 'contact': 
-            try:
-                from put_user import put_user_contact
-                agentID = str(uriAgentID)
-                contact = put_user_contact(agentID, jsondata)
-
-                self.send_response(204) 
-
-                logit = self.logResponse('204',output)
-
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        elif uriAgent == 'user' and uriObject == 'sessionID': 
-            try:
-                from sessions import put_user_sessionID
-                agentID = str(uriAgentID)
-                sessionID = put_user_sessionID(uriObject)
-
-                self.send_response(204) 
-
-                logit = self.logResponse('204',output)
-
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
-
-        else:
-            self.send_error(404)
-            return
-
-        return True
-
-
-    def do_POST(self):
-        """ Process a POST request. """
-
-        # NB: POST actions take a 201 code and should return the
-        # identifier of the object they create.
-
-        logit = self.logInput()
-        status = ""
+        if self.path.split('?', 1)[0] == '/batch':
+            self.handleBatch()
+            return
 
         # Rewrite POST requests that use the "_m" argument.  The "_m"
         # stands for "method" and allows clients that cannot use the
@@ -659,353 +3039,1305 @@ class RESTHandler(BaseHTTPRequestHandler):
                 self.command='POST'
                 self.path=parsed_path.netloc + parsed_path.path
             else:
+                self.logInput()
                 self.send_error(404)
                 return
 
+        self.handleREST(nobody = 404)
+
+
+    def do_DELETE(self):
+        """ Process a DELETE request. """
+
+        # DELETE actions respond with a 204 status.  Obviously, no
+        # further data is sent after the requested deletion is
+        # processed.
+
+        self.handleREST(nobody = 400)
+
+
+    def handleREST(self, nobody):
+        """
+        Process a request of any method through the route table.  The
+        route decides which handler is called and which status codes
+        are sent.  NOBODY is the status sent when the request comes
+        without a data segment.
+        """
+
+        logit = self.logInput()
+        self.mark('log')
+        status = ""
+
         # Parsing on the question mark allows us to use tags in the
         # URLs that are logged and so allow tracking but that do not
         # impact negatively on the server's functionality.
         self.path = self.path.split('?')[0]
 
-        uriParts = self.path.split('/')
-
-        # All URIs must have four parts.  If they don't, send a 404.
-        # Only the first four parts of the URI are used.
-        #
-        # This server is developed for a REST API call like the following:
-        #
-        # METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
-        #
-        # Effectively, each call is a sentence where the method is the
-        # verb, the agent is the subject, and the object is the
-        # recipient of the action.  So, for example, a user creating
-        # a contact could be:
-        #
-        # POST http://www.restserver.tld/user/00123/contact/0
-        #
-        # The zeroed out contact ID is because the contact does not
-        # have an identifier yet.
-        #
-        # In the present server, we use IDs for both agent and object
-        # in order to allow us to use caches.
-        try:
-            uriAgent = uriParts[1]
-            uriAgentID = uriParts[2]
-            uriObject = uriParts[3]
-            uriObjectID = uriParts[4]
-        except Exception as error:
+        # All URIs must have four parts.  If they don't, or if no
+        # route is registered for the method, agent and object, or if
+        # an ID does not have the type given for it in the route, send
+        # a 404.  Only the first four parts of the URI are used.  See
+        # RouteTable for the form of the URIs.
+        match = routes.match(self.command, self.path)
+        if match is None:
             self.send_error(404)
             return
+        route, agentID, objectID = match
+        self.route_label = route.label
+        if agent_limiter is not None:
+            wait = agent_limiter.take((route.uriAgent, agentID))
+            if wait:
+                self.send_error(429, retry_after = wait)
+                return
+        self.mark('route')
 
         try:
-            # Get the length of the data before reading it.  That is
-            # contained in the headers of the request.
-            inputlength = int(self.headers['content-length'])
-
-            # MUST NOT try to read the rfile attribute without a set
-            # length.  Otherwise, the server will hang and wait for
-            # unlimited input from the client.
-            inputdata = self.rfile.read(inputlength)
-
-            if dev_status != 0:
+            # Read the body by its Content-Length or by its chunks.
+            # The rfile MUST NOT be read without a length.  Else the
+            # server hangs and waits for unlimited input from the
+            # client.
+            inputdata = self.readBody()
+            self.mark('read')
+
+            if log_output == 1 and log_format == 'text' and dev_status != 0:
                 status += "RECEIVED DATA: \n"
                 status += inputdata
                 status += "\n\n\n"
-                logfile = open(server_log, 'at')
-                logfile.write(status)
-                logfile.close()
+                logger.write(status)
+                self.mark('log')
 
-        # If no data segment is sent with the request, send a 404.
+        # If no data segment is sent with the request, send NOBODY.
         except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('404', error, exc)
-            self.send_error(404)
+            self.send_error(self.failRequest(error, nobody))
+            return
+
+        # A GET on a route with a ttl is answered from the cache if it
+        # can be, and otherwise shares the backend call of an identical
+        # GET under way.  Any other method invalidates what is cached
+        # for its agent and object once the handler has run, and cuts
+        # loose the GETs under way for them.
+        group = (route.uriAgent, agentID, route.uriObject)
+        if self.command != 'GET':
+            try:
+                self.callRoute(route, agentID, objectID, inputdata)
+            finally:
+                invalidateGroup(group)
+            return
+        if cache is not None or coalescer is not None:
+            key = (objectID, sha1(inputdata).digest())
+            if cache is not None and route.ttl:
+                cached = cache.get(group + key)
+                self.mark('cache')
+                if cached is not None:
+                    self.sendJSON(cached[0], cached[1], 'HIT', cached[2], cached[3])
+                    return
+                generation = cache.generation(group)
+                sent = self.coalesceRoute(route, agentID, objectID, inputdata, group, key, 'MISS')
+                if sent is not None:
+                    output, etag, deflated = sent
+                    # Compress the body now, even if this client did not
+                    # ask for it, so that no hit has to.
+                    if deflated is None and compress_level and len(output) >= compress_min:
+                        deflated = deflateBody(output)
+                    cache.put(group + key, group, generation, route.ttl, route.success, output, etag, deflated)
+                return
+            self.coalesceRoute(route, agentID, objectID, inputdata, group, key)
             return
+        self.callRoute(route, agentID, objectID, inputdata)
+
+    def coalesceRoute(self, route, agentID, objectID, inputdata, group, key, cache_status = None):
+        """ Call the route for a GET as callRoute() does, unless an
+        identical GET is calling it already, in which case wait for its
+        response and send the same.  Return what callRoute() returns,
+        or None if the response of another GET was sent. """
+        if coalescer is None:
+            return self.callRoute(route, agentID, objectID, inputdata, cache_status)
+        flight, leading = coalescer.join(group, key)
+        if not leading:
+            outcome = coalescer.wait(flight)
+            self.mark('coalesce')
+            if outcome is None:
+                return self.callRoute(route, agentID, objectID, inputdata, cache_status)
+            if len(outcome) == 1:
+                logit = self.logFailure(outcome[0], 'An identical request failed with status %d' %(outcome[0]))
+                self.send_error(outcome[0])
+                return None
+            self.sendJSON(outcome[0], outcome[1], cache_status, outcome[2], outcome[3])
+            return None
+        outcome = None
+        try:
+            sent = self.callRoute(route, agentID, objectID, inputdata, cache_status, flight)
+            if sent is not None:
+                outcome = (route.success,) + sent
+            elif self.response_code >= 400:
+                outcome = (self.response_code,)
+        finally:
+            coalescer.land(flight, outcome)
+        return sent
+
+    def handleBatch(self):
+        """
+        Run the operations posted to /batch and answer with the results
+        of all of them in one response.  The body is a JSON array of
+        operations such as:
+
+        {"method": "PUT", "path": "/user/00123/profile/0", "body": {...}}
+
+        Each is dispatched through the route table as if it had been
+        sent on its own.  The response is a JSON array that holds, in
+        the same order, the "status" of each operation and, if it has
+        one, its "body".  With ?concurrent=1, the operations are run
+        at the same time by BATCH_WORKERS threads, so they must not
+        depend on one another.
+        """
+
+        logit = self.logInput()
+        self.route_label = '/batch'
+        self.mark('log')
+        concurrent = 'concurrent=1' in self.path.partition('?')[2].split('&')
+        self.path = self.path.split('?')[0]
 
         try:
-            decodedata = inputdata
+            inputdata = self.readBody()
+            self.mark('read')
         except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('400', error, exc)
-            self.send_error(400)
+            self.send_error(self.failRequest(error, 400))
             return
 
-        # Instantiate new JSONDecoder object to decode JSON object
-        # into a dictionary.  
-        ajsondecoder = JSONDecoder()
-        jsondata = ajsondecoder.decode(decodedata)
+        try:
+            operations = codec.decode(inputdata)
+            if not isinstance(operations, list):
+                raise ValueError('A batch must be a JSON array.')
+            if len(operations) > batch_max:
+                raise ValueError('A batch of %s operations is larger than %s.' %(len(operations), batch_max))
+        except Exception as error:
+            self.send_error(self.failRequest(error, 400))
+            return
+        self.mark('decode')
 
-        if dev_status != 0:
-            logfile = open(server_log, 'at')
-            logfile.write('DECODED DATA: ' + str(jsondata) + '\n')
-            logfile.close()
+        if concurrent and len(operations) > 1:
+            results = batchPool().map(self.runOperation, operations)
+        else:
+            results = [self.runOperation(operation) for operation in operations]
+        self.mark('call')
+        self.sendJSON(200, '[%s]' %(','.join(results)))
 
+    # The status of a batch operation sent without a body, as for a
+    # request without a data segment.
+    batch_nobody = {'GET': 404, 'PUT': 404, 'POST': 404, 'DELETE': 400}
 
-        # Here we presume on the above example of an agent 'user' and
-        # a series of objects on which that user can operate: profile,
-        # contact, and sessionID.  Obviously, the details will depend
-        # on the API being implemented.
-        if uriAgent == 'user' and uriObject == 'profile':
-            try:
-                from post_user import post_user_profile
-                agentID = str(uriAgentID)
-                profile = post_user_profile(agentID, jsondata)
+    def runOperation(self, operation):
+        """ Run one operation of a batch and return its result as a
+        JSON object. """
+        try:
+            method = str(operation['method']).upper()
+            path = str(operation['path']).split('?')[0]
+        except Exception:
+            return '{"status":400}'
+        match = routes.match(method, path)
+        if match is None:
+            return '{"status":404}'
+        route, agentID, objectID = match
+        if agent_limiter is not None and agent_limiter.take((route.uriAgent, agentID)):
+            return '{"status":429}'
+        if 'body' not in operation:
+            return '{"status":%d}' %(self.batch_nobody[method])
 
-                output = self.makeJSONfromLIST("profiles", "profile", profiles)
-                output = str(output)
-                output_length = len(output)
+        try:
+            result = route.call(agentID, objectID, operation['body'])
+            if hasattr(result, '__iter__') and not isinstance(result, dict) and route.success != 204:
+                result = list(result)
+            if route.empty and not result:
+                return '{"status":%d}' %(route.empty)
+            if route.success == 204:
+                return '{"status":204}'
+            if isinstance(result, list):
+                output = '[%s]' %(','.join([codec.encodeItem(item) for item in result]))
+            else:
+                output = codec.encode(result)
+            return '{"status":%d,"body":%s}' %(route.success, output)
+        except Exception as error:
+            return '{"status":%d}' %(self.failRequest(error, route.failure, method,
+                                                       str(operation['path']), route.label))
+        finally:
+            if method != 'GET':
+                invalidateGroup((route.uriAgent, agentID, route.uriObject))
+
+    def readBody(self):
+        """
+        Read the body of the request, sent either with a Content-Length
+        or in chunks with "Transfer-Encoding: chunked".  RequestTooLarge
+        is raised as soon as the body is known to be longer than
+        MAX_BODY, before the part past the limit is read.  Any other
+        exception means that the request came without a body or with a
+        malformed one.
+        """
+        if 'chunked' not in self.headers.get('transfer-encoding', '').lower():
+            inputlength = int(self.headers['content-length'])
+            if inputlength > max_body:
+                raise RequestTooLarge('The body of %s bytes is longer than %s.' %(inputlength, max_body))
+            inputdata = self.rfile.read(inputlength)
+            if len(inputdata) < inputlength:
+                raise ValueError('The body ended after %s of %s bytes.' %(len(inputdata), inputlength))
+            self.body_pending = False
+            return inputdata
+
+        chunks = []
+        inputlength = 0
+        while True:
+            size = int(self.rfile.readline(65537).split(';', 1)[0], 16)
+            if size < 0:
+                raise ValueError('Negative chunk size.')
+            if size == 0:
+                break
+            inputlength += size
+            if inputlength > max_body:
+                raise RequestTooLarge('The chunked body is longer than %s bytes.' %(max_body))
+            chunk = self.rfile.read(size)
+            if len(chunk) < size or self.rfile.readline(65537) not in ('\r\n', '\n'):
+                raise ValueError('A chunk of the body is cut short.')
+            chunks.append(chunk)
+        # Skip any trailer up to the empty line that ends the body.
+        while self.rfile.readline(65537) not in ('\r\n', '\n', ''):
+            pass
+        self.body_pending = False
+        return ''.join(chunks)
 
-                self.send_response(201) 
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', output_length)
-                self.end_headers()
-                self.wfile.write(output)
+    def callRoute(self, route, agentID, objectID, inputdata, cache_status = None, flight = None):
+        """ Decode the request data, call the route's handler and send
+        its result.  Return the JSON sent on success, its ETag and its
+        compressed form, if any, so that they can be cached, or None.
+        CACHE_STATUS, if set, is sent as the X-Cache header.  The GETs
+        waiting on FLIGHT, if given, are let go before a list is
+        streamed, as it cannot be shared. """
 
-                logit = self.logResponse('201',output)
+        try:
+            # Decode the JSON object into a dictionary.
+            jsondata = codec.decode(inputdata)
+        except Exception as error:
+            self.send_error(self.failRequest(error, 400))
+            return None
+        self.mark('decode')
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('401', error, exc)
-                self.send_error(401)
-                return
+        if log_output == 1 and log_format == 'text' and dev_status != 0:
+            logger.write('DECODED DATA: ' + str(jsondata) + '\n')
+            self.mark('log')
 
-        elif uriAgent == 'user' and uriObject == 'contact': 
-            try:
-                from post_user import post_user_contact
-                agentID = str(uriAgentID)
-                contact = post_user_contact(agentID, jsondata)
-                if contact:
+        try:
+            result = route.call(agentID, objectID, jsondata)
+
+            # A list or generator is sent as a JSON array, encoded item
+            # by item as it is sent.  Its first item is taken here, so
+            # that an empty one counts as no data and one that fails
+            # at once is answered with the failure status.
+            first = None
+            if hasattr(result, '__iter__') and not isinstance(result, dict) and route.success != 204:
+                result = iter(result)
+                try:
+                    first = (next(result),)
+                except StopIteration:
+                    result = []
+            self.mark('call')
+
+            if route.empty and not result:
+                logit = self.logFailure(route.empty, 'No matching data')
+                self.send_error(route.empty)
+                return None
+
+            # 204 responses carry nothing but the status.
+            if route.success == 204:
+                self.send_response(204)
+                self.end_headers()
+                self.mark('write')
+                logit = self.logResponse('204','')
+                self.mark('log')
+                return None
+
+            if first is not None:
+                if flight is not None:
+                    coalescer.land(flight, None)
+                self.sendJSONList(route.success, first[0], result)
+                return None
+            if result == []:
+                self.sendJSON(route.success, '[]')
+                return None
+
+            output = self.makeJSONfromDICT(result)
+            etag = None
+            if self.command == 'GET':
+                etag = entityTag(output)
+            self.mark('encode')
+            deflated = self.sendJSON(route.success, output, cache_status, etag)
+            return output, etag, deflated
 
-                    output = self.makeJSONfromDICT("contacts", "contact", contact)
+        except Exception as error:
+            self.send_error(self.failRequest(error, route.failure))
+            return None
+
+    def sendJSON(self, code, output, cache_status = None, etag = None, deflated = None):
+        """ Send output as the JSON body of a CODE response.  With an
+        ETag that the client already holds, as named by If-None-Match,
+        send an empty 304 instead.
+
+        A body of at least COMPRESS_MIN bytes is compressed if the
+        client accepts gzip or deflate, from deflated if it is given.
+        The compressed form has an ETag of its own.  Return deflated,
+        or the body as compressed here, or None. """
+        encoding = None
+        compressible = compress_level and len(output) >= compress_min
+        if compressible:
+            encoding = self.acceptedEncoding()
+            if encoding is not None and etag is not None:
+                etag = '%s-%s"' %(etag[:-1], encoding)
+
+        if etag is not None and self.notModified(etag):
+            headers = 'ETag: %s\r\n' %(etag)
+            if compressible:
+                headers += 'Vary: Accept-Encoding\r\n'
+            if cache_status is not None:
+                headers += 'X-Cache: %s\r\n' %(cache_status)
+            self.sendWhole(304, headers)
+            self.mark('write')
+            logit = self.logResponse('304','')
+            self.mark('log')
+            return deflated
+
+        body = output
+        if encoding is not None:
+            if deflated is None:
+                deflated = deflateBody(output)
+            body = encodeBody(deflated, encoding)
+            self.mark('compress')
+
+        headers = 'Content-Type: application/json\r\n'
+        if etag is not None:
+            headers = 'ETag: %s\r\n%s' %(etag, headers)
+        if compressible:
+            headers += 'Vary: Accept-Encoding\r\n'
+        if encoding is not None:
+            headers += 'Content-Encoding: %s\r\n' %(encoding)
+        if cache_status is not None:
+            headers += 'X-Cache: %s\r\n' %(cache_status)
+        self.sendWhole(code, headers, body)
+        self.mark('write')
+
+        logit = self.logResponse(str(code),output)
+        self.mark('log')
+        return deflated
+
+    def sendWhole(self, code, headers, body = None):
+        """
+        Send a response whose headers and body are all known at once,
+        in one write: the status line and the Server and Date headers,
+        which are made ahead, the Connection header, HEADERS, given as
+        "Name: value\\r\\n" lines, and BODY with its Content-Length.
+        With no BODY, no Content-Length is sent either, as for a 304.
+
+        This takes the place of send_response(), send_header() and
+        end_headers(), which format and buffer every header apart, and
+        of the log_request() line they write to stderr, as the request
+        is logged by logResponse() and logAccess().
+        """
+        self.response_code = code
+        if self.close_connection:
+            headers += 'Connection: close\r\n'
+        elif self.request_version == 'HTTP/1.0':
+            headers += 'Connection: keep-alive\r\n'
+        if body is None:
+            data = ''.join((STATUS_LINES[code], standardHeaders(), headers, '\r\n'))
+        else:
+            self.response_bytes = len(body)
+            data = ''.join((STATUS_LINES[code], standardHeaders(), headers,
+                            'Content-Length: %d\r\n\r\n' %(len(body)), body))
+        if self.direct_write:
+            # Whatever is already buffered in wfile goes first.
+            self.wfile.flush()
+            self.connection.sendall(data)
+        else:
+            self.wfile.write(data)
+
+    def acceptedEncoding(self):
+        """ Return "gzip" or "deflate", whichever the client's
+        Accept-Encoding prefers, or None if it accepts neither.  gzip
+        is chosen when both are equally welcome. """
+        accept = self.headers.get('accept-encoding')
+        if not accept:
+            return None
+        weights = {}
+        for item in accept.split(','):
+            coding, sep, params = item.partition(';')
+            weight = 1.0
+            for param in params.split(';'):
+                name, sep, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            coding = coding.strip().lower()
+            if coding == 'x-gzip':
+                coding = 'gzip'
+            weights[coding] = weight
+        anything = weights.get('*', 0.0)
+        gzip = weights.get('gzip', anything)
+        deflate = weights.get('deflate', anything)
+        if gzip > 0 and gzip >= deflate:
+            return 'gzip'
+        if deflate > 0:
+            return 'deflate'
+        return None
+
+    def sendJSONList(self, code, first, items):
+        """
+        Send first and the rest of items as the JSON array body of a
+        CODE response, a chunk at a time, so that neither the list nor
+        its JSON is held whole.  An HTTP/1.0 client, which cannot take
+        chunks, is sent the array unchunked and the connection is
+        closed after it.
+
+        Once the headers have gone out, an item that fails to be
+        produced or encoded can no longer change the status.  The
+        connection is then closed without the last chunk, so that the
+        client sees the response as cut short.
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        if not chunked:
+            self.close_connection = 1
+        compressor = None
+        encoding = None
+        if compress_level:
+            encoding = self.acceptedEncoding()
+        if encoding is not None:
+            compressor = compressobj(compress_level, DEFLATED, 31 if encoding == 'gzip' else 15)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if compress_level:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        encode = codec.encodeItem
+        pieces = ['[', encode(first)]
+        size = len(pieces[1]) + 1
+        count = 1
+        sent = 0
+        try:
+            for item in items:
+                piece = encode(item)
+                pieces.append(',')
+                pieces.append(piece)
+                size += len(piece) + 1
+                count += 1
+                if size >= self.stream_chunk_size:
+                    self.mark('encode')
+                    sent += self.sendChunk(''.join(pieces), chunked, compressor)
+                    pieces = []
+                    size = 0
+        except Exception as error:
+            self.failRequest(error, code)
+            self.close_connection = 1
+            self.response_bytes = sent
+            return
+        pieces.append(']')
+        self.mark('encode')
+        sent += self.sendChunk(''.join(pieces), chunked, compressor, True)
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+        self.response_bytes = sent
+
+        logit = self.logResponse(str(code), '[%s items in %s bytes]' %(count, sent))
+        self.mark('log')
+
+    def sendChunk(self, data, chunked, compressor = None, last = False):
+        """ Send data as one chunk of the body, at once, and return its
+        length as sent.  With a compressor, the data is compressed and
+        flushed so that the client can decode it as it arrives, and the
+        compressed stream is ended with the last chunk. """
+        if compressor is not None:
+            if last:
+                data = compressor.compress(data) + compressor.flush()
+            else:
+                data = compressor.compress(data) + compressor.flush(Z_SYNC_FLUSH)
+            self.mark('compress')
+        if chunked:
+            self.wfile.write('%x\r\n%s\r\n' %(len(data), data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+        self.mark('write')
+        return len(data)
+
+    def notModified(self, etag):
+        """ Return whether If-None-Match names etag or "*".  Tags are
+        compared weakly, so "W/" prefixes are ignored. """
+        match = self.headers.get('if-none-match')
+        if not match:
+            return False
+        for tag in match.split(','):
+            tag = tag.strip()
+            if tag[:2] == 'W/':
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
+
+    def sendMetrics(self):
+        """ Send the Metrics in the Prometheus text format.  This request
+        is neither logged nor counted itself, and any body it comes with
+        is left unread. """
+        self.route_label = None
+        if self.body_pending:
+            self.close_connection = 1
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TLSHTTPServer(HTTPServer):
+    """
+    An HTTPServer that wraps each connection for TLS as it is accepted,
+    but leaves the handshake to finish_request().  In single and fork
+    mode the handshake runs in the serving process, which a client
+    that stalls it holds up until it is cut off after
+    HANDSHAKE_TIMEOUT seconds, 2 by default in these modes.  With SSL
+    off, this is a plain HTTPServer.
+    """
 
-                    output = str(output)
-                    output_length = len(output)
+    def waiting(self):
+        """ Return whether a client is waiting to be accepted.  In fork
+        mode, the worker processes share the listening socket, so this
+        is any client waiting for any of them. """
+        waiter = poll()
+        waiter.register(self.socket, POLLIN)
+        try:
+            return bool(waiter.poll(0))
+        except select_error:
+            return False
+
+    def handle_error(self, request, client_address):
+        """ Report an exception raised while a connection was handled,
+        unless it is the SystemExit of stopServer() or a
+        KeyboardInterrupt, which is raised again to halt the server.
+        SocketServer catches every exception of process_request(), so
+        a SIGTERM that arrives while a request is handled, or while a
+        kept-open connection waits for the next one, would otherwise
+        leave the server running. """
+        if isinstance(exc_info()[1], (SystemExit, KeyboardInterrupt)):
+            raise
+        HTTPServer.handle_error(self, request, client_address)
+
+    def get_request(self):
+        sock, client_address = self.socket.accept()
+        if tls_context is not None:
+            sock = tls_context.wrap_socket(sock, server_side = True, do_handshake_on_connect = False)
+        return sock, client_address
+
+    def finish_request(self, request, client_address):
+        """ Complete the TLS handshake, if any, and then handle the
+        connection.  A connection whose handshake fails or times out is
+        closed without a word. """
+        if tls_context is not None and not completeHandshake(request):
+            return
+        HTTPServer.finish_request(self, request, client_address)
 
-                    self.send_response(201) 
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Content-Length', output_length)
-                    self.end_headers()
-                    self.wfile.write(output)
 
-                    logit = self.logResponse('201',output)
+class PooledHTTPServer(TLSHTTPServer):
+    """
+    An HTTPServer that hands each accepted connection to a fixed pool
+    of worker threads.  Unlike ThreadingMixIn, which starts a new
+    thread for every connection, the number of threads is capped by
+    WORKERS and accepted connections wait in a queue of QUEUE_SIZE.
+    When the queue is full, process_request() blocks and the server
+    stops accepting, so any further backlog waits in the kernel's
+    listen queue rather than in this process.
+
+    With SSL on, a connection is only queued for a worker once its TLS
+    handshake is complete.  Until then one handshake thread takes the
+    handshakes of all accepted connections as far as their clients have
+    sent them, waiting on every socket at once with poll, so that
+    clients slow to handshake hold no worker.  The accepting thread
+    hands it new connections through a deque, and wakes it with a byte
+    on a pipe.  At most QUEUE_SIZE handshakes are under way at once,
+    past which the server stops accepting, as when the queue is full.
+    """
 
-                else:
-                    error = 'POST failed.'
-                    exc = format_exc()
-                    logit = self.logFailure('403', error, exc)
-                    self.send_error(403)
-                    return
+    def __init__(self, server_address, RequestHandlerClass):
+        TLSHTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.request_queue = Queue(queue_size)
+        for i in range(workers):
+            worker = Thread(target = self.processQueue)
+            worker.daemon = True
+            worker.start()
+        if tls_context is not None:
+            self.accepted = deque()
+            self.handshake_slots = Semaphore(queue_size)
+            self.wakefd, self.wakewrite = pipe()
+            fcntl(self.wakewrite, F_SETFL, fcntl(self.wakewrite, F_GETFL) | O_NONBLOCK)
+            handshaker = Thread(target = self.driveHandshakes)
+            handshaker.daemon = True
+            handshaker.start()
+
+    def waiting(self):
+        """ Return whether an accepted connection is waiting for a
+        worker thread. """
+        return not self.request_queue.empty()
+
+    def process_request(self, request, client_address):
+        """ Queue the connection for the next free worker thread, or
+        with SSL on, pass it to the handshake thread. """
+        if tls_context is None:
+            self.request_queue.put((request, client_address))
+            return
+        self.handshake_slots.acquire()
+        self.accepted.append((request, client_address))
+        try:
+            write(self.wakewrite, 'x')
+        except OSError:
+            # The pipe is full, so the handshake thread is already due
+            # to wake.
+            pass
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('401', error, exc)
-                self.send_error(401)
-                return
+    def finish_request(self, request, client_address):
+        """ Handle the connection, whose handshake, if any, the
+        handshake thread has completed. """
+        HTTPServer.finish_request(self, request, client_address)
+
+    def driveHandshakes(self):
+        """ Take the TLS handshakes of accepted connections forward as
+        their clients send them, until the process exits.  A connection
+        whose handshake completes is queued for a worker thread, and
+        one whose handshake fails or does not complete within
+        HANDSHAKE_TIMEOUT is closed.  The outcomes are counted in the
+        Metrics as completeHandshake() counts them. """
+        waiter = poll()
+        waiter.register(self.wakefd, POLLIN)
+        # The socket, client address and start time of each handshake,
+        # by file descriptor.
+        pending = {}
+        while True:
+            now = time()
+            timeout = None
+            if pending:
+                first = min(started for sock, client_address, started in pending.itervalues())
+                timeout = max(first + handshake_timeout - now, 0) * 1000
+            try:
+                events = waiter.poll(timeout)
+            except select_error as error:
+                if error.args[0] != EINTR:
+                    raise
+                continue
+            steps = []
+            for fd, event in events:
+                if fd == self.wakefd:
+                    read(self.wakefd, 4096)
+                elif fd in pending:
+                    steps.append(fd)
+            while self.accepted:
+                sock, client_address = self.accepted.popleft()
+                sock.settimeout(0.0)
+                pending[sock.fileno()] = (sock, client_address, time())
+                steps.append(sock.fileno())
+            for fd in steps:
+                sock, client_address, started = pending[fd]
+                wanted = stepHandshake(sock)
+                if wanted:
+                    try:
+                        waiter.modify(fd, wanted)
+                    except IOError:
+                        waiter.register(fd, wanted)
+                    continue
+                self.endHandshake(waiter, pending, fd, 'ok' if wanted == 0 else 'failed')
+            now = time()
+            for fd, (sock, client_address, started) in pending.items():
+                if started + handshake_timeout <= now:
+                    self.endHandshake(waiter, pending, fd, 'timeout')
+
+    def endHandshake(self, waiter, pending, fd, outcome):
+        """ Stop waiting on the connection of fd, count its handshake,
+        and queue it for a worker thread if its outcome is "ok", or
+        else close it. """
+        sock, client_address, started = pending.pop(fd)
+        self.handshake_slots.release()
+        try:
+            waiter.unregister(fd)
+        except KeyError:
+            pass
+        if metrics is not None:
+            metrics.observeHandshake(outcome, time() - started)
+        if outcome == 'ok':
+            sock.settimeout(None)
+            self.request_queue.put((sock, client_address))
+        else:
+            self.shutdown_request(sock)
 
-        elif uriAgent == 'user' and uriObject == 'sessionID': 
+    def processQueue(self):
+        """ Serve queued connections until the process exits. """
+        while True:
+            request, client_address = self.request_queue.get()
             try:
-                from sessions import post_user_sessionID
-                agentID = str(uriAgentID)
-                sessionID = post_user_sessionID(uriObject)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
 
-                output = self.makeJSONfromDICT("sessions", "session", sessiondata)
-                output = str(output)
-                output_length = len(output)
 
-                self.send_response(201)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', output_length)
-                self.end_headers()
-                self.wfile.write(output)
+class BufferedRequestMixin:
+    """
+    Run a handler class on one complete request held in memory rather
+    than on a socket.  The async mode reads the request off the wire
+    itself and only hands it over once all of it has arrived, so the
+    do_* methods never wait on the client.  The response is collected
+    in wfile and sent back to the client by the event loop.
+    """
 
-                logit = self.logResponse('201',output)
+    def __init__(self, rawrequest, client_address, server, requests_served = 0):
+        self.rawrequest = rawrequest
+        self.requests_served = requests_served
+        BaseHTTPRequestHandler.__init__(self, None, client_address, server)
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('401', error, exc)
-                self.send_error(401)
-                return
+    direct_write = False
+    admit = False
 
-        else: 
-            pass
+    def setup(self):
+        self.rfile = StringIO(self.rawrequest)
+        self.wfile = StringIO()
 
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
 
+    def finish(self):
+        pass
 
 
-    def do_DELETE(self):
-        """ Process a DELETE request. """
+def bufferedHandler(handler_class):
+    """ Return a subclass of handler_class that runs on buffered requests. """
+    class BufferedHandler(BufferedRequestMixin, handler_class):
+        pass
+    return BufferedHandler
 
-        # DELETE actions respond with a 204 status.  Obviously, no
-        # further data is sent after the requested deletion is
-        # processed.
 
-        logit = self.logInput()
-        status = ""
+class AsyncHTTPChannel(asyncore.dispatcher):
+    """
+    One client connection of the AsyncHTTPServer.  Incoming data is
+    collected until a complete request (request line, headers and a
+    body of Content-Length bytes or of chunks) is available, which is
+    then passed to the server's worker threads.  Only one request per
+    connection is handed over at a time, so that pipelined requests
+    are answered in the order in which they arrived.
+    """
 
-        # Parsing on the question mark allows us to use tags in the
-        # URLs that are logged and so allow tracking but that do not
-        # impact negatively on the server's functionality.
-        self.path = self.path.split('?')[0]
+    # Requests whose headers do not end within this many bytes are
+    # dropped.  BaseHTTPRequestHandler uses the same bound for the
+    # request line.
+    max_header_size = 65536
+
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock, map = server.channels)
+        self.client_address = client_address
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = ''
+        self.busy = False
+        self.admitted = False
+        self.closing = False
+        self.requests_served = 0
+        self.last_active = self.accepted = time()
+        self.handshaking = tls_context is not None
+        self.handshake_writing = False
+
+    def readable(self):
+        return self.handshaking or not (self.busy or self.closing)
+
+    def writable(self):
+        return bool(self.outbuf) or self.handshake_writing
+
+    def handshake(self):
+        """ Take the TLS handshake as far as the client has sent it,
+        without blocking, and count it in the Metrics once it is over.
+        Clients that do not complete it in HANDSHAKE_TIMEOUT seconds are
+        closed by closeIdle(). """
+        try:
+            self.socket.do_handshake()
+        except SSLError as error:
+            if error.args[0] in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                self.handshake_writing = error.args[0] == SSL_ERROR_WANT_WRITE
+                return
+            self.endHandshake('failed')
+            self.close()
+            return
+        except socket_error:
+            self.endHandshake('failed')
+            self.close()
+            return
+        self.endHandshake('ok')
 
-        uriParts = self.path.split('/')
+    def endHandshake(self, outcome):
+        self.handshaking = self.handshake_writing = False
+        self.last_active = time()
+        if metrics is not None:
+            metrics.observeHandshake(outcome, self.last_active - self.accepted)
 
-        # All URIs must have four parts.  If they don't, send a 404.
-        # Only the first four parts of the URI are used.
-        #
-        # This server is developed for a REST API call like the following:
-        #
-        # METHOD http://www.somedomain.com/uriAgent/uriAgentID/uriObject/uriObjectID
-        #
-        # Effectively, each call is a sentence where the method is the
-        # verb, the agent is the subject, and the object is the
-        # recipient of the action.  So, for example, a user retrieving
-        # a contact could be:
-        #
-        # GET http://www.restserver.tld/user/00123/contact/012345609
-        #
-        # In the present server, we use IDs for both agent and object
-        # in order to allow us to use caches.  
+    def handle_read(self):
+        if self.handshaking:
+            self.handshake()
+            return
         try:
-            uriAgent = uriParts[1]
-            uriAgentID = uriParts[2]
-            uriObject = uriParts[3]
-            uriObjectID = uriParts[4]
-        except:
-            self.send_error(404)
+            data = self.recv(65536)
+            # Decrypted SSL data that is already buffered is not seen
+            # by poll(), so it must be collected here.
+            pending = getattr(self.socket, 'pending', None)
+            while data and pending and pending():
+                data += self.recv(65536)
+        except SSLError as error:
+            if error.args[0] in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        if data:
+            self.last_active = time()
+            self.inbuf += data
+            self.nextRequest()
+
+    def nextRequest(self):
+        """ Hand the next complete request in the input buffer to the
+        worker threads. """
+        if self.busy or self.closing:
+            return
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self.inbuf) > self.max_header_size:
+                self.close()
             return
+        length = 0
+        chunked = False
+        for line in self.inbuf[:end].split('\r\n')[1:]:
+            name, sep, value = line.partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                try:
+                    length = max(int(value), 0)
+                except ValueError:
+                    length = 0
+            elif name == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+        if chunked:
+            total = self.chunkedEnd(end + 4)
+            if total is None:
+                return
+        elif length > max_body:
+            # Hand over the headers alone, which the handler answers
+            # with 413, rather than collect the body.
+            total = end + 4
+        else:
+            total = end + 4 + length
+            if len(self.inbuf) < total:
+                return
+        rawrequest = self.inbuf[:total]
+        self.inbuf = self.inbuf[total:]
+        # Turn the request away now, if it is to be, rather than queue
+        # it for a worker thread.  A request for the metrics is always
+        # queued, and does not count against MAX_ACTIVE.
+        words = rawrequest[:rawrequest.find('\r\n')].split()
+        self.admitted = False
+        if len(words) < 2 or not isMetricsRequest(words[0], words[1]):
+            if ip_limiter is not None:
+                wait = ip_limiter.take(self.client_address[0])
+                if wait:
+                    self.refuse(429, wait)
+                    return
+            if admission is not None:
+                if not admission.enter():
+                    self.refuse(503, 1)
+                    return
+                self.admitted = True
+        self.busy = True
+        self.server.tasks.put((self, rawrequest))
+
+    def refuse(self, code, retry_after):
+        """ Answer the request just read with code and a Retry-After of
+        retry_after seconds, and close the connection. """
+        self.respond(''.join((STATUS_LINES[code], standardHeaders(),
+                              'Retry-After: %d\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+                              %(retryAfter(retry_after)))),
+                     True, self.requests_served + 1)
+
+    def chunkedEnd(self, start):
+        """ Return where the chunked body that begins at start ends in
+        the input buffer, or None if it has not all arrived yet.  A
+        body that is malformed, or whose chunks add up to more than
+        MAX_BODY, is cut off at the size of the chunk at fault, which
+        the handler then rejects. """
+        inbuf = self.inbuf
+        pos = start
+        inputlength = 0
+        while True:
+            eol = inbuf.find('\r\n', pos)
+            if eol < 0:
+                if len(inbuf) - pos > self.max_header_size:
+                    return len(inbuf)
+                return None
+            try:
+                size = int(inbuf[pos:eol].split(';', 1)[0], 16)
+            except ValueError:
+                return eol
+            inputlength += size
+            if size < 0 or inputlength > max_body:
+                return eol
+            if size == 0:
+                # The body ends with the empty line after any trailer.
+                end = inbuf.find('\r\n\r\n', eol)
+                if end < 0:
+                    return None
+                return end + 4
+            pos = eol + 2 + size + 2
+            if len(inbuf) < pos:
+                return None
+
+    def respond(self, response, close_connection, requests_served):
+        """ Queue the response to the current request for sending.
+        Called from the event loop once a worker has finished. """
+        self.busy = False
+        self.last_active = time()
+        self.requests_served = requests_served
+        self.outbuf += response
+        if close_connection:
+            self.closing = True
+            if not self.outbuf:
+                self.close()
+        else:
+            self.nextRequest()
 
+    def handle_write(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        sent = self.send(self.outbuf)
+        if sent:
+            self.last_active = time()
+        self.outbuf = self.outbuf[sent:]
+        if self.closing and not self.outbuf:
+            self.close()
 
-        try:
-            # Get the length of the data before reading it.  That is
-            # contained in the headers of the request.
-            inputlength = int(self.headers['content-length'])
+    def handle_close(self):
+        self.close()
 
+    def handle_error(self):
+        self.close()
 
-            # MUST NOT try to read the rfile attribute without a set
-            # length.  Otherwise, the server will hang and wait for
-            # unlimited input from the client.
-            inputdata = self.rfile.read(inputlength)
 
-            if dev_status != 0:
-                status += "RECEIVED DATA: \n"
-                status += inputdata
-                status += "\n\n\n"
+class AsyncWaker(asyncore.file_dispatcher):
+    """
+    The read end of a pipe in the event loop.  Worker threads write a
+    byte to it after queueing a finished response, which wakes the
+    loop so that the response is passed to its channel.
+    """
 
-                logfile = open(server_log, 'at')
-                logfile.write(status)
-                logfile.close()
+    def __init__(self, server):
+        self.server = server
+        readfd, self.writefd = pipe()
+        fcntl(self.writefd, F_SETFL, fcntl(self.writefd, F_GETFL) | O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, readfd, map = server.channels)
+        close(readfd)
+
+    def wake(self):
+        try:
+            write(self.writefd, 'x')
+        except OSError:
+            # The pipe is full, so the loop is already due to wake.
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        completed = self.server.completed
+        while completed:
+            channel, response, close_connection, requests_served = completed.popleft()
+            if channel.admitted:
+                admission.leave()
+            if channel.connected:
+                channel.respond(response, close_connection, requests_served)
 
-        # If no data segment is sent with the request, send a 400.
-        except Exception as error:
-            logfile = open(server_log, 'at')
-            status = "\n\n\n***** BAD REQUEST *****\n" + status + "\n***********************\n"
-            logfile.write(status)
-            logfile.close()
-            self.send_error(400)
-            return
 
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+    An event-driven server for the async SERVER_MODE.  A single
+    asyncore loop accepts connections and does all reading and
+    writing, so idle or slow clients cost a socket and a buffer
+    rather than a thread.  Complete requests are run through
+    RequestHandlerClass by WORKERS threads, which is where the
+    blocking backend calls happen.
+
+    The interface mirrors HTTPServer: it is created with an address
+    and a handler class, and it is run with serve_forever().  With
+    SSL on, each connection is wrapped as it is accepted and its TLS
+    handshake is driven by the event loop like any other reading and
+    writing.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.channels = {}
+        asyncore.dispatcher.__init__(self, map = self.channels)
+        self.create_socket(AF_INET, SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(1024)
+        self.server_address = self.socket.getsockname()
+        self.RequestHandlerClass = bufferedHandler(RequestHandlerClass)
+        self.tasks = Queue()
+        self.completed = deque()
+        self.waker = AsyncWaker(self)
+        for i in range(workers):
+            worker = Thread(target = self.processTasks)
+            worker.daemon = True
+            worker.start()
+
+    def handle_accept(self):
         try:
-            decodedata = inputdata
-        except Exception as error:
-            exc = format_exc()
-            logit = self.logFailure('400', error, exc)
-            self.send_error(400)
+            pair = self.accept()
+            if pair is not None and tls_context is not None:
+                # The handshake is driven by the channel's events, so it
+                # is not left to block the event loop here.
+                pair = (tls_context.wrap_socket(pair[0], server_side = True, do_handshake_on_connect = False),
+                        pair[1])
+        except Exception:
+            # A client that is gone before it is accepted must not take
+            # the listening socket down with it.
             return
-
-        # Instantiate new JSONDecoder object to decode JSON object
-        # into a dictionary.  
-        ajsondecoder = JSONDecoder()
-        jsondata = ajsondecoder.decode(decodedata)
-
-        if dev_status != 0:
-            logfile = open(server_log, 'at')
-            logfile.write('DECODED DATA: ' + str(jsondata) + '\n')
-            logfile.close()
-
-        # Here we presume on the above example of an agent 'user' and
-        # a series of objects on which that user can operate: profile,
-        # contact, and sessionID.  Obviously, the details will depend
-        # on the API being implemented.
-        if uriAgent == 'user' and uriObject == 'profile':
+        if pair is not None:
+            sock, client_address = pair
+            AsyncHTTPChannel(sock, client_address, self)
+
+    def handle_error(self):
+        stderr.write(format_exc())
+
+    def processTasks(self):
+        """ Run queued requests through the handler until the process
+        exits. """
+        while True:
+            channel, rawrequest = self.tasks.get()
+            requests_served = channel.requests_served
             try:
-                from delete_user import delete_user_profile
-                agentID = str(uriAgentID)
-                profile = delete_user_profile(agentID, jsondata)
+                handler = self.RequestHandlerClass(rawrequest, channel.client_address, self, requests_served)
+                response = handler.wfile.getvalue()
+                close_connection = handler.close_connection
+                requests_served = handler.requests_served
+            except Exception:
+                stderr.write(format_exc())
+                response = ''
+                close_connection = 1
+            self.completed.append((channel, response, close_connection, requests_served))
+            self.waker.wake()
+
+    def closeIdle(self):
+        """ Close the connections that have waited for a new request
+        for longer than KEEPALIVE_TIMEOUT seconds, and those that have
+        not completed their TLS handshake in HANDSHAKE_TIMEOUT. """
+        now = time()
+        expired = now - keepalive_timeout
+        for channel in self.channels.values():
+            if not isinstance(channel, AsyncHTTPChannel):
+                continue
+            if channel.handshaking:
+                if channel.accepted < now - handshake_timeout:
+                    channel.endHandshake('timeout')
+                    channel.close()
+            elif not channel.busy and channel.last_active < expired:
+                channel.close()
+
+    def serve_forever(self):
+        next_sweep = time() + 1.0
+        while True:
+            asyncore.loop(timeout = 1.0, use_poll = True, map = self.channels, count = 1)
+            if time() >= next_sweep:
+                self.closeIdle()
+                next_sweep = time() + 1.0
+
+
+def reloadBackends(signum, frame):
+    """ Reload the backend modules on SIGHUP, without closing the
+    listening socket.  If any of them fails to load, the backends
+    already in use are kept. """
+    try:
+        routes.bind(reloading = True)
+        message = "BACKENDS RELOADED"
+    except ImportError as error:
+        message = "BACKEND RELOAD FAILED: %s" %(error)
+    logEvent(message)
+    logCacheStats()
 
-                self.send_response(204) 
 
-                logit = self.logResponse('204',output)
+def logCacheStats():
+    """ Log the counters of the response cache, if there is one. """
+    if cache is not None:
+        logEvent("CACHE STATS: %s" %(' '.join('%s=%s' % item for item in sorted(cache.stats().items()))))
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
 
-        elif uriAgent == 'user' and uriObject == 'contact': 
-            try:
-                from delete_user import delete_user_contact
-                agentID = str(uriAgentID)
-                contact = delete_user_contact(agentID, jsondata)
-                self.send_response(204) 
-                logit = self.logResponse('204',output)
+def startSampling(signum, frame):
+    """ Sample the stacks of the serving threads on SIGUSR1. """
+    profiler.startSampling()
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
 
-        elif uriAgent == 'user' and uriObject == 'sessionID': 
-            try:
-                from sessions import delete_user_sessionID
-                agentID = str(uriAgentID)
-                sessionID = delete_user_sessionID(uriObject)
-                self.send_response(204)
-                logit = self.logResponse('204',output)
+def toggleProfiling(signum, frame):
+    """ Switch the profiling of requests on or off on SIGUSR2. """
+    profiler.toggle()
 
-            except Exception as error:
-                exc = format_exc()
-                logit = self.logFailure('403', error, exc)
-                self.send_error(403)
-                return
 
-        else: 
-            pass
+def stopServer(signum, frame):
+    """ Turn SIGTERM into SystemExit so that the server is halted and
+    logged in the same way as with a KeyboardInterrupt. """
+    raise SystemExit(0)
+
+
+def serveForked(httpd):
+    """
+    Fork WORKERS processes that each run serve_forever() on the
+    listening socket of httpd.  The kernel hands every new connection
+    to one of the waiting processes.  The parent only watches over
+    its children: a worker that dies is replaced, a SIGHUP, SIGUSR1 or
+    SIGUSR2 is passed on to every worker, and when the parent is
+    halted, every worker is halted with it, and waited for.
+    """
+
+    children = set()
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                kill(pid, signum)
+            except OSError:
+                pass
+
+    def spawn():
+        pid = fork()
+        if pid == 0:
+            logger.afterFork()
+            signal(SIGTERM, stopServer)
+            signal(SIGHUP, reloadBackends)
+            signal(SIGUSR1, startSampling)
+            signal(SIGUSR2, toggleProfiling)
+            status = 1
+            try:
+                httpd.serve_forever()
+            except (KeyboardInterrupt, SystemExit):
+                status = 0
+            except Exception:
+                stderr.write(format_exc())
+            finally:
+                profiler.writeStats()
+                logger.close()
+                _exit(status)
+        children.add(pid)
+
+    # Write out the parent's log before forking, so that its records
+    # come first and are not inherited by the workers.
+    logger.close()
+    for i in range(workers):
+        spawn()
+    signal(SIGHUP, forward)
+    signal(SIGUSR1, forward)
+    signal(SIGUSR2, forward)
+
+    try:
+        while True:
+            try:
+                pid, status = wait()
+            except OSError as error:
+                if error.errno == EINTR:
+                    continue
+                raise
+            children.discard(pid)
+            logEvent("WORKER %s EXITED WITH STATUS %s" %(pid, status))
+            spawn()
+
+    finally:
+        for pid in children:
+            try:
+                kill(pid, SIGTERM)
+            except OSError:
+                pass
+        # Wait for every worker to exit, so that none is left behind
+        # still serving on the port.
+        for pid in children:
+            while True:
+                try:
+                    waitpid(pid, 0)
+                    break
+                except OSError as error:
+                    if error.errno != EINTR:
+                        break
 
 
 def main(server_class=HTTPServer, handler_class=RESTHandler):
     """
     The main() function instantiates the server and takes care of
-    binding it to the port set above.  The wrap_socket() function of
-    the SSL module is used to encrypt all communication using the
-    specified certificate.
+    binding it to the port set above.  The certificate in CERTFILE is
+    loaded into the TLS context, with which every connection is
+    wrapped as it is accepted, to encrypt all communication.
+
+    With SERVER_MODE set to "thread", a PooledHTTPServer is used in
+    place of the plain HTTPServer, and with SERVER_MODE set to "async",
+    an AsyncHTTPServer is used.  Otherwise a TLSHTTPServer is used.
+    With SERVER_MODE set to "fork", the listening socket is bound here
+    and then shared by the worker processes started by serveForked().
+
+    The backends of all routes are loaded before anything else, and if
+    any is missing, the server exits with a message saying which.
+    A SIGHUP reloads them while the server keeps running, and SIGUSR1
+    and SIGUSR2 start the Profiler.
 
     """
 
     try:
-        now = datetime.now()
-        logfile = open(server_log, 'at')
-        logfile.write("\n\n SERVER STARTED on Port %s : %s \n\n" %(server_port,now))
-        logfile.close()
-        server_address = ('', server_port)
-        httpd = server_class(server_address, handler_class)
-        # Wrap the socket for SSL
+        routes.bind()
+    except ImportError as error:
+        stderr.write("restserver.py: %s\n" %(error))
+        raise SystemExit(1)
+    if tls_context is not None:
+        try:
+            tls_context.load_cert_chain(certfile, keyfile)
+        except (IOError, SSLError) as error:
+            stderr.write("restserver.py: Cannot load the certificate from %s: %s\n" %(certfile, error))
+            raise SystemExit(1)
+    signal(SIGHUP, reloadBackends)
+    signal(SIGUSR1, startSampling)
+    signal(SIGUSR2, toggleProfiling)
+
+    try:
+        logEvent("\n SERVER STARTED on Port %s" %(server_port))
+        signal(SIGTERM, stopServer)
+        if server_mode == 'thread' and server_class is HTTPServer:
+            server_class = PooledHTTPServer
+        elif server_mode == 'async' and server_class is HTTPServer:
+            server_class = AsyncHTTPServer
+        elif server_class is HTTPServer:
+            server_class = TLSHTTPServer
+        # The connections are wrapped for SSL as they are accepted.
         #
         # A test certificate can be generated with the following incantation:
-        # openssl req -new -x509 -days 30 -nodes -out timecert.pem -keyout restcert.pem
-        #
-        # Note:  The location of the certificate should be an absolute path.
-        if no_ssl == 0:
-           httpd.socket = wrap_socket(httpd.socket, certfile='/some/directory/with/an/absolute/path/restcert.pem', server_side=True)
-        httpd.serve_forever()
+        # openssl req -new -x509 -days 30 -nodes -out restcert.pem -keyout restcert.pem
+        server_address = ('', server_port)
+        httpd = server_class(server_address, handler_class)
+        if server_mode == 'fork':
+            serveForked(httpd)
+        else:
+            httpd.serve_forever()
         return True
 
     except (KeyboardInterrupt, SystemExit):
-        now = datetime.now()
-        logfile = open(server_log, 'at')
-        logfile.write("\n SERVER HALTED : %s \n\n" %(now))
-        logfile.close()
+        logCacheStats()
+        profiler.writeStats()
+        logEvent("SERVER HALTED")
+
+    finally:
+        logger.close()
 
 
 # Check whether the program has been called from the command line.  If
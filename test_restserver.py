@@ -0,0 +1,678 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+#
+# test_restserver.py
+#
+# Released under the GPLv2, as restserver.py.
+'''
+Tests for restserver.py.  The tests of whole requests start the
+server with the stub backends of benchmark.py, so no database is
+needed, and the tests of its parts import it with the options they
+need.
+
+Usage: python -m unittest test_restserver
+'''
+
+# Use the server and client helpers of the benchmarks
+from benchmark import (startServer, stopServer, readResponse, importServer,
+                       importStubbedServer, serverCommand)
+# Use HTTPConnection for requests whose response body is checked
+from httplib import HTTPConnection
+# Use json to read the log records and the responses
+from json import (dumps, loads)
+# Use os to find the server log
+from os import (path, remove)
+# Use re to read the counts of dropped log records
+from re import findall
+# Use rmtree to remove the backend module of the pool tests
+from shutil import rmtree
+# Use socket for the client connection
+from socket import create_connection
+# Use sqlite3 for the connections of the pool tests
+import sqlite3
+# Use sys to register the backends of the tests
+import sys
+# Use gettempdir to find the server log, and mkdtemp to hold the
+# backend module of the pool tests
+from tempfile import (gettempdir, mkdtemp)
+# Use Thread to write to the log from several threads at once, and to
+# serve requests from this process, and Event to hold a pooled
+# connection until a test lets it go
+from threading import (Thread, Event)
+# Use sleep to let pooled connections go idle
+from time import sleep
+# Use ModuleType to build the backends of the tests
+from types import ModuleType
+# Use unittest to run the tests
+import unittest
+
+
+def request(port, method, path, body = '', headers = {}):
+    """ Send one request and return the status, headers and body of
+    its response. """
+    connection = HTTPConnection('127.0.0.1', port, timeout = 10)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+class InProcessServer:
+    """
+    A mixin that serves restserver.py in thread mode from a thread of
+    this process, with the options ARGV, so that a test can reach into
+    the server and give it backends of its own.  The functions of
+    BACKENDS are registered as the module test_backends, and
+    addRoutes() adds the routes that use them before they are bound.
+    """
+
+    port = None
+    argv = []
+    backends = {}
+
+    @classmethod
+    def setUpClass(cls):
+        module = ModuleType('test_backends')
+        module.__dict__.update(cls.backends)
+        sys.modules['test_backends'] = module
+        cls.restserver = importStubbedServer(serverCommand(cls.port, ['-s', '1', '-m', 'thread'] + cls.argv))
+        cls.addRoutes(cls.restserver)
+        cls.restserver.routes.bind()
+        cls.httpd = cls.restserver.PooledHTTPServer(('127.0.0.1', cls.port), cls.restserver.RESTHandler)
+        serving = Thread(target = cls.httpd.serve_forever)
+        serving.daemon = True
+        serving.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    @classmethod
+    def addRoutes(cls, restserver):
+        pass
+
+    def request(self, method, path, body = '', headers = {}):
+        return request(self.port, method, path, body, headers)
+
+
+class JSONLogTest(unittest.TestCase):
+
+    port = 65190
+
+    def setUp(self):
+        self.server = startServer(self.port, ['-s', '1', '-m', 'thread', '-l', '1',
+                                              '-O', 'json', '-F', '0.05'])
+
+    def tearDown(self):
+        if self.server is not None:
+            stopServer(self.server)
+
+    def request(self, connection, reader, path):
+        connection.sendall('GET %s HTTP/1.1\r\nHost: localhost\r\n'
+                           'Content-Length: 2\r\n\r\n{}' %(path))
+        return readResponse(reader)
+
+    def testNonUTF8Path(self):
+        """ A path that is not UTF-8 is logged, and the connection is
+        kept alive for the next request. """
+        connection = create_connection(('127.0.0.1', self.port))
+        reader = connection.makefile('rb')
+        try:
+            self.assertEqual(self.request(connection, reader, '/user/1/profile/\xff'), (200, False))
+            self.assertEqual(self.request(connection, reader, '/user/1/profile/1'), (200, False))
+        finally:
+            reader.close()
+            connection.close()
+        stopServer(self.server)
+        self.server = None
+        log = open(path.join(gettempdir(), 'restserver-benchmark.log'))
+        try:
+            paths = [record.get('path') for record in map(loads, log)]
+        finally:
+            log.close()
+        self.assertIn(u'/user/1/profile/\xff', paths)
+        self.assertIn(u'/user/1/profile/1', paths)
+
+
+class LogWriterTest(unittest.TestCase):
+
+    log = path.join(gettempdir(), 'restserver-test.log')
+    threads = 4
+    records = 500
+
+    def setUp(self):
+        if path.exists(self.log):
+            remove(self.log)
+
+    def writeAll(self, policy):
+        """ Write records from several threads at once through a
+        LogWriter with a short queue, and return what it wrote. """
+        logger = importServer(['-L', self.log, '-Q', '4', '-B', '4', '-F', '0.01',
+                               '-P', policy]).logger
+        def writeRecords():
+            for i in range(self.records):
+                logger.write('record\n')
+        writers = [Thread(target = writeRecords) for i in range(self.threads)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        logger.close()
+        log = open(self.log)
+        try:
+            return log.read()
+        finally:
+            log.close()
+
+    def testBlockKeepsEveryRecord(self):
+        written = self.writeAll('block')
+        self.assertEqual(written.count('record\n'), self.threads * self.records)
+
+    def testDropCountsEveryRecord(self):
+        """ Every record is either written or counted as dropped. """
+        written = self.writeAll('drop')
+        dropped = sum(int(n) for n in findall('LOG RECORDS DROPPED: (\\d+)', written))
+        self.assertEqual(written.count('record\n') + dropped, self.threads * self.records)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = importServer([])
+
+    def setUp(self):
+        # Room for three entries of a 10-byte body.
+        self.cache = self.server.ResponseCache(3 * (self.server.ResponseCache.OVERHEAD + 10))
+
+    def put(self, objectID, group = ('user', '1', 'contact')):
+        key = group + (objectID, '')
+        self.cache.put(key, group, self.cache.generation(group), 60, 200, 'x' * 10, '"etag"', None)
+        return key
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        first, second, third = self.put('1'), self.put('2'), self.put('3')
+        self.assertNotEqual(self.cache.get(first), None)
+        fourth = self.put('4')
+        self.assertEqual(self.cache.get(second), None)
+        for key in (first, third, fourth):
+            self.assertEqual(self.cache.get(key), (200, 'x' * 10, '"etag"', None))
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (3, 1))
+        self.assertTrue(stats['bytes'] <= self.cache.budget)
+
+    def testEntryLargerThanBudgetIsNotCached(self):
+        group = ('user', '1', 'contact')
+        self.cache.put(group + ('1', ''), group, self.cache.generation(group), 60, 200,
+                       'x' * self.cache.budget, '"etag"', None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def testWriteInvalidatesItsGroup(self):
+        written, other = ('user', '1', 'contact'), ('user', '2', 'contact')
+        keys = [self.put('1', written), self.put('2', written)]
+        kept = self.put('1', other)
+        self.cache.invalidate(written)
+        for key in keys:
+            self.assertEqual(self.cache.get(key), None)
+        self.assertNotEqual(self.cache.get(kept), None)
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+    def testResponseReadBeforeWriteIsNotStored(self):
+        """ A GET that read the generation before a write came in must
+        not cache what its backend returned. """
+        group = ('user', '1', 'contact')
+        generation = self.cache.generation(group)
+        self.cache.invalidate(group)
+        self.cache.put(group + ('1', ''), group, generation, 60, 200, 'stale', '"etag"', None)
+        self.assertEqual(self.cache.get(group + ('1', '')), None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+
+class ReadBodyTest(unittest.TestCase):
+    """ Request bodies, read by RESTHandler.readBody() in thread mode
+    and collected by AsyncHTTPChannel in async mode. """
+
+    port = 65191
+    mode = 'thread'
+    head = 'POST /user/1/profile/1 HTTP/1.1\r\nHost: localhost\r\n'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = startServer(cls.port, ['-s', '1', '-m', cls.mode, '-b', '100'])
+
+    @classmethod
+    def tearDownClass(cls):
+        stopServer(cls.server)
+
+    def send(self, headers, body):
+        """ Send a POST with headers and body on a new connection, and
+        return the status of the response and whether the connection
+        is closed after it. """
+        connection = create_connection(('127.0.0.1', self.port))
+        reader = connection.makefile('rb')
+        try:
+            connection.sendall(self.head + headers + '\r\n' + body)
+            return readResponse(reader)
+        finally:
+            reader.close()
+            connection.close()
+
+    def sendChunked(self, body):
+        return self.send('Transfer-Encoding: chunked\r\n', body)
+
+    def testChunkedBody(self):
+        self.assertEqual(self.sendChunked('1\r\n{\r\n1;ext=1\r\n}\r\n0\r\n\r\n'), (201, False))
+
+    def testMalformedChunks(self):
+        """ A malformed chunked body is answered like a missing one,
+        with the route's NOBODY status, and as the end of the body
+        cannot be found, the connection is closed. """
+        for body in ('zz\r\n{}\r\n0\r\n\r\n',
+                     '-2\r\n{}\r\n0\r\n\r\n',
+                     '2\r\n{}XX0\r\n\r\n'):
+            self.assertEqual(self.sendChunked(body), (404, True), repr(body))
+
+    def testContentLengthPastMaxBody(self):
+        self.assertEqual(self.send('Content-Length: 2\r\n', '{}'), (201, False))
+        self.assertEqual(self.send('Content-Length: 101\r\n', ' ' * 101), (413, True))
+
+    def testChunkedPastMaxBody(self):
+        self.assertEqual(self.sendChunked('32\r\n%s\r\n33\r\n%s\r\n0\r\n\r\n' %(' ' * 50, ' ' * 51)),
+                         (413, True))
+
+
+class AsyncReadBodyTest(ReadBodyTest):
+
+    port = 65192
+    mode = 'async'
+
+
+def metricValue(port, name):
+    """ Return the value of the metric with the whole label set name, or
+    None if it is not served. """
+    status, headers, body = request(port, 'GET', '/metrics')
+    if status != 200:
+        raise AssertionError('GET /metrics was answered with %d.' %(status))
+    for line in body.splitlines():
+        if line.rsplit(' ', 1)[0] == name:
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class RateLimitTest(unittest.TestCase):
+    """ A client past RATE_LIMIT, here two requests at once, with GET
+    /metrics never limited. """
+
+    port = 65196
+    mode = 'thread'
+
+    def setUp(self):
+        self.server = startServer(self.port, ['-s', '1', '-m', self.mode, '-A', '1', '-J', '2'])
+
+    def tearDown(self):
+        stopServer(self.server)
+
+    def testLimitedWithRetryAfter(self):
+        responses = [request(self.port, 'GET', '/user/1/profile/1', '{}') for i in range(3)]
+        self.assertEqual([status for status, headers, body in responses], [200, 200, 429])
+        self.assertEqual(responses[-1][1].get('retry-after'), '1')
+        for i in range(3):
+            self.assertEqual(metricValue(self.port, 'restserver_rate_limited_total{by="ip"}'), 1)
+
+
+class AsyncRateLimitTest(RateLimitTest):
+
+    port = 65197
+    mode = 'async'
+
+
+class AdmissionTest(unittest.TestCase):
+    """ MAX_ACTIVE of one request, held by a POST whose body has not
+    arrived yet.  In async mode a request is only counted once all of
+    it has been read, so it cannot be held in the same way. """
+
+    port = 65198
+
+    def setUp(self):
+        self.server = startServer(self.port, ['-s', '1', '-m', 'thread', '-f', '1'])
+
+    def tearDown(self):
+        stopServer(self.server)
+
+    def testShedWithRetryAfter(self):
+        holder = create_connection(('127.0.0.1', self.port))
+        reader = holder.makefile('rb')
+        try:
+            holder.sendall('POST /user/1/profile/1 HTTP/1.1\r\nHost: localhost\r\n'
+                           'Content-Length: 2\r\n\r\n')
+            # GET /metrics is answered even with every request taken.
+            for i in range(100):
+                if metricValue(self.port, 'restserver_active_requests') == 1:
+                    break
+                sleep(0.05)
+            self.assertEqual(metricValue(self.port, 'restserver_active_requests'), 1)
+            status, headers, body = request(self.port, 'GET', '/user/1/profile/1', '{}')
+            self.assertEqual((status, headers.get('retry-after')), (503, '1'))
+            self.assertEqual(metricValue(self.port, 'restserver_shed_total'), 1)
+            holder.sendall('{}')
+            self.assertEqual(readResponse(reader), (201, False))
+        finally:
+            reader.close()
+            holder.close()
+        self.assertEqual(request(self.port, 'GET', '/user/1/profile/1', '{}')[0], 200)
+
+
+def failingBackend(agentID, data):
+    raise KeyError('name')
+
+
+class BatchTest(InProcessServer, unittest.TestCase):
+
+    port = 65193
+    backends = {'fail': failingBackend}
+
+    @classmethod
+    def addRoutes(cls, restserver):
+        restserver.routes.add('GET', 'user', 'fail', restserver.agentCall, backend = 'test_backends.fail')
+
+    # Operations that succeed and fail in turn, with the status each
+    # is answered with.
+    operations = [({'method': 'GET', 'path': '/user/1/profile/1', 'body': {}}, 200),
+                  ({'method': 'GET', 'path': '/user/1/fail/1', 'body': {}}, 403),
+                  ({'method': 'POST', 'path': '/user/1/contact/1', 'body': {}}, 201),
+                  ({'method': 'GET', 'path': '/user/1/nothing/1', 'body': {}}, 404),
+                  ({'method': 'DELETE', 'path': '/user/1/profile/1'}, 400),
+                  ({'path': '/user/1/profile/1'}, 400),
+                  ({'method': 'PUT', 'path': '/user/1/profile/1', 'body': {}}, 204)]
+
+    def runBatch(self, path):
+        status, headers, body = self.request('POST', path, dumps([operation for operation, expected in self.operations]))
+        self.assertEqual(status, 200)
+        results = loads(body)
+        self.assertEqual([result['status'] for result in results],
+                         [expected for operation, expected in self.operations])
+        self.assertEqual(results[0]['body'], {'name': 'Some User', 'email': 'user@somedomain.someTLD'})
+        self.assertFalse('body' in results[1])
+
+    def failures(self):
+        """ Return the failures counted for the failing route. """
+        status, headers, body = self.request('GET', '/metrics')
+        for line in body.splitlines():
+            if line.startswith('restserver_failures_total{route="/user/<ID>/fail/<ID>"'):
+                return int(line.split()[-1])
+        return 0
+
+    def testMixedBatch(self):
+        before = self.failures()
+        self.runBatch('/batch')
+        self.assertEqual(self.failures(), before + 1)
+
+    def testMixedConcurrentBatch(self):
+        before = self.failures()
+        self.runBatch('/batch?concurrent=1')
+        self.assertEqual(self.failures(), before + 1)
+
+    def testBatchThatIsNotAnArray(self):
+        self.assertEqual(self.request('POST', '/batch', '{"method": "GET"}')[0], 400)
+
+
+# The connect and check functions of the pool tests, as a module that
+# RouteTable.bind() can reload.
+POOL_MODULE = """
+import sqlite3
+
+def connect():
+    return sqlite3.connect(':memory:', check_same_thread = False)
+
+def ping(connection):
+    connection.execute('SELECT 1')
+"""
+
+def isClosed(connection):
+    try:
+        connection.execute('SELECT 1')
+        return False
+    except sqlite3.ProgrammingError:
+        return True
+
+def selectRows(connection, *args):
+    for row in connection.execute('SELECT 1 UNION ALL SELECT 2'):
+        yield row[0]
+
+
+class ResourcePoolTest(unittest.TestCase):
+    """ ResourcePool with sqlite3 connections, bound by a RouteTable
+    of its own to the module POOL_MODULE. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = mkdtemp()
+        module = open(path.join(cls.directory, 'restserver_test_pool.py'), 'w')
+        try:
+            module.write(POOL_MODULE)
+        finally:
+            module.close()
+        sys.path.insert(0, cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.directory)
+        sys.modules.pop('restserver_test_pool', None)
+        rmtree(cls.directory)
+
+    def makePool(self, argv, size = None):
+        """ Import the server with the options argv, and return a
+        RouteTable with one pool, bound, and the pool. """
+        self.server = importServer(argv)
+        table = self.server.RouteTable()
+        table.addPool('db', 'restserver_test_pool.connect', 'restserver_test_pool.ping', size)
+        table.bind()
+        return table, table.pools['db']
+
+    def testSizeBound(self):
+        table, pool = self.makePool(['-U', '0.1'], size = 2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertRaises(self.server.PoolTimeout, pool.acquire)
+        pool.release(*first)
+        self.assertEqual(pool.acquire()[0], first[0])
+        stats = pool.stats()
+        self.assertEqual((stats['open'], stats['created'], stats['timeouts']), (2, 2, 1))
+
+    def testDeadConnectionIsDropped(self):
+        """ With POOL_CHECK 0, a connection is checked whenever it is
+        taken from the pool, and one that fails is replaced. """
+        table, pool = self.makePool(['-y', '0'])
+        connection, generation = pool.acquire()
+        pool.release(connection, generation)
+        connection.close()
+        replacement = pool.acquire()[0]
+        self.assertNotEqual(replacement, connection)
+        self.assertFalse(isClosed(replacement))
+        stats = pool.stats()
+        self.assertEqual((stats['open'], stats['created'], stats['failed_checks']), (1, 2, 1))
+
+    def testIdleConnectionExpires(self):
+        table, pool = self.makePool(['-u', '0.1'])
+        connection, generation = pool.acquire()
+        pool.release(connection, generation)
+        sleep(0.2)
+        self.assertNotEqual(pool.acquire()[0], connection)
+        self.assertTrue(isClosed(connection))
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def testGeneratorReleasedWhenConsumed(self):
+        table, pool = self.makePool(['-U', '0.1'], size = 1)
+        rows = pool.call(selectRows)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(list(rows), [1, 2])
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def testGeneratorReleasedWhenClosedEarly(self):
+        table, pool = self.makePool(['-U', '0.1'], size = 1)
+        rows = pool.call(selectRows)
+        self.assertEqual(next(rows), 1)
+        del rows
+        self.assertEqual(pool.stats()['idle'], 1)
+        connection, generation = pool.acquire()
+        self.assertFalse(isClosed(connection))
+
+    def testReloadClosesOldConnections(self):
+        """ bind() on a reload closes the free connections at once, and
+        the one in use once it comes back. """
+        table, pool = self.makePool([])
+        free, used = pool.acquire(), pool.acquire()
+        pool.release(*free)
+        table.bind(reloading = True)
+        self.assertTrue(isClosed(free[0]))
+        self.assertFalse(isClosed(used[0]))
+        pool.release(*used)
+        self.assertTrue(isClosed(used[0]))
+        stats = pool.stats()
+        self.assertEqual((stats['open'], stats['idle'], stats['closed']), (0, 0, 2))
+        self.assertFalse(isClosed(pool.acquire()[0]))
+
+
+# Set by holdConnection() once it has its connection, and waited for
+# by it before it gives it back.
+holding = Event()
+letGo = Event()
+
+def holdConnection(connection, agentID, data):
+    holding.set()
+    letGo.wait(10)
+    return {'held': agentID}
+
+
+class PooledRouteTest(InProcessServer, unittest.TestCase):
+    """ Routes whose backends share a pool of one sqlite3 connection. """
+
+    port = 65194
+    argv = ['-U', '0.2']
+    backends = {'connect': lambda: sqlite3.connect(':memory:', check_same_thread = False),
+                'hold': holdConnection,
+                'rows': selectRows}
+
+    @classmethod
+    def addRoutes(cls, restserver):
+        restserver.routes.addPool('db', 'test_backends.connect', size = 1)
+        restserver.routes.add('GET', 'user', 'hold', restserver.agentCall, backend = 'test_backends.hold', pool = 'db')
+        restserver.routes.add('GET', 'user', 'rows', restserver.agentCall, backend = 'test_backends.rows', pool = 'db')
+
+    def testPoolTimeoutIsUnavailable(self):
+        """ A request that finds the only connection in use is answered
+        with 503 once POOL_TIMEOUT has passed. """
+        holding.clear()
+        letGo.clear()
+        held = []
+        holder = Thread(target = lambda: held.append(self.request('GET', '/user/1/hold/1', '{}')[0]))
+        holder.start()
+        try:
+            self.assertTrue(holding.wait(10))
+            self.assertEqual(self.request('GET', '/user/1/rows/1', '{}')[0], 503)
+        finally:
+            letGo.set()
+            holder.join()
+        self.assertEqual(held, [200])
+        self.assertEqual(self.request('GET', '/user/1/rows/1', '{}')[0], 200)
+
+    def testGeneratorResultReleasesConnection(self):
+        for i in range(3):
+            status, headers, body = self.request('GET', '/user/1/rows/1', '{}')
+            self.assertEqual((status, loads(body)), (200, ['1', '2']))
+        self.assertEqual(self.restserver.routes.pools['db'].stats()['idle'], 1)
+
+
+# The version of the document of the coalescing tests, moved on by
+# each write, and the versions read by the backend calls.  The first
+# read is held until a test lets it go.
+document = {'version': 0, 'reads': []}
+reading = Event()
+resume = Event()
+
+def readDocument(agentID, data):
+    version = document['version']
+    document['reads'].append(version)
+    if len(document['reads']) == 1:
+        reading.set()
+        resume.wait(10)
+    return {'version': version}
+
+def writeDocument(agentID, data):
+    document['version'] += 1
+
+
+class CoalesceTest(InProcessServer, unittest.TestCase):
+    """ GETs of one document coalesced while its first read is held,
+    and cut loose by writes. """
+
+    port = 65195
+    argv = ['-X', '5']
+    backends = {'read': readDocument, 'write': writeDocument}
+
+    @classmethod
+    def addRoutes(cls, restserver):
+        restserver.routes.add('GET', 'user', 'doc', restserver.agentCall, backend = 'test_backends.read')
+        restserver.routes.add('PUT', 'user', 'doc', restserver.agentCall, backend = 'test_backends.write',
+                              success = 204)
+
+    def setUp(self):
+        document['version'] = 0
+        document['reads'] = []
+        reading.clear()
+        resume.clear()
+        self.before = self.restserver.coalescer.stats()
+        self.versions = []
+        self.leader = Thread(target = lambda: self.versions.append(self.read()))
+        self.leader.start()
+        self.assertTrue(reading.wait(10))
+
+    def tearDown(self):
+        resume.set()
+        self.leader.join()
+
+    def read(self):
+        status, headers, body = self.request('GET', '/user/1/doc/1', '{}')
+        self.assertEqual(status, 200)
+        return int(loads(body)['version'])
+
+    def counted(self, name):
+        return self.restserver.coalescer.stats()[name] - self.before[name]
+
+    def testIdenticalGetJoinsFlight(self):
+        follower = Thread(target = lambda: self.versions.append(self.read()))
+        follower.start()
+        # Give the follower time to join the flight of the leader.
+        sleep(0.2)
+        resume.set()
+        follower.join()
+        self.leader.join()
+        self.assertEqual(self.versions, [0, 0])
+        self.assertEqual(len(document['reads']), 1)
+        self.assertEqual(self.counted('shared'), 1)
+
+    def assertCutLoose(self):
+        """ Check that a GET after a write calls the backend itself,
+        while the read before the write is still held. """
+        self.assertEqual(self.read(), 1)
+        self.assertEqual(document['reads'], [0, 1])
+        self.assertEqual((self.counted('flights'), self.counted('timeouts')), (2, 0))
+        resume.set()
+        self.leader.join()
+        self.assertEqual(self.versions, [0])
+
+    def testWriteCutsFlightLoose(self):
+        self.assertEqual(self.request('PUT', '/user/1/doc/1', '{}')[0], 204)
+        self.assertCutLoose()
+
+    def testBatchWriteCutsFlightLoose(self):
+        status, headers, body = self.request('POST', '/batch', dumps([{'method': 'PUT', 'path': '/user/1/doc/1',
+                                                                        'body': {}}]))
+        self.assertEqual((status, loads(body)), (200, [{'status': 204}]))
+        self.assertCutLoose()
+
+
+if __name__ == '__main__':
+    unittest.main()